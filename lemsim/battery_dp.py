@@ -0,0 +1,338 @@
+"""
+Solves the battery control problem of `lemsim.lp_with_reg.solve_bat`
+without an LP solver.
+
+The cost of each timeslot is a convex piecewise-linear function of the
+battery usage, so the optimal cost-to-go is a convex piecewise-linear
+function of the state of charge. It is propagated backwards exactly
+(infimal convolution of piecewise-linear functions amounts to merging
+their slopes) and the optimal actions are recovered with a forward pass.
+"""
+import numpy as np
+
+
+class ConvexPWL:
+    """
+    Convex piecewise-linear function defined on a closed interval.
+
+    It is stored as the left end of its domain `x0`, the value at
+    that point `v0`, and the length and slope of every segment, with
+    the slopes sorted in increasing order.
+    """
+
+    __slots__ = ("x0", "v0", "lengths", "slopes")
+
+    def __init__(self, x0, v0, lengths, slopes):
+        self.x0 = float(x0)
+        self.v0 = float(v0)
+        self.lengths = np.asarray(lengths, dtype=float)
+        self.slopes = np.asarray(slopes, dtype=float)
+
+    @classmethod
+    def from_points(cls, xs, values):
+        """
+        Builds the function interpolating `values` at the sorted
+        points `xs`
+        """
+        xs = np.asarray(xs, dtype=float)
+        values = np.asarray(values, dtype=float)
+        lengths = np.diff(xs)
+        keep = lengths > 0
+        slopes = np.diff(values)[keep] / lengths[keep]
+        return cls(xs[0], values[0], lengths[keep], slopes)
+
+    @property
+    def end(self):
+        return self.x0 + self.lengths.sum()
+
+    def breakpoints(self):
+        """
+        Returns the abscissas and the values at every breakpoint
+        """
+        xs = self.x0 + np.concatenate([[0], np.cumsum(self.lengths)])
+        vs = self.v0 + np.concatenate([[0], np.cumsum(self.lengths * self.slopes)])
+        return xs, vs
+
+    def __call__(self, x):
+        xs, vs = self.breakpoints()
+        return np.interp(x, xs, vs)
+
+    def reflect(self):
+        """
+        Returns the function x -> self(-x)
+        """
+        xs, vs = self.breakpoints()
+        return ConvexPWL(-xs[-1], vs[-1], self.lengths[::-1], -self.slopes[::-1])
+
+    def restrict(self, lo, hi, tol=1e-9):
+        """
+        Restricts the domain to [`lo`, `hi`]. Returns None if the
+        intersection is empty.
+        """
+        xs, vs = self.breakpoints()
+        lo_ = max(lo, xs[0])
+        hi_ = min(hi, xs[-1])
+        if lo_ > hi_ + tol:
+            return None
+        hi_ = max(lo_, hi_)
+        inner = (xs > lo_) & (xs < hi_)
+        points = np.concatenate([[lo_], xs[inner], [hi_]])
+        return ConvexPWL.from_points(points, np.interp(points, xs, vs))
+
+    def infconv(self, other):
+        """
+        Infimal convolution, (f # g)(x) = min_{y + z = x} f(y) + g(z)
+        """
+        lengths = np.concatenate([self.lengths, other.lengths])
+        slopes = np.concatenate([self.slopes, other.slopes])
+        order = np.argsort(slopes, kind="stable")
+        lengths = lengths[order]
+        slopes = slopes[order]
+        # Merge consecutive segments with the same slope
+        if slopes.shape[0] > 1:
+            starts = np.flatnonzero(np.concatenate([[True], np.diff(slopes) != 0]))
+            lengths = np.add.reduceat(lengths, starts)
+            slopes = slopes[starts]
+        return ConvexPWL(self.x0 + other.x0, self.v0 + other.v0, lengths, slopes)
+
+
+def _inv_min_net(n, e_c, e_d):
+    """
+    Battery usage for which the minimum external energy is `n`
+    """
+    return n * e_c if n > 0 else n / e_d
+
+
+def _inv_max_net(n, e_c, e_d, d_max, dis_max):
+    """
+    Battery usage for which the maximum external energy is `n`, that is,
+    charging and discharging at the same time as much as possible
+    """
+    u = (n + dis_max * e_d) * e_c - dis_max
+    if u <= d_max - dis_max:
+        return u
+    return d_max - (d_max / e_c - n) / e_d
+
+
+def stage_cost(z, p_b, p_s, e_c, e_d, d_max, d_min, commitment=None, eps=1e-3):
+    """
+    Cost of one timeslot as a function of the battery usage u = x_c - x_d,
+    minimizing over all the pairs (x_c, x_d) that yield u.
+
+    Parameters
+    -----------
+    z : float
+        Load of the timeslot
+    p_b, p_s : float
+        Buying and selling price of the timeslot
+    e_c, e_d, d_max, d_min: float
+        Battery parameters, as in `solve_bat`
+    commitment : float or None
+        Energy committed in the timeslot, as in `solve_bat`
+
+    Returns
+    --------
+    ConvexPWL or None
+        The cost, or None if no battery usage satisfies the commitment
+    """
+    dis_max = -d_min
+    n_lo, n_hi = -np.inf, np.inf
+    if commitment is not None:
+        if commitment > 0:
+            n_lo = max(commitment - eps, 0) - z
+        else:
+            n_hi = min(0, commitment + eps) - z
+
+    lo, hi = d_min, d_max
+    if np.isfinite(n_lo):
+        lo = max(lo, _inv_max_net(n_lo, e_c, e_d, d_max, dis_max))
+    if np.isfinite(n_hi):
+        hi = min(hi, _inv_min_net(n_hi, e_c, e_d))
+    if lo > hi + 1e-9:
+        return None
+    hi = max(lo, hi)
+
+    candidates = [lo, hi, 0, d_max - dis_max,
+                  _inv_min_net(-z, e_c, e_d),
+                  _inv_max_net(-z, e_c, e_d, d_max, dis_max)]
+    for n in (n_lo, n_hi):
+        if np.isfinite(n):
+            candidates.append(_inv_min_net(n, e_c, e_d))
+            candidates.append(_inv_max_net(n, e_c, e_d, d_max, dis_max))
+    us = np.unique(np.clip(candidates, lo, hi))
+
+    # Range of external energy reachable with each battery usage
+    net_min = np.where(us > 0, us / e_c, us * e_d)
+    x_c = np.minimum(d_max, us + dis_max)
+    net_max = x_c / e_c - (x_c - us) * e_d
+    net_min = np.maximum(net_min, n_lo)
+    net_max = np.maximum(np.minimum(net_max, n_hi), net_min)
+
+    def cost(n):
+        return np.maximum(p_b * (n + z), p_s * (n + z))
+
+    best = np.minimum(cost(net_min), cost(net_max))
+    crossing = (net_min < -z) & (net_max > -z)
+    best[crossing] = np.minimum(best[crossing], 0)
+    return ConvexPWL.from_points(us, best)
+
+
+def backward_pass(costs, B_min, B_max):
+    """
+    Cost-to-go of every timeslot as a function of the state of charge at
+    its start, given the cost of each timeslot (see `stage_cost`). The
+    one of the first timeslot is not restricted to [`B_min`, `B_max`].
+
+    Returns
+    --------
+    list of ConvexPWL
+        One for each timeslot and one for the end of the horizon
+    """
+    T = len(costs)
+    values = [None] * (T + 1)
+    values[T] = ConvexPWL.from_points([B_min, B_max], [0, 0])
+    for t in reversed(range(T)):
+        v = values[t + 1].infconv(costs[t].reflect())
+        if t > 0:
+            v = v.restrict(B_min, B_max)
+            if v is None:
+                raise ValueError("Infeasible battery problem")
+        values[t] = v
+    return values
+
+
+def best_step(f, v, b, tol=1e-9):
+    """
+    Optimal state of charge after a timeslot that starts at `b`, with
+    the cost `f` of the timeslot and the cost-to-go `v` of the next one.
+    Among several optimal actions, the one using the battery the least
+    is chosen.
+    """
+    y_lo = max(v.x0, b + f.x0)
+    y_hi = max(y_lo, min(v.end, b + f.end))
+    ys = np.concatenate([v.breakpoints()[0], b + f.breakpoints()[0], [b]])
+    ys = np.unique(np.clip(ys, y_lo, y_hi))
+    total = f(ys - b) + v(ys)
+    best = total.min()
+    optimal = np.flatnonzero(total <= best + tol * (1 + abs(best)))
+    return ys[optimal[np.argmin(np.abs(ys[optimal] - b))]]
+
+
+def solve_bat_dp(
+    demand,
+    price_buy,
+    price_sell,
+    B_0,
+    B_max,
+    B_min,
+    e_c,
+    e_d,
+    d_max,
+    d_min,
+    commitments={},
+    reg=False,
+    eps=1e-3,
+    seed=420
+):
+    """
+    Drop-in replacement of `lemsim.lp_with_reg.solve_bat` based on
+    dynamic programming. Among several optimal actions, the one using
+    the battery the least is chosen.
+
+    Returns
+    --------
+    status : str
+        Always 'optimal', a ValueError is raised if the problem is infeasible
+    value : float
+        Total cost of the optimal control
+    sol : np.array
+        Battery usage (charge minus discharge) in each timeslot
+    model : None
+        There is no solver model associated
+    """
+    if reg:
+        raise ValueError("Regularization is only available with the LP engine")
+    assert (price_buy >= price_sell).all()
+
+    T = len(demand)
+    tol = 1e-9
+
+    # Backward pass: cost-to-go as a function of the state of charge
+    costs = [None] * T
+    for t in reversed(range(T)):
+        costs[t] = stage_cost(demand[t], price_buy[t], price_sell[t], e_c, e_d,
+                              d_max, d_min, commitments.get(t, None), eps)
+        if costs[t] is None:
+            raise ValueError("Commitment {0} cannot be satisfied".format(t))
+    values = backward_pass(costs, B_min, B_max)
+
+    if not (values[0].x0 - tol <= B_0 <= values[0].end + tol):
+        raise ValueError("Infeasible battery problem")
+
+    # Forward pass: recover the optimal actions
+    sol = np.zeros(T)
+    value = 0
+    b = B_0
+    for t in range(T):
+        y = best_step(costs[t], values[t + 1], b, tol)
+        sol[t] = y - b
+        value += costs[t](sol[t])
+        b = y
+
+    return "optimal", value, sol, None
+
+
+def first_step_curve(
+    demand,
+    price_buy,
+    price_sell,
+    first_prices,
+    B_0,
+    B_max,
+    B_min,
+    e_c,
+    e_d,
+    d_max,
+    d_min,
+    commitments={},
+    eps=1e-3
+):
+    """
+    Optimal battery usage of the first timeslot of the problem of
+    `solve_bat_dp` for several prices of the first timeslot. The
+    cost-to-go from the second timeslot does not depend on them, so it
+    is computed with a single backward pass and each price only needs
+    the step of the first timeslot.
+
+    Parameters
+    -----------
+    first_prices : list of tuples
+        (buying price, selling price) of the first timeslot
+    Others :
+        As in `solve_bat_dp`. `price_buy[0]` and `price_sell[0]` are
+        not used.
+
+    Returns
+    --------
+    np.array
+        Battery usage of the first timeslot for each pair of prices
+    """
+    T = len(demand)
+    tol = 1e-9
+    costs = [None] * T
+    for t in reversed(range(1, T)):
+        costs[t] = stage_cost(demand[t], price_buy[t], price_sell[t], e_c, e_d,
+                              d_max, d_min, commitments.get(t, None), eps)
+        if costs[t] is None:
+            raise ValueError("Commitment {0} cannot be satisfied".format(t))
+    v = backward_pass(costs[1:], B_min, B_max)[0].restrict(B_min, B_max)
+    if v is None:
+        raise ValueError("Infeasible battery problem")
+
+    usage = np.zeros(len(first_prices))
+    for k, (p_b, p_s) in enumerate(first_prices):
+        f = stage_cost(demand[0], p_b, p_s, e_c, e_d, d_max, d_min, commitments.get(0, None), eps)
+        if f is None:
+            raise ValueError("Commitment 0 cannot be satisfied")
+        usage[k] = best_step(f, v, B_0, tol) - B_0
+    return usage
@@ -0,0 +1,153 @@
+"""
+Battery control problem of `lemsim.lp_with_reg.solve_bat` written
+as sparse matrices, so that the problems of many batteries can be
+stacked into a single block-diagonal LP and solved with one call.
+"""
+import numpy as np
+import scipy.sparse as sp
+from lemsim.solvers import LinearProgram, get_backend
+
+
+def battery_lp(
+    demand,
+    price_buy,
+    price_sell,
+    B_0,
+    B_max,
+    B_min,
+    e_c,
+    e_d,
+    d_max,
+    d_min,
+    commitments={},
+    eps=1e-3,
+    formulation='state'
+):
+    """
+    Builds the battery problem of `solve_bat`. The variables are ordered
+    as charge, discharge and cost, T of each, followed by the state of
+    charge with the `state` formulation.
+
+    Returns
+    --------
+    LinearProgram
+    """
+    assert (price_buy >= price_sell).all()
+    assert formulation in ['cumulative', 'state']
+    T = len(demand)
+    z = np.asarray(demand, dtype=float)
+    pb = np.asarray(price_buy, dtype=float)
+    ps = np.asarray(price_sell, dtype=float)
+    idx = np.arange(T)
+    xc, xd, ts, soc = idx, T + idx, 2 * T + idx, 3 * T + idx
+
+    max_t = (z.max() + d_max) * pb.max() * 1.5 / e_c
+    min_t = (z.min() + d_min) * ps.max() * 1.5 / e_d
+
+    n = 4 * T if formulation == 'state' else 3 * T
+    c = np.zeros(n)
+    c[ts] = 1
+    lb = np.concatenate([np.zeros(2 * T), np.repeat(min_t, T), np.repeat(B_min, T)])[:n]
+    ub = np.concatenate([np.repeat(d_max, T), np.repeat(-d_min, T),
+                         np.repeat(max_t, T), np.repeat(B_max, T)])[:n]
+
+    # p * (x_c / e_c - x_d * e_d) - t <= - p * z, for both prices
+    rows = [idx, idx, idx, T + idx, T + idx, T + idx]
+    cols = [xc, xd, ts, xc, xd, ts]
+    data = [pb / e_c, -pb * e_d, -np.ones(T), ps / e_c, -ps * e_d, -np.ones(T)]
+    b_ub = [-pb * z, -ps * z]
+
+    m = 2 * T
+    if formulation == 'cumulative':
+        # B_min - B_0 <= sum_{j <= i} x_c_j - x_d_j <= B_max - B_0
+        r_, c_ = np.tril_indices(T)
+        for sign, rhs in [(-1, B_0 - B_min), (1, B_max - B_0)]:
+            rows.extend([m + r_, m + r_])
+            cols.extend([xc[c_], xd[c_]])
+            data.extend([sign * np.ones(r_.shape[0]), -sign * np.ones(r_.shape[0])])
+            b_ub.append(np.repeat(rhs, T))
+            m += T
+
+    # Commitments on the energy seen from outside the battery
+    for k, v in commitments.items():
+        if v is None or k >= T:
+            continue
+        sign = -1 if v > 0 else 1
+        rhs = max((v - eps), 0) if v > 0 else min(0, v + eps)
+        rows.append(np.array([m, m]))
+        cols.append(np.array([xc[k], xd[k]]))
+        data.append(sign * np.array([1 / e_c, -e_d]))
+        b_ub.append([sign * (rhs - z[k])])
+        m += 1
+
+    A_ub = sp.coo_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(m, n),
+    ).tocsr()
+    b_ub = np.concatenate(b_ub)
+
+    if formulation == 'cumulative':
+        return LinearProgram(c, A_ub, b_ub, sp.csr_matrix((0, n)), np.zeros(0), lb, ub)
+
+    # soc_i - soc_{i-1} - x_c_i + x_d_i = 0, with soc_{-1} = B_0
+    A_eq = sp.coo_matrix(
+        (
+            np.concatenate([np.ones(T), -np.ones(T - 1), -np.ones(T), np.ones(T)]),
+            (np.concatenate([idx, idx[1:], idx, idx]), np.concatenate([soc, soc[:-1], xc, xd])),
+        ),
+        shape=(T, 4 * T),
+    ).tocsr()
+    b_eq = np.zeros(T)
+    b_eq[0] = B_0
+
+    return LinearProgram(c, A_ub, b_ub, A_eq, b_eq, lb, ub)
+
+
+def stack_lps(lps):
+    """
+    Stacks several independent problems into a single block-diagonal one
+    """
+    return LinearProgram(
+        np.concatenate([lp.c for lp in lps]),
+        sp.block_diag([lp.A_ub for lp in lps], format="csr"),
+        np.concatenate([lp.b_ub for lp in lps]),
+        sp.block_diag([lp.A_eq for lp in lps], format="csr"),
+        np.concatenate([lp.b_eq for lp in lps]),
+        np.concatenate([lp.lb for lp in lps]),
+        np.concatenate([lp.ub for lp in lps]),
+    )
+
+
+def solve_battery_lps(lps, backend=None, seed=420):
+    """
+    Solves the battery problems built with `battery_lp` as one block-diagonal
+    LP and splits the solution back.
+
+    Parameters
+    -----------
+    lps : list of LinearProgram
+    backend : str or SolverBackend
+        Solver to use, see `lemsim.solvers.get_backend`
+    seed : int
+
+    Returns
+    --------
+    list of tuples
+        For each problem, (status, value, sol, None) as in `solve_bat`
+    """
+    if len(lps) == 0:
+        return []
+    status, _, x, _ = get_backend(backend, seed).solve_lp(stack_lps(lps))
+    if x is None:
+        print('Solver error', status)
+        raise ValueError
+
+    results = []
+    start = 0
+    for lp in lps:
+        # The cost variables are the only ones in the objective
+        T = np.count_nonzero(lp.c)
+        x_ = x[start: start + lp.c.shape[0]]
+        results.append((status, x_[2 * T: 3 * T].sum(), x_[:T] - x_[T: 2 * T], None))
+        start += lp.c.shape[0]
+    return results
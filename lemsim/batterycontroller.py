@@ -4,7 +4,13 @@ formulation
 """
 
 import numpy as np
-from lemsim.lp_with_reg import solve_bat
+from collections import defaultdict
+from functools import partial
+from lemsim.lp_with_reg import solve_bat, PersistentBatteryModel
+from lemsim.battery_dp import solve_bat_dp
+from lemsim.battery_lp import battery_lp, solve_battery_lps
+
+ENGINES = ['lp', 'dp', 'persistent']
 
 class BatteryController:
     """
@@ -12,7 +18,7 @@ class BatteryController:
     and controls it using an LP
     """
     
-    def __init__(self, owner_id, b_max, b_min, eff_c, eff_d, d_max, d_min, seed=420):
+    def __init__(self, owner_id, b_max, b_min, eff_c, eff_d, d_max, d_min, seed=420, engine='lp', backend=None):
         """
         Instanciates the consumer with a battery
         Params:
@@ -24,7 +30,15 @@ class BatteryController:
             eff_d, float: efficiency of discharging the battery (0, 1]
             d_max, float: maximum amount of power that the battery can charge in kW
             d_min, float: maximum amount of power that the battery can discharge in kW
+            engine, str: method used to solve the control problem, `lp` solves
+                an LP with `backend`, `dp` uses dynamic programming and `persistent`
+                updates and re-solves the same CPLEX model at every step
+            backend, str: solver used by the `lp` engine, see `lemsim.solvers`,
+                HiGHS by default. With ties the solvers can choose other optimal
+                actions, so the results differ from runs before HiGHS was the
+                default unless `backend='cplex'`
         """
+        assert engine in ENGINES
         self.owner_id = owner_id
         self.b_max = b_max
         self.b_min = b_min
@@ -34,6 +48,9 @@ class BatteryController:
         self.d_min = d_min
         self.charge = b_min
         self.seed = seed
+        self.engine = engine
+        self.backend = backend
+        self.model = PersistentBatteryModel(seed) if engine == 'persistent' else None
     
     def reset(self, init_charge=None):
         """
@@ -57,25 +74,35 @@ class BatteryController:
             fload, np.array: forecast of the future net load in kW
             fprice_b, np.array: forecast of the futre buying price
             fprice_s, np.array: forecast of the futre selling price
+            commitment, dict: energy committed in some of the timeslots
+            reg, bool: regularize the actions, only with the `lp` engine
         Returns:
             xs, np.array: the optimal action for each of the timeslots consdiered
         """
+        if reg and self.engine != 'lp':
+            raise ValueError("Regularization needs the lp engine, not {0}".format(self.engine))
         #if self.owner_id == 32:
         #    print(len(fload), commitment)
-        res = solve_bat(fload,
-                       fprice_b,
-                       fprice_s,
-                       self.charge,
-                       self.b_max,
-                       self.b_min,
-                       self.eff_c,
-                       self.eff_d,
-                       self.d_max,
-                       self.d_min,
-                       commitment,
-                       reg,
-                       seed=self.seed
-                      )
+        if self.engine == 'persistent':
+            solver = self.model.solve
+        elif self.engine == 'dp':
+            solver = solve_bat_dp
+        else:
+            solver = partial(solve_bat, backend=self.backend)
+        res = solver(fload,
+                     fprice_b,
+                     fprice_s,
+                     self.charge,
+                     self.b_max,
+                     self.b_min,
+                     self.eff_c,
+                     self.eff_d,
+                     self.d_max,
+                     self.d_min,
+                     commitment,
+                     reg,
+                     seed=self.seed
+                    )
         a, b,c, d = res
         #if self.owner_id == 32:
         #    print(d.export_as_lp_string())
@@ -86,3 +113,60 @@ class BatteryController:
         Updated the charge of the battery by an amount x
         """
         self.charge += x
+
+    def battery(self):
+        """
+        A BatteryController with the parameters and the charge of this
+        one, and none of the state of the subclasses, to send it to
+        other processes
+        Returns:
+            BatteryController
+        """
+        bat = BatteryController(self.owner_id, self.b_max, self.b_min, self.eff_c, self.eff_d,
+                                self.d_max, self.d_min, self.seed, self.engine, self.backend)
+        bat.charge = self.charge
+        return bat
+
+
+def find_optimal_steps(controllers, problems):
+    """
+    Solves the control problem of many batteries at once. The batteries
+    with the `lp` engine are solved as a single block-diagonal LP for
+    each backend and seed, and the others one by one with their own
+    engine.
+    Params:
+        controllers, list of BatteryController: the batteries to control
+        problems, list of tuples: for each battery the arguments
+            (fload, fprice_b, fprice_s, commitment) of `find_optimal_step`
+    Returns:
+        list of tuples: for each battery, the same result as `find_optimal_step`
+    """
+    results = [None] * len(controllers)
+    groups = defaultdict(list)
+    for i, (bat, problem) in enumerate(zip(controllers, problems)):
+        if bat.engine == 'lp':
+            groups[(bat.backend, bat.seed)].append(i)
+        else:
+            results[i] = bat.find_optimal_step(*problem)
+    for (backend, seed), idx in groups.items():
+        lps = []
+        for i in idx:
+            bat = controllers[i]
+            fload, fprice_b, fprice_s, commitment = problems[i]
+            lp = battery_lp(fload,
+                            fprice_b,
+                            fprice_s,
+                            bat.charge,
+                            bat.b_max,
+                            bat.b_min,
+                            bat.eff_c,
+                            bat.eff_d,
+                            bat.d_max,
+                            bat.d_min,
+                            commitment
+                           )
+            lps.append(lp)
+        res = solve_battery_lps(lps, backend, seed)
+        for i, (a, b, c, _) in zip(idx, res):
+            results[i] = (a, b, c)
+    return results
@@ -1,3 +1,5 @@
+from bisect import bisect_right
+
 import numpy as np
 
 
@@ -120,16 +122,20 @@ class bundleSelling:
 
 
 def intervals_intercept(s1, e1, s2, e2):
-
-    interval1 = list(range(s1, e1 + 1))
-    interval2 = list(range(s2, e2 + 1))
-    intersection = [x for x in interval1 if x in interval2]
-    return len(intersection) > 0
+    """
+    True if the intervals [s1, e1] and [s2, e2] share an item
+    """
+    return s1 <= e1 and s2 <= e2 and s1 <= e2 and s2 <= e1
 
 
 class Bid:
     """
     Represents a bid, which is composed of bundles
+
+    The bundles and selling bundles of a bid cannot overlap, so they are
+    indexed as disjoint intervals sorted by their start, and the single
+    items by their timeslot. The consistency of a new piece is checked
+    with a binary search instead of going through all the pieces.
     """
 
     def __init__(self, uid):
@@ -137,6 +143,37 @@ class Bid:
         self.bundles = []
         self.sellingbundles = []
         self.singles = []
+        # Start, end and side of the bundles and selling bundles
+        self._starts = []
+        self._intervals = []
+        # Side of the single item of each timeslot, and the sorted timeslots
+        self._single_sides = {}
+        self._single_items = []
+
+    def _overlaps(self, start, end):
+        """
+        True if [start, end] shares an item with a bundle or selling bundle
+        """
+        k = bisect_right(self._starts, end)
+        return k > 0 and intervals_intercept(*self._intervals[k - 1][:2], start, end)
+
+    def _interval_side(self, item):
+        """
+        Side of the bundle or selling bundle that contains `item`, None
+        if there is not one
+        """
+        k = bisect_right(self._starts, item)
+        if k > 0 and self._intervals[k - 1][1] >= item:
+            return self._intervals[k - 1][2]
+        return None
+
+    def _add_interval(self, start, end, isbuying):
+        if start > end:
+            # An empty bundle does not take any timeslot
+            return
+        k = bisect_right(self._starts, start)
+        self._starts.insert(k, start)
+        self._intervals.insert(k, (start, end, isbuying))
 
     def add_bundle(self, start, end, quantity, unitcost, isbuying, upper_bound=None):
         """
@@ -152,20 +189,19 @@ class Bid:
         bool
             True if the new bundle was added
         """
-        consistent = True
-        for bund in self.bundles + self.sellingbundles:
-            if intervals_intercept(bund.start, bund.end, start, end):
-                consistent = False
+        consistent = not self._overlaps(start, end)
 
-        vals = list(range(start, end + 1))
-        for sing in self.singles:
-            if (sing.item in vals) and (sing.isbuying != isbuying):
+        lo = bisect_right(self._single_items, start - 1)
+        hi = bisect_right(self._single_items, end)
+        for item in self._single_items[lo:hi]:
+            if self._single_sides[item] != isbuying:
                 consistent = False
         if consistent:
             new_bundle = simpleBundle(
                 start, end, quantity, isbuying, unitcost, upper_bound
             )
             self.bundles.append(new_bundle)
+            self._add_interval(start, end, isbuying)
 
         return consistent
 
@@ -176,22 +212,17 @@ class Bid:
         was a bundle, it should be also for the same type of isbuying
         """
 
-        consistent = True
-        for s in self.singles:
-            if s.item == item:
-                consistent = False
-        for b in self.bundles:
-            vals = list(range(b.start, b.end + 1))
-            if (item in vals) and (isbuying != b.isbuying):
-                consistent = False
-        for b in self.sellingbundles:
-            vals = list(range(b.start, b.end + 1))
-            if (item in vals) and isbuying:
-                consistent = False
+        consistent = item not in self._single_sides
+        # Selling bundles are on the selling side
+        side = self._interval_side(item)
+        if side is not None and side != isbuying:
+            consistent = False
 
         if consistent:
             new_single = singleItem(item, quantity, unitcost, isbuying)
             self.singles.append(new_single)
+            self._single_sides[item] = isbuying
+            self._single_items.insert(bisect_right(self._single_items, item), item)
         return consistent
 
     def add_bundle_selling(
@@ -202,13 +233,11 @@ class Bid:
         selling bounds and it cannot be at the same timeslot than a buying
         offer
         """
-        timeslots = list(range(start, end + 1))
-        consistent = True
-        for s in self.singles:
-            if (s.item in timeslots) and (s.isbuying is True):
-                consistent = False
-        for bund in self.bundles + self.sellingbundles:
-            if intervals_intercept(start, end, bund.start, bund.end):
+        consistent = not self._overlaps(start, end)
+        lo = bisect_right(self._single_items, start - 1)
+        hi = bisect_right(self._single_items, end)
+        for item in self._single_items[lo:hi]:
+            if self._single_sides[item] is True:
                 consistent = False
 
         if consistent:
@@ -216,4 +245,5 @@ class Bid:
                 start, end, quantities, keep, unitcost, keep_quantities
             )
             self.sellingbundles.append(new_bundle)
+            self._add_interval(start, end, False)
         return consistent
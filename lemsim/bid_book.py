@@ -0,0 +1,437 @@
+"""
+Bid books of the combinatorial markets as an artifact of their own.
+
+The bids of `lemsim.core.MainSim.sim_comb_trade` only depend on the data
+of the prosumers and on the markup of the signaling, not on the mechanism
+that clears them. A BidBook is built once for a scenario (see
+`build_bid_book`) and kept in a `BidBookStore`, so that the `combflex`,
+`combflex_split` and `combflex_vcg` runs of the same scenario do not
+solve the battery problems of every prosumer again.
+
+The pieces of the bids are stored as arrays (see `BidBook`), so that a
+book of many bidders can be checked, saved and built into a WDP (see
+`lemsim.wdp.WinnerDeterminationProblem.add_book`) without going through
+an object per piece.
+"""
+import hashlib
+import os
+
+import numpy as np
+from lemsim.utils import create_bid, create_bids
+
+
+PIECE_TYPES = ["simplebundle", "singleitem", "sellingbundle"]
+BUNDLE, SINGLE, SELLING = range(3)
+
+
+def ragged_arange(lengths):
+    """
+    Position of every element inside its segment, for consecutive
+    segments of the given lengths
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum()) - np.repeat(starts, lengths)
+
+
+class BidBook:
+    """
+    Bids of a scenario, with the pieces of all the bidders stored in
+    contiguous arrays. The pieces of every bidder are consecutive, first
+    its bundles, then its single items and then its selling bundles, as
+    in `lemsim.wdp_matrix.build_wdp`.
+
+    The arrays of each timeslot of a piece (the upper bounds of a bundle,
+    the quantity of a single item, and the quantities of a selling
+    bundle) are in the flat buffer `values`, from `offsets[i]` to
+    `offsets[i + 1]`, and the quantities that can be kept of the selling
+    bundles in `keep_values` at the same positions.
+
+    `bids` gives `BidView` objects with the attributes of `lemsim.bid.Bid`,
+    so a BidBook can be passed to the WDP and the mechanisms as a list of
+    bids. They cannot be modified.
+
+    Parameters
+    -----------
+    uids : np.ndarray
+        Identifier of each bidder
+    bid_offsets : np.ndarray of int
+        Pieces of bidder `j` from `bid_offsets[j]` to `bid_offsets[j + 1]`
+    type : np.ndarray of int
+        `BUNDLE`, `SINGLE` or `SELLING`
+    start, end : np.ndarray of int
+        First and last timeslot, the same for a single item
+    quantity : np.ndarray of float
+        Total quantity of a bundle or quantity of a single item
+    keep : np.ndarray of float
+        Quantity to keep of a selling bundle
+    unitcost : np.ndarray of float
+    isbuying : np.ndarray of bool
+    threshold : np.ndarray of int
+        Threshold of a selling bundle (see `lemsim.bid.bundleSelling`)
+    offsets : np.ndarray of int
+    values, keep_values : np.ndarray of float
+    key : str
+        Key of the scenario (see `bid_book_key`)
+    """
+
+    FIELDS = ['uids', 'bid_offsets', 'type', 'start', 'end', 'quantity', 'keep', 'unitcost',
+              'isbuying', 'threshold', 'offsets', 'values', 'keep_values']
+
+    def __init__(self, uids, bid_offsets, type, start, end, quantity, keep, unitcost, isbuying,
+                 threshold, offsets, values, keep_values, key=None):
+        self.uids = uids
+        self.bid_offsets = bid_offsets
+        self.type = type
+        self.start = start
+        self.end = end
+        self.quantity = quantity
+        self.keep = keep
+        self.unitcost = unitcost
+        self.isbuying = isbuying
+        self.threshold = threshold
+        self.offsets = offsets
+        self.values = values
+        self.keep_values = keep_values
+        self.key = key
+        self._bids = None
+
+    @classmethod
+    def from_bids(cls, bids, key=None):
+        """
+        Copies a list of `lemsim.bid.Bid` into a BidBook
+        """
+        rows = []
+        values, keep_values = [], []
+        bid_offsets = [0]
+        for bd in bids:
+            for b_ in bd.bundles:
+                rows.append((BUNDLE, b_.start, b_.end, b_.quantity, 0, b_.unitcost, b_.isbuying, 0))
+                values.append(b_.upper_bound)
+                keep_values.append(np.zeros(b_.end - b_.start + 1))
+            for b_ in bd.singles:
+                rows.append((SINGLE, b_.item, b_.item, b_.quantity, 0, b_.unitcost, b_.isbuying, 0))
+                values.append([b_.quantity])
+                keep_values.append([0])
+            for b_ in bd.sellingbundles:
+                rows.append((SELLING, b_.start, b_.end, np.nan, b_.keep, b_.unitcost, False, b_.threshold))
+                values.append(b_.quantities)
+                keep_values.append(b_.keep_quantities)
+            bid_offsets.append(len(rows))
+        type_, start, end, quantity, keep, unitcost, isbuying, threshold = zip(*rows) if rows else [()] * 8
+        lengths = [len(v) for v in values]
+        uids = np.empty(len(bids), dtype=object)
+        uids[:] = [bd.uid for bd in bids]
+        return cls(
+            uids,
+            np.array(bid_offsets, dtype=np.int64),
+            np.array(type_, dtype=np.int8),
+            np.array(start, dtype=np.int64),
+            np.array(end, dtype=np.int64),
+            np.array(quantity, dtype=float),
+            np.array(keep, dtype=float),
+            np.array(unitcost, dtype=float),
+            np.array(isbuying, dtype=bool),
+            np.array(threshold, dtype=np.int64),
+            np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+            np.concatenate(values).astype(float) if values else np.zeros(0),
+            np.concatenate(keep_values).astype(float) if values else np.zeros(0),
+            key,
+        )
+
+    def __len__(self):
+        return self.uids.shape[0]
+
+    def __iter__(self):
+        return iter(self.bids)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_bids'] = None
+        return state
+
+    @property
+    def bids(self):
+        if self._bids is None:
+            self._bids = [BidView(self, j) for j in range(len(self))]
+        return self._bids
+
+    @property
+    def owner(self):
+        """
+        Position of the bidder of each piece
+        """
+        return np.repeat(np.arange(len(self)), np.diff(self.bid_offsets))
+
+    def take(self, idx):
+        """
+        BidBook with the bidders at the positions `idx`, in that order
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        counts = np.diff(self.bid_offsets)[idx]
+        pieces = np.repeat(self.bid_offsets[idx], counts) + ragged_arange(counts)
+        lengths = np.diff(self.offsets)[pieces]
+        values = np.repeat(self.offsets[pieces], lengths) + ragged_arange(lengths)
+        return BidBook(
+            self.uids[idx],
+            np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+            self.type[pieces],
+            self.start[pieces],
+            self.end[pieces],
+            self.quantity[pieces],
+            self.keep[pieces],
+            self.unitcost[pieces],
+            self.isbuying[pieces],
+            self.threshold[pieces],
+            np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+            self.values[values],
+            self.keep_values[values],
+        )
+
+    def check(self, M):
+        """
+        Checks all the bids at once as `lemsim.wdp.check_bid`
+
+        Returns
+        --------
+        np.ndarray of bool
+            True for the bidders whose bids fit a problem of `M`
+            timeslots
+        """
+        bundle = self.type == BUNDLE
+        malformed = np.diff(self.offsets) != self.end - self.start + 1
+        bad = bundle & ((self.end > M) | (self.start > self.end) | malformed)
+        return np.bincount(self.owner[bad], minlength=len(self)) == 0
+
+    def save(self, filename):
+        """
+        Saves the arrays of the book in a `.npz` file
+        """
+        arrays = {name: getattr(self, name) for name in self.FIELDS}
+        arrays['uids'] = np.asarray(self.uids.tolist())
+        np.savez(filename, key=np.array('' if self.key is None else self.key), **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            arrays = {name: data[name] for name in cls.FIELDS}
+            key = str(data['key']) or None
+        uids = np.empty(arrays['uids'].shape[0], dtype=object)
+        uids[:] = arrays['uids'].tolist()
+        arrays['uids'] = uids
+        return cls(key=key, **arrays)
+
+
+class BidView:
+    """
+    Bid `j` of a BidBook, with the attributes of `lemsim.bid.Bid`
+    """
+    __slots__ = ('book', 'j')
+
+    def __init__(self, book, j):
+        self.book = book
+        self.j = j
+
+    @property
+    def uid(self):
+        return self.book.uids[self.j]
+
+    def pieces(self, type_):
+        book = self.book
+        i = np.arange(book.bid_offsets[self.j], book.bid_offsets[self.j + 1])
+        return [PieceView(book, k) for k in i[book.type[i] == type_]]
+
+    @property
+    def bundles(self):
+        return self.pieces(BUNDLE)
+
+    @property
+    def singles(self):
+        return self.pieces(SINGLE)
+
+    @property
+    def sellingbundles(self):
+        return self.pieces(SELLING)
+
+
+class PieceView:
+    """
+    Piece `i` of a BidBook, with the attributes of `lemsim.bid.simpleBundle`,
+    `lemsim.bid.singleItem` or `lemsim.bid.bundleSelling`. The arrays are
+    views of the buffers of the book.
+    """
+    __slots__ = ('book', 'i')
+
+    def __init__(self, book, i):
+        self.book = book
+        self.i = i
+
+    @property
+    def type(self):
+        return PIECE_TYPES[self.book.type[self.i]]
+
+    @property
+    def start(self):
+        return int(self.book.start[self.i])
+
+    @property
+    def end(self):
+        return int(self.book.end[self.i])
+
+    @property
+    def item(self):
+        return int(self.book.start[self.i])
+
+    @property
+    def quantity(self):
+        return float(self.book.quantity[self.i])
+
+    @property
+    def keep(self):
+        return float(self.book.keep[self.i])
+
+    @property
+    def unitcost(self):
+        return float(self.book.unitcost[self.i])
+
+    @property
+    def isbuying(self):
+        return bool(self.book.isbuying[self.i])
+
+    @property
+    def threshold(self):
+        return int(self.book.threshold[self.i])
+
+    @property
+    def upper_bound(self):
+        return self.book.values[self.book.offsets[self.i]: self.book.offsets[self.i + 1]]
+
+    quantities = upper_bound
+
+    @property
+    def keep_quantities(self):
+        return self.book.keep_values[self.book.offsets[self.i]: self.book.offsets[self.i + 1]]
+
+
+def comb_prices(price_buy, price_sell, markup=False):
+    """
+    Prices with which the prosumers bid in the combinatorial markets.
+    With `markup`, the buying prices between the timeslots 15 and 30 are
+    lowered and the selling prices raised by 10%, and the timeslots where
+    buying gets cheaper than selling take the mean of both.
+    """
+    price_buy = price_buy.copy()
+    price_sell = price_sell.copy()
+    if markup:
+        price_buy[15: 30] *= 0.9
+        price_sell[15: 30] *= 1.1
+        for t in range(price_buy.shape[0]):
+            if price_buy[t] < price_sell[t]:
+                m = price_buy[t] + price_sell[t]
+                price_buy[t] = m * 0.5
+                price_sell[t] = m * 0.5
+    return price_buy, price_sell
+
+
+def prosumer_profile(p, markup=False):
+    """
+    Load, use of the battery and prices with which the prosumer `p`
+    bids for the whole first day, from its battery profile at the
+    prices of `comb_prices`
+    """
+    load = p.register[0]['load']
+    price_buy, price_sell = comb_prices(p.register[0]['price_buy'], p.register[0]['price_sell'], markup)
+    pbat = p.get_profile_only_battery(0, pb=price_buy, ps=price_sell)
+    return load, pbat - load, price_buy, price_sell
+
+
+def prosumer_bid(p, markup=False):
+    """
+    Bid of the prosumer `p` (see `prosumer_profile`)
+
+    Returns
+    --------
+    Same as `lemsim.utils.create_bid`
+    """
+    load, bat, price_buy, price_sell = prosumer_profile(p, markup)
+    return create_bid(p.owner_id, load, bat, price_buy, price_sell, p.d_max, -p.d_min)
+
+
+def bid_book_key(prosumers, markup=False):
+    """
+    Hash of everything the bids of `prosumers` depend on: their data,
+    their batteries and the solver they use
+    """
+    h = hashlib.sha256()
+    h.update(repr(markup).encode())
+    for p in prosumers:
+        h.update(repr((p.owner_id, p.b_max, p.b_min, p.eff_c, p.eff_d, p.d_max, p.d_min,
+                       p.seed, p.engine, p.backend, p.full_foresight())).encode())
+        for name in ['load', 'price_buy', 'price_sell']:
+            h.update(np.ascontiguousarray(p.register[0][name], dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def build_bid_book(prosumers, markup=False):
+    """
+    Builds the BidBook of `prosumers`, with the valid bids only
+    """
+    bids = []
+    if len(prosumers) > 0:
+        loads, bats, prices_buy, prices_sell = map(np.array, zip(*[prosumer_profile(p, markup) for p in prosumers]))
+        created = create_bids([p.owner_id for p in prosumers], loads, bats, prices_buy, prices_sell,
+                              [p.d_max for p in prosumers], [-p.d_min for p in prosumers])
+        bids = [bd for bd, status in created if status is True]
+    return BidBook.from_bids(bids, bid_book_key(prosumers, markup))
+
+
+class BidBookStore:
+    """
+    Bid books by the key of their scenario
+
+    Parameters
+    -----------
+    path : str
+        Directory where the bid books are also saved as `{key}.npz`
+        files, so that they are shared between processes and runs. If
+        None they are only kept in memory.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.books = dict()
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def __getstate__(self):
+        # The bid books in memory are not pickled with the simulations
+        state = self.__dict__.copy()
+        state['books'] = dict()
+        return state
+
+    def __len__(self):
+        return len(self.books)
+
+    def filename(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def get(self, prosumers, markup=False):
+        """
+        Returns the BidBook of `prosumers`, building it if it is not
+        stored yet
+        """
+        key = bid_book_key(prosumers, markup)
+        book = self.books.get(key)
+        if book is None and self.path is not None and os.path.isfile(self.filename(key)):
+            book = BidBook.load(self.filename(key))
+        if book is None:
+            self.misses += 1
+            book = build_bid_book(prosumers, markup)
+            if self.path is not None:
+                book.save(self.filename(key))
+        else:
+            self.hits += 1
+        self.books[key] = book
+        return book
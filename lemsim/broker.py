@@ -13,15 +13,17 @@ class ProsumerBroker:
         self.prosumer = prosumer
         self.r = r
 
-    def market_bid(self, bid_type = 'long'):
+    def market_bid(self, bid_type = 'long', bids_ac=None):
         """
-        Calculates the market bid to submit in the market
+        Calculates the market bid to submit in the market. `bids_ac` are
+        the bids of the prosumer, if they were already computed.
         """
         # The prosumer solves the control problem and returns
         # how much he expects to consume and at what price
         t = self.prosumer.time
         id_ = self.prosumer.owner_id
-        bids_ac= self.prosumer.get_bid(bid_type)
+        if bids_ac is None:
+            bids_ac= self.prosumer.get_bid(bid_type)
         current_quantity = 0
         new_bids = []
         for q_, p_, b_ in bids_ac:
@@ -34,10 +36,11 @@ class ProsumerBroker:
 
         return new_bids
 
-    def process_market_result(self, q, p, extra):
+    def process_market_result(self, q, p, extra, act=True):
         """
         Process the market result, adding commitments and special prices
-        to the prosumer
+        to the prosumer. If `act` is False, the prosumer is not moved
+        forward and its action has to be taken afterwards.
         """
 
         t = self.prosumer.time
@@ -46,5 +49,6 @@ class ProsumerBroker:
             #self.prosumer.add_special_price(t, q, p)
             self.prosumer.add_cost(p)
         ## Maybe there should be something here to update the strategy if needed.
-        self.prosumer.take_action()
-        self.prosumer.move_forward()
+        if act:
+            self.prosumer.take_action()
+            self.prosumer.move_forward()
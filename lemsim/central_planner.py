@@ -1,5 +1,8 @@
 import docplex.mp.model as cpx
 import numpy as np
+import scipy.sparse as sp
+from lemsim.battery_lp import battery_lp, stack_lps
+from lemsim.solvers import LinearProgram, get_backend
 
 
 def solve_all(
@@ -14,8 +17,27 @@ def solve_all(
     e_d,
     d_max,
     d_min,
-    seed = 420
+    seed = 420,
+    formulation = 'cumulative',
+    backend = None
 ):
+    """
+    Jointly optimizes the batteries of all the prosumers to minimize the
+    absolute value of the aggregated net load.
+
+    `formulation` selects how the state of charge bounds are written,
+    `cumulative` or `state`, as in `lemsim.lp_with_reg.solve_bat`.
+
+    `backend` selects the solver (see `lemsim.solvers.get_backend`). With
+    `cplex` the model is built with docplex and returned, with the
+    other backends it is built as matrices and no model is returned.
+    """
+
+    assert formulation in ['cumulative', 'state']
+    backend = get_backend(backend, seed)
+    if backend.name != 'cplex':
+        return _solve_all_lp(demands, prices_buy, prices_sell, max_costs, B_0,
+                             B_max, B_min, e_c, e_d, d_max, d_min, formulation, backend)
 
     opt_model = cpx.Model(name="Battery")
     opt_model.parameters.randomseed.set(seed)
@@ -74,23 +96,36 @@ def solve_all(
             for i in set_I
         }
 
-        {
-            i: opt_model.add_constraint(
-                ct=opt_model.sum(x_c[j] - x_d[j] for j in range(0, i + 1))
-                >= sum_lower_bound,
-                ctname="constraintsumgt{0}_{1}".format(i, n),
-            )
-            for i in set_I
-        }
+        if formulation == 'cumulative':
+            {
+                i: opt_model.add_constraint(
+                    ct=opt_model.sum(x_c[j] - x_d[j] for j in range(0, i + 1))
+                    >= sum_lower_bound,
+                    ctname="constraintsumgt{0}_{1}".format(i, n),
+                )
+                for i in set_I
+            }
 
-        {
-            i: opt_model.add_constraint(
-                ct=opt_model.sum(x_c[j] - x_d[j] for j in range(0, i + 1))
-                <= sum_upper_bound,
-                ctname="constraintsumgt{0}_{1}".format(i, n),
-            )
-            for i in set_I
-        }
+            {
+                i: opt_model.add_constraint(
+                    ct=opt_model.sum(x_c[j] - x_d[j] for j in range(0, i + 1))
+                    <= sum_upper_bound,
+                    ctname="constraintsumgt{0}_{1}".format(i, n),
+                )
+                for i in set_I
+            }
+        else:
+            soc = {
+                i: opt_model.continuous_var(lb=B_min, ub=B_max, name="soc{0}_{1}".format(i, n))
+                for i in set_I
+            }
+            {
+                i: opt_model.add_constraint(
+                    ct=soc[i] == (soc[i - 1] if i > 0 else B_0) + x_c[i] - x_d[i],
+                    ctname="constraintsoc{0}_{1}".format(i, n),
+                )
+                for i in set_I
+            }
 
         if max_costs[n] is not None:
             opt_model.add_constraint(
@@ -142,3 +177,88 @@ def solve_all(
         raise ValueError
 
     return status, value, sol_n, opt_model
+
+
+def _solve_all_lp(
+    demands,
+    prices_buy,
+    prices_sell,
+    max_costs,
+    B_0,
+    B_max,
+    B_min,
+    e_c,
+    e_d,
+    d_max,
+    d_min,
+    formulation,
+    backend
+):
+    """
+    Same problem as `solve_all`, built from the matrices of
+    `lemsim.battery_lp.battery_lp` and solved with `backend`
+    """
+    T = len(demands[0])
+    N = len(demands)
+
+    lps = []
+    max_ts = 0
+    min_ts = 0
+    for n in range(N):
+        lp = battery_lp(demands[n], prices_buy[n], prices_sell[n], B_0, B_max,
+                        B_min, e_c, e_d, d_max, d_min, formulation=formulation)
+        max_t = (demands[n].max() + d_max) * prices_buy[n].max() / e_c
+        max_ts += max_t
+        min_t = (demands[n].min() + d_min) * prices_sell[n].max() / e_d
+        min_ts += min_t
+        lp.lb[2 * T: 3 * T] = min_t
+        lp.ub[2 * T: 3 * T] = max_t
+        lps.append(lp)
+    lp = stack_lps(lps)
+    sizes = [l.c.shape[0] for l in lps]
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    n_bat = lp.c.shape[0]
+
+    # The total cost of each prosumer is bounded by its maximum cost
+    rows, cols = [], []
+    for k, n in enumerate([n for n in range(N) if max_costs[n] is not None]):
+        rows.append(np.repeat(k, T))
+        cols.append(starts[n] + 2 * T + np.arange(T))
+    m = len(rows)
+    A_cost = sp.coo_matrix(
+        (np.ones(m * T), (np.concatenate(rows or [[]]), np.concatenate(cols or [[]]))),
+        shape=(m, n_bat + 2 * T),
+    )
+    b_cost = np.array([max_costs[n] for n in range(N) if max_costs[n] is not None], dtype=float)
+
+    # sum_n x_c / e_c - x_d * e_d - tcp + tcn = - sum_n z
+    idx = np.arange(T)
+    rows = [idx, idx]
+    cols = [n_bat + idx, n_bat + T + idx]
+    data = [-np.ones(T), np.ones(T)]
+    for n in range(N):
+        rows.extend([idx, idx])
+        cols.extend([starts[n] + idx, starts[n] + T + idx])
+        data.extend([np.repeat(1 / e_c, T), np.repeat(-e_d, T)])
+    A_tc = sp.coo_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(T, n_bat + 2 * T),
+    )
+    b_tc = -np.sum(demands, axis=0)
+
+    full = LinearProgram(
+        np.concatenate([np.zeros(n_bat), np.ones(2 * T)]),
+        sp.vstack([sp.hstack([lp.A_ub, sp.csr_matrix((lp.A_ub.shape[0], 2 * T))]), A_cost], format="csr"),
+        np.concatenate([lp.b_ub, b_cost]),
+        sp.vstack([sp.hstack([lp.A_eq, sp.csr_matrix((lp.A_eq.shape[0], 2 * T))]), A_tc], format="csr"),
+        np.concatenate([lp.b_eq, b_tc]),
+        np.concatenate([lp.lb, np.zeros(2 * T)]),
+        np.concatenate([lp.ub, np.repeat(max_ts, T), np.repeat(-min_ts, T)]),
+    )
+    status, value, x, _ = backend.solve_lp(full)
+    if x is None:
+        print("Solver error", status)
+        raise ValueError
+
+    sol_n = [x[s: s + T] / e_c - x[s + T: s + 2 * T] * e_d for s in starts]
+    return status, value, sol_n, None
@@ -3,8 +3,11 @@ import numpy as np
 import dill
 import pickle
 from copy import deepcopy
-from lemsim.utils import create_bid
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from lemsim.prosumer import ActionPool, get_bids, map_bids, take_actions
 from lemsim.wdp import WinnerDeterminationProblem
+from lemsim.bid_book import build_bid_book
 from lemsim.mechanism_variants import simple_split_mechanism, vcg_mechanism
 
 class MainSim:
@@ -21,8 +24,69 @@ class MainSim:
                  market_type='muda',
                  nickname=None,
                  sun_times=(15, 30),
-                 seed=420
+                 seed=420,
+                 batch=False,
+                 backend=None,
+                 workers=None,
+                 partitions=1,
+                 decompose=False,
+                 pricing='alphabeta',
+                 presolve=False,
+                 cache=None,
+                 bid_books=None,
+                 bid_workers=None,
+                 action_workers=None,
+                 curve=None,
+                 foresight=None
                 ):
+        """
+        If `batch` is True, the control problems of all the prosumers
+        in a timeslot with the `lp` engine are solved together as a single
+        LP for each backend.
+
+        `backend` selects the solver of the market and, if given, of the
+        prosumers (see `lemsim.solvers.get_backend`).
+
+        `workers` is the number of processes used to solve the problems
+        of the market in parallel, None solves them in this process.
+
+        `partitions` is the number of random splits averaged by the
+        `combflex_split` market.
+
+        If `decompose` is True the `combflex` market solves the groups of
+        bids that do not share any timeslot as separate problems.
+
+        `pricing` is the pricing rule of the combinatorial markets,
+        `alphabeta` or `duals` (see `lemsim.wdp.WinnerDeterminationProblem`).
+        If `presolve` is True their WDPs remove the offers that cannot
+        trade before solving.
+
+        `cache` is a `lemsim.wdp_cache.SolutionCache` shared by the
+        `combflex` markets of several simulations, so that the bid books
+        that are cleared again, e.g. with other `alpha` and `beta`, are
+        not solved again.
+
+        `bid_books` is a `lemsim.bid_book.BidBookStore` shared by the
+        combinatorial markets of several simulations, so that the bids of
+        the same prosumers are only built once.
+
+        `bid_workers` is the number of processes that compute the bids of
+        the prosumers in every round of trading (see
+        `lemsim.prosumer.map_bids`), None computes them in this process.
+        The bids are the same and in the same order. The processes are
+        kept between the days until `close` is called. It has no effect
+        with `batch`.
+
+        `action_workers` is the number of processes that take the actions
+        of the prosumers after the pre-trade (see
+        `lemsim.prosumer.ActionPool`). They are kept between the days
+        until `close` is called. It has no effect with `batch`.
+
+        `curve` selects, if given, how the prosumers compute their `long`
+        bids (see `lemsim.prosumer.bid_curve`), and `foresight` how they
+        compute their profile with only the battery (see
+        `lemsim.prosumer.Prosumer.full_foresight`).
+        """
 
 
         #assert bid_type == 'short' or bid_type == 'long' or bid_type == 'flexible'
@@ -41,11 +105,51 @@ class MainSim:
         self.sun_times = sun_times
         self.nickname=nickname
         self.seed = seed
+        self.batch = batch
+        self.backend = backend
+        self.workers = workers
+        self.partitions = partitions
+        self.decompose = decompose
+        self.pricing = pricing
+        self.presolve = presolve
+        self.cache = cache
+        self.bid_books = bid_books
+        self.bid_workers = bid_workers
+        self.bid_pool = None
+        self.action_workers = action_workers
+        self.action_pool = None
+        if backend is not None:
+            for b in self.brokers:
+                b.prosumer.backend = backend
+        if curve is not None:
+            for b in self.brokers:
+                b.prosumer.curve = curve
+        if foresight is not None:
+            for b in self.brokers:
+                b.prosumer.foresight = foresight
 
 
         self.days = 0
         self.results = []
 
+    def __getstate__(self):
+        # The processes of the bids stay with this simulation
+        state = self.__dict__.copy()
+        state['bid_pool'] = None
+        state['action_pool'] = None
+        return state
+
+    def close(self):
+        """
+        Stops the processes of the bids and the actions of the prosumers
+        """
+        if self.bid_pool is not None:
+            self.bid_pool.shutdown()
+            self.bid_pool = None
+        if self.action_pool is not None:
+            self.action_pool.close()
+            self.action_pool = None
+
     def one_market_round(self, param):
         """
         Implements one round of trading among all brokers
@@ -56,9 +160,20 @@ class MainSim:
 
         # Creates a new instance of the market
         mi = lmar.MarketInterface(r=r)
-        for b in self.brokers:
-            bid = b.market_bid(bt)
+        if self.batch:
+            bids_ac = get_bids([b.prosumer for b in self.brokers], bt)
+        elif self.bid_workers is not None and self.bid_workers > 1:
+            if self.bid_pool is None:
+                self.bid_pool = ProcessPoolExecutor(max_workers=self.bid_workers)
+            chunksize = max(1, len(self.brokers) // (4 * self.bid_workers))
+            bids_ac = map_bids(self.bid_pool, [b.prosumer for b in self.brokers], bt, chunksize)
+        else:
+            bids_ac = [None] * len(self.brokers)
+        for b, b_ac in zip(self.brokers, bids_ac):
+            bid = b.market_bid(bt, b_ac)
             call= b.process_market_result
+            if self.batch:
+                call = partial(call, act=False)
             if len(bid) > 0:
                 for block in bid:
                     mi.accept_bid(block, call)
@@ -68,6 +183,11 @@ class MainSim:
         #print('this is the param', param)
         #print(mi.bm.get_df())
         mi.clear(param, r=r)
+        if self.batch:
+            prosumers = [b.prosumer for b in self.brokers]
+            take_actions(prosumers)
+            for p in prosumers:
+                p.move_forward()
         return mi
 
     def update_with_market_existance(self, per=0.1):
@@ -148,69 +268,48 @@ class MainSim:
 
     def sim_comb_trade(self, alpha=0, beta=1):
         r = self.r
-        bt = self.bid_type
         T = self.brokers[0].prosumer.T
         markup = True if self.signaling == 'ismarket' else False
-        pro_dict = dict()
-        bid_list = []
-        for b_ in self.brokers:
-            p = b_.prosumer
-            load = p.register[0]['load']
-            price_buy = p.register[0]['price_buy'].copy()
-            price_sell = p.register[0]['price_sell'].copy()
-            if markup:
-                price_buy[15: 30] *= 0.9
-                price_sell[15: 30] *= 1.1
-                for t in range(T):
-                    if price_buy[t] < price_sell[t]:
-                        m = price_buy[t] + price_sell[t]
-                        price_buy[t] = m * 0.5
-                        price_sell[t] = m * 0.5
-            pbat = p.get_profile_only_battery(0, pb=price_buy, ps=price_sell)
-
-            bat = pbat - load
-            bd, status  = create_bid(p.owner_id,
-                                     load,
-                                     bat,
-                                     price_buy,
-                                     price_sell,
-                                     p.d_max,
-                                     -p.d_min)
-            if status is True:
-                bid_list.append(bd)
-                pro_dict[p.owner_id] = p
+        prosumers = [b_.prosumer for b_ in self.brokers]
+        if self.bid_books is None:
+            book = build_bid_book(prosumers, markup)
+        else:
+            book = self.bid_books.get(prosumers, markup)
+        bid_list = book.bids
+        uids = set(book.uids)
+        pro_dict = {p.owner_id: p for p in prosumers if p.owner_id in uids}
 
         if self.market_type == 'combflex':
             #print('entre normal')
-            prob = WinnerDeterminationProblem(T, alpha, beta, seed=self.seed)
-            [prob.add_bid(b_) for b_ in bid_list]
+            prob = WinnerDeterminationProblem(T, alpha, beta, seed=self.seed, backend=self.backend,
+                                              decompose=self.decompose, workers=self.workers,
+                                              pricing=self.pricing, presolve=self.presolve,
+                                              cache=self.cache)
+            prob.add_book(book)
             prob.build_problem()
-            _, _, _, (vb, vs, _), costs = prob.solve()         
+            _, _, _, _, costs = prob.solve()
+            result = prob.result
         elif self.market_type == 'combflex_split':
             #print('entre split')
             #print(alpha, beta)
-            prob, vb, vs, costs = simple_split_mechanism(bid_list, r, alpha, beta, seed=self.seed, T=T)     
+            prob, result, costs = simple_split_mechanism(book, r, alpha, beta, seed=self.seed, T=T, backend=self.backend,
+                                                         partitions=self.partitions, workers=self.workers,
+                                                         pricing=self.pricing, presolve=self.presolve)
         elif self.market_type == 'combflex_vcg':
             #print('Entré vcg')
-            prob, vb, vs, costs = vcg_mechanism(bid_list, r, alpha, beta, seed=self.seed, T=T)
+            prob, result, costs = vcg_mechanism(book, r, alpha, beta, seed=self.seed, T=T, backend=self.backend,
+                                                workers=self.workers, pricing=self.pricing,
+                                                presolve=self.presolve)
         
         for k, v in costs.items():
             pro_dict[int(k)].add_cost(v)
         
-        #for k, v in vb.items():
-        #    for i in range(T):
-        #        pro_dict[int(k)].add_commitment(i, v[i])
-        for k in vb:
-            if k in vs:
-                vb[k] -= vs[k]
-        for k in vs:
-            if k not in vb:
-                vb[k] = -vs[k]
-        
-        for k, v in vb.items():
-            for i in range(T):
-                pro_dict[int(k)].add_commitment(i, v[i])
-        
+        net = result.net
+        for k, v in zip(result.uids, net):
+            pro_dict[int(k)].add_commitments(v)
+
+        vb = dict(zip(result.uids, net))
+        vs = dict(zip(result.uids, result.sell))
         
         return (bid_list, prob, costs, vb, vs)
         
@@ -231,16 +330,35 @@ class MainSim:
         else:
             results = []
 
+        pool = None
+        prosumers = [b.prosumer for b in self.brokers]
+        if self.pre_trade == 'yes' and not self.batch and self.action_workers is not None and self.action_workers > 1:
+            # A pool that was shut down by an error is started again
+            if self.action_pool is None or not self.action_pool.processes:
+                self.action_pool = ActionPool(self.action_workers)
+            pool = self.action_pool
+            pool.load(prosumers)
+
         for t in range(T):
             #print(t)
             if self.pre_trade == 'none':
                 res = self.one_market_round(self.market_type)
                 results.append(res)
+            elif self.batch:
+                take_actions(prosumers)
+                for p in prosumers:
+                    p.move_forward()
+            elif pool is not None:
+                pool.step()
+                for p in prosumers:
+                    p.move_forward()
             else:
                 for i, b in enumerate(self.brokers):
                     p = b.prosumer
                     p.take_action()
                     p.move_forward()
+        if pool is not None:
+            pool.collect()
 
         for b in self.brokers:
             b.prosumer.finish_day()
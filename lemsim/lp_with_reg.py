@@ -6,6 +6,8 @@ import pandas as pd
 import numpy as np
 import docplex.mp.model as cpx
 from cplex.exceptions import CplexSolverError
+from lemsim.solvers import get_backend
+from lemsim.battery_lp import battery_lp, solve_battery_lps
 
 def solve_bat(
     demand,
@@ -21,11 +23,40 @@ def solve_bat(
     commitments={},
     reg=False,
     eps=1e-3,
-    seed=420
+    seed=420,
+    formulation='cumulative',
+    backend=None
 ):
+    """
+    Solves the optimal control of a battery with a piecewise-linear
+    cost for buying and selling energy.
 
-#    print(price_buy, price_sell)
+    `formulation` selects how the state of charge bounds are written:
+    `cumulative` bounds the sum of all the previous actions in each
+    timeslot (O(T^2) nonzeros) and `state` adds a state of charge
+    variable per timeslot linked by the battery dynamics (O(T) nonzeros).
+
+    `backend` selects the solver (see `lemsim.solvers.get_backend`). With
+    `cplex` the model is built with docplex and returned, with the
+    other backends it is built as matrices and no model is returned.
+    The regularization `reg` is only written with docplex, so it uses
+    `cplex` when no backend is given.
+    """
+
+    assert formulation in ['cumulative', 'state']
     assert (price_buy >= price_sell).all()
+    if reg and backend is None:
+        backend = 'cplex'
+    backend = get_backend(backend, seed)
+    if backend.name != 'cplex':
+        if reg:
+            raise ValueError("Regularization needs the cplex backend, not {0}".format(backend.name))
+        lp = battery_lp(demand, price_buy, price_sell, B_0, B_max, B_min,
+                        e_c, e_d, d_max, d_min, commitments, eps, formulation)
+        (status, value, sol, _), = solve_battery_lps([lp], backend)
+        return status, value, sol, None
+
+#    print(price_buy, price_sell)
     #commitment = None
     #print(commitment)
     opt_model = cpx.Model(name="Battery")
@@ -60,19 +91,28 @@ def solve_bat(
         for i in set_I
     }
 
-    cons_sum_gt = {i : 
-        opt_model.add_constraint(
-        ct=opt_model.sum(x_c[j] - x_d[j] for j in range(0, i + 1)) >= sum_lower_bound,
-        ctname="constraintsumgt{0}".format(i))
-        for i in set_I
-    }
+    if formulation == 'cumulative':
+        cons_sum_gt = {i : 
+            opt_model.add_constraint(
+            ct=opt_model.sum(x_c[j] - x_d[j] for j in range(0, i + 1)) >= sum_lower_bound,
+            ctname="constraintsumgt{0}".format(i))
+            for i in set_I
+        }
 
-    cons_sum_lt = {i : 
-        opt_model.add_constraint(
-        ct=opt_model.sum(x_c[j] - x_d[j] for j in range(0, i + 1)) <= sum_upper_bound,
-        ctname="constraintsumgt{0}".format(i))
-        for i in set_I
-    }
+        cons_sum_lt = {i : 
+            opt_model.add_constraint(
+            ct=opt_model.sum(x_c[j] - x_d[j] for j in range(0, i + 1)) <= sum_upper_bound,
+            ctname="constraintsumgt{0}".format(i))
+            for i in set_I
+        }
+    else:
+        soc = {i: opt_model.continuous_var(lb=B_min, ub=B_max, name="soc{0}".format(i)) for i in set_I}
+        cons_soc = {i :
+            opt_model.add_constraint(
+            ct=soc[i] == (soc[i - 1] if i > 0 else B_0) + x_c[i] - x_d[i],
+            ctname="constraintsoc{0}".format(i))
+            for i in set_I
+        }
 
     #i = 0
     #print('-' * 50)
@@ -94,7 +134,7 @@ def solve_bat(
 
     objective = opt_model.sum(t_s[i] for i in set_I)
     if reg:
-        reg_c = opt_model.sumsq(reg_coef[i] / x_c[i] for i in set_I)
+        reg_c = opt_model.sumsq(reg_coef[i] * x_c[i] for i in set_I)
         reg_d = opt_model.sumsq(reg_coef[i] * x_d[i] for i in set_I)
         objective = opt_model.sum([objective, reg_c, reg_d])
     opt_model.minimize(objective)
@@ -119,6 +159,201 @@ def solve_bat(
     return status, value, sol, opt_model
     #return opt_model, x_c, x_d, t_s
 
+class PersistentBatteryModel:
+    """
+    Battery control problem of `solve_bat` kept alive between solves.
+
+    The model is built once for a horizon of T timeslots and every call
+    to `solve` only updates, in place, the bounds, right hand sides and
+    coefficients that changed since the previous call. When the horizon
+    is shorter than T, the first timeslots are considered already executed:
+    their variables are fixed to zero and their constraints relaxed.
+    CPLEX re-optimizes starting from the basis of the previous solve.
+    """
+
+    def __init__(self, seed=420):
+        self.seed = seed
+        self.T = 0
+        self.params = None
+        self._cpx = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cpx'] = None
+        state['T'] = 0
+        state['params'] = None
+        return state
+
+    def build(self, T, B_max, B_min, e_c, e_d, d_max, d_min):
+        """
+        Creates the variables and constraints for T timeslots. All the data
+        dependent values are left to be filled by `update`.
+        """
+        cpx = cplex.Cplex()
+        cpx.set_log_stream(None)
+        cpx.set_results_stream(None)
+        cpx.set_warning_stream(None)
+        cpx.parameters.randomseed.set(self.seed)
+        cpx.objective.set_sense(cpx.objective.sense.minimize)
+
+        set_I = range(T)
+        self.xc = list(set_I)
+        self.xd = [T + i for i in set_I]
+        self.ts = [2 * T + i for i in set_I]
+        cpx.variables.add(
+            obj=[0] * 2 * T + [1] * T,
+            lb=[0] * 3 * T,
+            ub=[0] * 3 * T,
+        )
+
+        # Rows: buying cost, selling cost, cumulative lower and upper bound,
+        # commitment lower and upper bound.
+        net = [cplex.SparsePair([self.xc[i], self.xd[i]], [1 / e_c, -e_d]) for i in set_I]
+        cost = [cplex.SparsePair([self.xc[i], self.xd[i], self.ts[i]], [0, 0, -1]) for i in set_I]
+        cumsum = [
+            cplex.SparsePair(self.xc[: i + 1] + self.xd[: i + 1], [1] * (i + 1) + [-1] * (i + 1))
+            for i in set_I
+        ]
+        self.net_lo = d_min * e_d - 1
+        self.net_hi = d_max / e_c + 1
+        cpx.linear_constraints.add(
+            lin_expr=cost + cost + cumsum + cumsum + net + net,
+            senses='L' * T + 'L' * T + 'G' * T + 'L' * T + 'G' * T + 'L' * T,
+            rhs=[0] * 4 * T + [self.net_lo] * T + [self.net_hi] * T,
+        )
+        self.rows = {k: [j * T + i for i in set_I]
+                     for j, k in enumerate(['pb', 'ps', 'sum_lo', 'sum_hi', 'com_lo', 'com_hi'])}
+
+        self._cpx = cpx
+        self.T = T
+        self.params = (B_max, B_min, e_c, e_d, d_max, d_min)
+        self.coefs = {'pb': np.zeros(T), 'ps': np.zeros(T)}
+        self.rhs = np.zeros(6 * T)
+        self.rhs[4 * T: 5 * T] = self.net_lo
+        self.rhs[5 * T:] = self.net_hi
+        self.lb = np.zeros(3 * T)
+        self.ub = np.zeros(3 * T)
+
+    def update(self, demand, price_buy, price_sell, B_0, commitments={}, eps=1e-3):
+        """
+        Updates the model in place to represent the last `len(demand)` timeslots
+        """
+        B_max, B_min, e_c, e_d, d_max, d_min = self.params
+        T = self.T
+        o = T - len(demand)
+
+        z = np.zeros(T)
+        z[o:] = demand
+        pb = np.zeros(T)
+        pb[o:] = price_buy
+        ps = np.zeros(T)
+        ps[o:] = price_sell
+        max_t = (demand.max() + d_max) * price_buy.max() * 1.5 / e_c
+        min_t = (demand.min() + d_min) * price_sell.max() * 1.5 / e_d
+        sum_lower_bound = B_min - B_0
+        sum_upper_bound = B_max - B_0
+
+        lb = np.zeros(3 * T)
+        ub = np.zeros(3 * T)
+        ub[self.xc[o:]] = d_max
+        ub[self.xd[o:]] = -d_min
+        lb[self.ts[o:]] = min_t
+        ub[self.ts[o:]] = max_t
+
+        rhs = np.zeros(6 * T)
+        rhs[: T] = -pb * z
+        rhs[T: 2 * T] = -ps * z
+        rhs[2 * T: 3 * T] = sum_lower_bound
+        rhs[3 * T: 4 * T] = sum_upper_bound
+        rhs[2 * T: 2 * T + o] = min(sum_lower_bound, 0)
+        rhs[3 * T: 3 * T + o] = max(sum_upper_bound, 0)
+        com_lo = np.repeat(self.net_lo, T)
+        com_hi = np.repeat(self.net_hi, T)
+        for k, v in commitments.items():
+            if v is not None and k < T - o:
+                if v > 0:
+                    com_lo[o + k] = max((v - eps), 0) - z[o + k]
+                else:
+                    com_hi[o + k] = min(0, v + eps) - z[o + k]
+        rhs[4 * T: 5 * T] = com_lo
+        rhs[5 * T:] = com_hi
+
+        cpx = self._cpx
+        coefs = []
+        for k, p in [('pb', pb), ('ps', ps)]:
+            changed = np.flatnonzero(self.coefs[k] != p)
+            changed = changed[changed >= o]
+            for i in changed:
+                row = self.rows[k][i]
+                coefs.append((row, self.xc[i], p[i] / e_c))
+                coefs.append((row, self.xd[i], -p[i] * e_d))
+            self.coefs[k][changed] = p[changed]
+        if coefs:
+            cpx.linear_constraints.set_coefficients(coefs)
+
+        changed = np.flatnonzero(self.rhs != rhs)
+        if changed.shape[0] > 0:
+            cpx.linear_constraints.set_rhs([(int(i), rhs[i]) for i in changed])
+        changed = np.flatnonzero(self.lb != lb)
+        if changed.shape[0] > 0:
+            cpx.variables.set_lower_bounds([(int(i), lb[i]) for i in changed])
+        changed = np.flatnonzero(self.ub != ub)
+        if changed.shape[0] > 0:
+            cpx.variables.set_upper_bounds([(int(i), ub[i]) for i in changed])
+        self.rhs = rhs
+        self.lb = lb
+        self.ub = ub
+        return o
+
+    def solve(
+        self,
+        demand,
+        price_buy,
+        price_sell,
+        B_0,
+        B_max,
+        B_min,
+        e_c,
+        e_d,
+        d_max,
+        d_min,
+        commitments={},
+        reg=False,
+        eps=1e-3,
+        seed=420
+    ):
+        """
+        Same interface as `solve_bat`. The model is (re)built only
+        if the horizon is longer than the current one or the
+        battery parameters changed.
+        """
+        if reg:
+            raise ValueError("Regularization is not available in the persistent model")
+        assert (price_buy >= price_sell).all()
+        params = (B_max, B_min, e_c, e_d, d_max, d_min)
+        if self._cpx is None or len(demand) > self.T or params != self.params:
+            self.seed = seed
+            self.build(len(demand), *params)
+
+        o = self.update(demand, price_buy, price_sell, B_0, commitments, eps)
+        cpx = self._cpx
+        try:
+            cpx.solve()
+            status = cpx.solution.get_status_string()
+            x = np.array(cpx.solution.get_values())
+            sol = x[self.xc[o:]] - x[self.xd[o:]]
+            value = cpx.solution.get_objective_value()
+        except CplexSolverError:
+            status = 'error'
+        if status != 'optimal':
+            print('Cplex error', status)
+            print(price_buy, price_sell)
+            print(demand, B_0, commitments)
+            raise ValueError
+
+        return status, value, sol, self
+
+
 if __name__ == '__main__':
     import scipy.io as sio
     from glob import glob
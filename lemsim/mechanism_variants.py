@@ -7,106 +7,177 @@ import time
 import lemsim.broker as lbro
 from itertools import product
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from lemsim.bid_book import BidBook
 from lemsim.utils import create_bid
-from lemsim.wdp import WinnerDeterminationProblem
+from lemsim.wdp import WinnerDeterminationProblem, WDPResult
 
 
-def simple_split_mechanism(bids, r=None, alpha=0, beta=1, seed=420, T=48):
-    
-    EPS = 1e-4
+def add_bids(wdp, bids):
+    """
+    Adds a list of bids or a BidBook to the WDP
+    """
+    if isinstance(bids, BidBook):
+        wdp.add_book(bids)
+    else:
+        [wdp.add_bid(bd) for bd in bids]
+
+
+def simple_split_mechanism(bids, r=None, alpha=0, beta=1, seed=420, T=48, backend=None,
+                           partitions=1, workers=None, pricing='alphabeta', presolve=False):
+    """
+    Splits the bidders at random in two sides, and each side trades at
+    the prices of the other one. `bids` is a list of bids or a BidBook.
+
+    With more than one partition, the allocation and the costs are the
+    average over `partitions` random splits, each one drawn with its own
+    seed from `r`. If `workers` is larger than one the partitions are
+    solved by a pool of that many processes. `pricing` and `presolve`
+    are passed to the WDPs (see `WinnerDeterminationProblem`).
+
+    Returns
+    --------
+    wdp_sides : list of WinnerDeterminationProblem
+        The left and right problems of every partition
+    result : WDPResult
+    costs : dict
+    """
     if r is None:
         r = np.random.RandomState(1)
-        
-    left, right = [], []
-    for b in bids:
-        if r.rand() < 0.5:
-            left.append(b)
-        else:
-            right.append(b)
-    
-    bid_sides = [left, right]
+    if partitions == 1:
+        return split_partition(bids, r, alpha, beta, seed, T, backend, pricing, presolve)
+
+    seeds = r.randint(0, 2 ** 31 - 1, partitions)
+    if workers is not None and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_split_worker,
+                                 initargs=(bids, alpha, beta, seed, T, backend, pricing, presolve)) as pool:
+            outputs = list(pool.map(_split_partition, seeds))
+    else:
+        outputs = [split_partition(bids, np.random.RandomState(s), alpha, beta, seed, T, backend, pricing,
+                                   presolve) for s in seeds]
+
+    wdp_sides = [w for sides, _, _ in outputs for w in sides]
+    result = WDPResult.mean([res for _, res, _ in outputs])
+    costs = defaultdict(float)
+    for _, _, costs_ in outputs:
+        for k, v in costs_.items():
+            costs[k] += v / partitions
+    return wdp_sides, result, costs
+
+
+def split_partition(bids, r, alpha=0, beta=1, seed=420, T=48, backend=None, pricing='alphabeta',
+                    presolve=False):
+    """
+    One random split of `simple_split_mechanism`. The second solve of
+    each side, after removing the offers that do not trade at the prices
+    of the other side, starts from the first one only with
+    `backend='cplex'`, the other backends solve it from scratch (see
+    `WinnerDeterminationProblem.solver_session`).
+    """
+    EPS = 1e-4
+    left = r.rand(len(bids)) < 0.5
+    if isinstance(bids, BidBook):
+        bid_sides = [bids.take(np.flatnonzero(left)), bids.take(np.flatnonzero(~left))]
+    else:
+        bid_sides = [[b for b, l in zip(bids, left) if l], [b for b, l in zip(bids, left) if not l]]
     
-    wdp_left = WinnerDeterminationProblem(T, alpha, beta, seed=seed)
-    wdp_right = WinnerDeterminationProblem(T, alpha, beta, seed=seed)  
+    wdp_left = WinnerDeterminationProblem(T, alpha, beta, seed=seed, backend=backend, pricing=pricing,
+                                          presolve=presolve)
+    wdp_right = WinnerDeterminationProblem(T, alpha, beta, seed=seed, backend=backend, pricing=pricing,
+                                           presolve=presolve)
     wdp_sides = [wdp_left, wdp_right]
     
     for (b, w) in zip(bid_sides, wdp_sides):
-        for b_ in b:
-            w.add_bid(b_)
-            
-    models = []
+        add_bids(w, b)
+        w.build_problem()
+
     for w in wdp_sides:
-        m = w.build_problem()
         w.solve()
-        models.append(m)
-        
+
     l_left = wdp_left.get_prices()
     l_right = wdp_right.get_prices()
     prices = [l_right, l_left] # Inverted on purpose
-    
+
     for p, w in zip(prices, wdp_sides):
-        for t in range(T):
-            limit_buy = p[t][0]
-            limit_sell = p[t][1]
-            
-            for var in w.vars_buying[t]:
-                unitcost = w.vars_unitcost[var.name]
-                if np.allclose(limit_buy, -1): #  kill variable
-                    var.upBound = 0
-                elif (limit_buy - unitcost > EPS):
-                    var.upBound = 0
-            for var in w.vars_selling[t]:
-                unitcost = w.vars_unitcost[var.name]
-                if np.allclose(limit_sell, -1): #  kill variable
-                    var.upBound = 0
-                elif (unitcost - limit_sell > EPS):
-                    var.upBound = 0
-     
-    a_l, b_l, c_l, (vb_l, vs_l, pay_l), _ = wdp_left.solve()
-    a_r, b_r, c_r, (vb_r, vs_r, pay_r), _ = wdp_right.solve()
+        w.restrict_to_prices(p, EPS)
+        w.solve()
     
     costs_left = wdp_left.get_costs(*zip(*l_right))
     costs_right = wdp_right.get_costs(*zip(*l_left))
     
-    
-    vb = {**vb_l, **vb_r}
-    vs = {**vs_l, **vs_r}
+    result = WDPResult.concat([wdp_left.result, wdp_right.result])
     costs = {**costs_left, **costs_right}
     
 
-    return wdp_sides, vb, vs, costs
+    return wdp_sides, result, costs
 
 
+_SPLIT_ARGS = None
 
-def vcg_mechanism(bids, r=None, alpha=0, beta=1, seed=420, T=48):
-    
-    EPS = 1e-4
-    if r is None:
-        r = np.random.RandomState(1)
 
-        
-    wdp = WinnerDeterminationProblem(T, alpha, beta, seed=seed)
-    [wdp.add_bid(bd) for bd in bids]
+def _init_split_worker(*args):
+    global _SPLIT_ARGS
+    _SPLIT_ARGS = args
+
+
+def _split_partition(seed_):
+    bids, alpha, beta, seed, T, backend, pricing, presolve = _SPLIT_ARGS
+    return split_partition(bids, np.random.RandomState(seed_), alpha, beta, seed, T, backend, pricing, presolve)
+
+
+
+def vcg_mechanism(bids, r=None, alpha=0, beta=1, seed=420, T=48, backend=None, workers=None,
+                  pricing='alphabeta', presolve=False):
+    """
+    VCG payments of the combinatorial auction. The WDP is built once,
+    the problem without each bidder is solved by fixing its columns at
+    zero (see `WinnerDeterminationProblem.solve_without`). The bidders
+    that trade nothing are not re-solved, their payment is zero. `bids`
+    is a list of bids or a BidBook.
+
+    If `workers` is larger than one, the problems without each bidder
+    are solved by a pool of that many processes, each one receiving
+    the WDP once. `pricing` and `presolve` are passed to the WDP (see
+    `WinnerDeterminationProblem`).
+    """
+    EPS = 1e-4
+    wdp = WinnerDeterminationProblem(T, alpha, beta, seed=seed, backend=backend, pricing=pricing,
+                                     presolve=presolve)
+    add_bids(wdp, bids)
     wdp.build_problem()
-    _, _, _, (vb, vs, _), costs = wdp.solve()
+    _, _, _, _, costs = wdp.solve()
     total_cost = sum(costs.values())
-    
-    #print(total_cost, costs)
-    
+
+    result = wdp.result
+    traded = result.uids[(result.buy + result.sell).sum(axis=1) > EPS]
+
     vcg_payments = defaultdict(float)
-    
     for bd in bids:
-        uid = bd.uid
-        #print(uid)
-        new_bids = [bd_ for bd_ in bids if bd_.uid != uid]
-        wdp_ = WinnerDeterminationProblem(T, alpha, beta, seed=seed)
-        [wdp_.add_bid(bd_2) for bd_2 in new_bids]
-        wdp_.build_problem()
-        _, _, _, (vb_bd, vs_bd, _), costs_bd = wdp_.solve()
-        new_total_cost = sum(costs_bd.values())
-        payment = total_cost - costs[uid] - new_total_cost
-        vcg_payments[uid] = payment
-    
-    return wdp, vb, vs, vcg_payments
-     
-    
+        vcg_payments[bd.uid] = 0.0
+    uids = [bd.uid for bd in bids if str(bd.uid) in traded]
+
+    if workers is not None and workers > 1 and len(uids) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_vcg_worker,
+                                 initargs=(wdp,)) as pool:
+            new_total_costs = list(pool.map(_total_cost_without, uids))
+    else:
+        new_total_costs = [_total_cost_without(uid, wdp) for uid in uids]
+
+    for uid, new_total_cost in zip(uids, new_total_costs):
+        vcg_payments[uid] = total_cost - costs[str(uid)] - new_total_cost
+
+    return wdp, wdp.result, vcg_payments
+
+
+_VCG_WDP = None
+
+
+def _init_vcg_worker(wdp):
+    global _VCG_WDP
+    _VCG_WDP = wdp
+
+
+def _total_cost_without(uid, wdp=None):
+    wdp = _VCG_WDP if wdp is None else wdp
+    _, _, costs = wdp.solve_without(uid)
+    return sum(costs.values())
@@ -1,15 +1,36 @@
 """
 Prosumer class, extendes the battery controler
 """
+import multiprocessing
+import time
+import traceback
 import numpy as np
-from copy import deepcopy
+from copy import copy, deepcopy
 from operator import itemgetter
-from lemsim.batterycontroller import BatteryController
+from lemsim.batterycontroller import BatteryController, find_optimal_steps
+from lemsim.battery_dp import first_step_curve
+
+CURVES = ['resolve', 'parametric']
+FORESIGHT = ['auto', 'full', 'stepwise']
 
 class Prosumer(BatteryController):
 
-    def __init__(self, owner_id, b_max, b_min, eff_c, eff_d, d_max, d_min, price_buy, price_sell, load, seed=420):
-        super().__init__(owner_id, b_max, b_min, eff_c, eff_d, d_max, d_min, seed)
+    def __init__(self, owner_id, b_max, b_min, eff_c, eff_d, d_max, d_min, price_buy, price_sell, load, seed=420, engine='lp', backend=None,
+                 curve='resolve', foresight='auto'):
+        """
+        Params:
+            curve, str: how the `long` bids are computed, see `bid_curve`
+            foresight, str: how the profile with only the battery is
+                computed, `full` solves the whole day once, `stepwise`
+                solves it again from every timeslot, and `auto` chooses
+                (see `full_foresight`)
+            Others as in `BatteryController`
+        """
+        super().__init__(owner_id, b_max, b_min, eff_c, eff_d, d_max, d_min, seed, engine, backend)
+        assert curve in CURVES
+        self.curve = curve
+        assert foresight in FORESIGHT
+        self.foresight = foresight
         self.day = 0
         self.price_buy = price_buy.copy()
         self.price_sell = price_sell.copy()
@@ -34,6 +55,18 @@ class Prosumer(BatteryController):
             'initial_course': {},
         }}
 
+    def full_foresight(self):
+        """
+        True if `get_profile_only_battery` solves the whole day once
+        instead of once per timeslot. With `auto`, only the `dp` engine
+        does it, since it breaks the ties between optimal actions in the
+        same way in both cases. The other engines can return another
+        optimal profile, with the same cost.
+        """
+        if self.foresight == 'auto':
+            return self.engine == 'dp'
+        return self.foresight == 'full'
+
     def get_profile_only_battery(self, day, pb=None, ps=None):
         cons = []
         T_ = self.time
@@ -46,11 +79,19 @@ class Prosumer(BatteryController):
 
         self.time = 0
         self.charge = 0
-        for t in range(len(load)):
-            xs_ = self.find_optimal_step(load[t:], pb[t:], ps[t:], {})
-            xs = xs_[2]
-            self.update_charge(xs[0])
-            cons.append(xs[0] / self.eff_c if xs[0] > 0 else xs[0] * self.eff_d)
+        if self.full_foresight():
+            # Nothing changes between the steps, so the first action of
+            # every step is the action of the whole day in that timeslot
+            xs = self.find_optimal_step(load, pb, ps, {})[2]
+            for x in xs:
+                self.update_charge(x)
+                cons.append(x / self.eff_c if x > 0 else x * self.eff_d)
+        else:
+            for t in range(len(load)):
+                xs_ = self.find_optimal_step(load[t:], pb[t:], ps[t:], {})
+                xs = xs_[2]
+                self.update_charge(xs[0])
+                cons.append(xs[0] / self.eff_c if xs[0] > 0 else xs[0] * self.eff_d)
         profile_only_battery = np.array(cons) + load
         self.update_charge(C_)
         self.time = T_
@@ -159,12 +200,11 @@ class Prosumer(BatteryController):
             
         return price
 
-    def get_bid(self, bid_type='short', EPS=1e-4):
+    def bid_problem(self):
         """
-        Estimate the consumption of the next timeslot
+        Forecasts used to compute the bid of the current timeslot
         Returns:
-            q: quantity wanted to be traded in the market
-            p: price at which it would normall be traded
+            the arguments (load, pb, ps, commitments) of `find_optimal_step`
         """
         t = self.time
         load = self.load[t:].copy().astype(float)
@@ -177,50 +217,19 @@ class Prosumer(BatteryController):
         commitments = {}
         for ii in range(t, N + 1):
             commitments[ii - t] = self.commitments.get(ii, None)
+        return load, pb, ps, commitments
 
-        accumulated_bids = []
-        ## Solves the first battery usage
-        r = self.find_optimal_step(load, pb, ps, commitments) # battery usage
-        x = r[2][0]
-        q = x / self.eff_c if x > 0 else x * self.eff_d # Energy seen from outside the battery
-        q += load[0] #* self.resolution
-        q_0 = q
-        buying = (q > 0) or (q == 0 and load[0] > 0)
-        p = pb[0] if q > 0 else ps[0]
-        if not np.allclose(q, 0):
-            accumulated_bids.append([np.abs(q), p, buying])
-
-        if bid_type == 'long':
-
-            if buying: # Case in which user is buying by default
-                future_prices = set(p_ for p_ in pb if p_ < pb[0])
-                future_prices = sorted([x for x in future_prices], reverse=True)
-            else:
-                pbs = np.hstack([ps, pb])
-                future_prices = set(p_ for p_ in pbs if p_ > ps[0])
-                future_prices = sorted([x for x in future_prices], reverse=False)
-
-            for fp in future_prices[:5]:
-                pb_1 = pb.copy()
-                ps_1 = ps.copy()
-                if buying:
-                    pb_1[0] = fp - EPS # Force solution to be in different range
-                    if pb_1[0] < ps_1[0]:
-                        ps_1[0] = pb_1[0]
-                    r = self.find_optimal_step(load, pb_1, ps_1, commitments) #
-                else:
-                    ps_1[0] = fp + EPS
-                    if ps_1[0] > pb_1[0]:
-                        pb_1[0] = ps_1[0]
-                    r = self.find_optimal_step(load, pb_1, ps_1, commitments) #
-                x = r[2][0] # first battery usage
-                q = x / self.eff_c if x > 0 else x * self.eff_d
-                q += load[0] #* self.resolution
-                if not np.allclose(q, 0) and ((buying and q > 0) or (not buying and q < 0)):
-                    accumulated_bids.append([np.abs(q), fp, buying])
-
-        bids_sorted = sorted(accumulated_bids, key=itemgetter(1, 0, 2), reverse=True)
-        return accumulated_bids
+    def get_bid(self, bid_type='short', EPS=1e-4, first=None):
+        """
+        Estimate the consumption of the next timeslot (see `bid_curve`)
+        Params:
+            first, tuple: result of solving `bid_problem`, if it
+            was already solved
+        Returns:
+            list of [q, p, buying]: quantity wanted to be traded in the
+            market and price at which it would normally be traded
+        """
+        return bid_curve(self, *self.bid_problem(), bid_type=bid_type, EPS=EPS, first=first, curve=self.curve)
 
     
     def add_commitment(self, timeslot, quantity):
@@ -231,16 +240,24 @@ class Prosumer(BatteryController):
         if (self.owner_id == 4):
             pass
 
-    def take_action(self):
+    def add_commitments(self, quantities):
         """
-        Process the market result and takes the appropiate
-        action to move forward
-        Params:
-            traded_quantity, amount of energy that was finally traded
-            in the market
-            traded_price: price at which it was traded.
+        Adds a commitment in every timeslot, `quantities[t]` being the
+        energy committed in timeslot t, as in `add_commitment`
+        """
+        quantities = np.asarray(quantities, dtype=float)
+        empty = np.abs(quantities) <= 1e-5
+        self.commitments.update(
+            (t, None if e else q) for t, (q, e) in enumerate(zip(quantities, empty))
+        )
+
+    def action_problem(self):
+        """
+        Forecasts used to decide the action of the current timeslot, with
+        the actual prices for the current timeslot
+        Returns:
+            the arguments (load, pb, ps, commitments) of `find_optimal_step`
         """
-        #print('entre', self.owner_id)     
         t = self.time
         load = self.load[t:].copy()
         pb = self.expected_price_buy[t:].copy()
@@ -253,8 +270,13 @@ class Prosumer(BatteryController):
         commitments_ = {}
         for ii in range(t, N + 1):
             commitments_[ii - t] = self.commitments.get(ii, None)
-      
-        xs_ = self.find_optimal_step(load, pb, ps, commitments_) # battery usage
+        return load, pb, ps, commitments_
+
+    def apply_action(self, xs_):
+        """
+        Executes the first action of the solution `xs_` of `action_problem`
+        """
+        t = self.time
         self.register[self.day]['initial_course'][t] = xs_
         xs = xs_[2]
         xf = xs[0]
@@ -264,6 +286,317 @@ class Prosumer(BatteryController):
         self.update_charge(xf)
 
         q = xf / self.eff_c if xf > 0 else xf * self.eff_d
-        q += load[0] #* self.resolution
+        q += self.load[t] #* self.resolution
         self.net_demand[t] = q
-       
\ No newline at end of file
+
+    def action_copy(self):
+        """
+        Copy of the prosumer with what `take_action` needs, to send it to
+        other processes. The register only has the initial course of the
+        current day.
+        """
+        p = copy(self)
+        p.register = {self.day: {'initial_course': {}}}
+        return p
+
+    def take_action(self):
+        """
+        Process the market result and takes the appropiate
+        action to move forward
+        Params:
+            traded_quantity, amount of energy that was finally traded
+            in the market
+            traded_price: price at which it was traded.
+        """
+        #print('entre', self.owner_id)     
+        xs_ = self.find_optimal_step(*self.action_problem()) # battery usage
+        self.apply_action(xs_)
+
+
+def take_actions(prosumers):
+    """
+    Takes the action of the current timeslot for all the prosumers,
+    solving their control problems together (see
+    `lemsim.batterycontroller.find_optimal_steps`)
+    """
+    results = find_optimal_steps(prosumers, [p.action_problem() for p in prosumers])
+    for p, xs_ in zip(prosumers, results):
+        p.apply_action(xs_)
+
+
+def get_bids(prosumers, bid_type='short'):
+    """
+    Computes the bids of all the prosumers for the current timeslot, solving
+    their first control problems together (see
+    `lemsim.batterycontroller.find_optimal_steps`). The extra problems
+    solved for `long` bids are still solved one by one.
+    """
+    results = find_optimal_steps(prosumers, [p.bid_problem() for p in prosumers])
+    return [p.get_bid(bid_type, first=r) for p, r in zip(prosumers, results)]
+
+
+def _bid_curve(args):
+    controller, problem, bid_type, curve = args
+    return bid_curve(controller, *problem, bid_type=bid_type, curve=curve)
+
+
+def map_bids(pool, prosumers, bid_type='short', chunksize=1):
+    """
+    Computes the bids of all the prosumers for the current timeslot in
+    the processes of `pool`. Only the battery of each prosumer (see
+    `BatteryController.battery`) and its problem are sent, and the bids
+    come back in the order of `prosumers`, the same as `get_bid`. The
+    prosumers with the `persistent` engine keep their model, so they
+    bid in this process.
+    """
+    remote = [i for i, p in enumerate(prosumers) if p.engine != 'persistent']
+    args = [(prosumers[i].battery(), prosumers[i].bid_problem(), bid_type, prosumers[i].curve) for i in remote]
+    bids = [None] * len(prosumers)
+    for i, bid in zip(remote, pool.map(_bid_curve, args, chunksize=chunksize)):
+        bids[i] = bid
+    for i, p in enumerate(prosumers):
+        if bids[i] is None:
+            bids[i] = p.get_bid(bid_type)
+    return bids
+
+
+def bid_curve(controller, load, pb, ps, commitments, bid_type='short', EPS=1e-4, first=None, curve='resolve'):
+    """
+    Bid of a battery for the first timeslot of the problem `bid_problem`
+    of a prosumer. With `long` bids, the first action is also found for
+    other prices of the first timeslot to add more points of the curve.
+    Params:
+        controller, BatteryController: battery that bids
+        load, pb, ps, commitments: arguments of `find_optimal_step`
+        first, tuple: result of solving the problem, if it was already solved
+        curve, str: `resolve` solves the problem again for every other
+            price, and `parametric` finds all the actions from a single
+            backward pass (see `lemsim.battery_dp.first_step_curve`)
+    Returns:
+        list of [q, p, buying]: quantity wanted to be traded in the
+        market and price at which it would normally be traded
+    """
+    accumulated_bids = []
+    ## Solves the first battery usage
+    r = first if first is not None else controller.find_optimal_step(load, pb, ps, commitments) # battery usage
+    x = r[2][0]
+    q = x / controller.eff_c if x > 0 else x * controller.eff_d # Energy seen from outside the battery
+    q += load[0] #* controller.resolution
+    q_0 = q
+    buying = (q > 0) or (q == 0 and load[0] > 0)
+    p = pb[0] if q > 0 else ps[0]
+    if not np.allclose(q, 0):
+        accumulated_bids.append([np.abs(q), p, buying])
+
+    if bid_type == 'long':
+
+        if buying: # Case in which user is buying by default
+            future_prices = set(p_ for p_ in pb if p_ < pb[0])
+            future_prices = sorted([x for x in future_prices], reverse=True)
+        else:
+            pbs = np.hstack([ps, pb])
+            future_prices = set(p_ for p_ in pbs if p_ > ps[0])
+            future_prices = sorted([x for x in future_prices], reverse=False)
+
+        first_prices = []
+        for fp in future_prices[:5]:
+            pb_0, ps_0 = pb[0], ps[0]
+            if buying:
+                pb_0 = fp - EPS # Force solution to be in different range
+                if pb_0 < ps_0:
+                    ps_0 = pb_0
+            else:
+                ps_0 = fp + EPS
+                if ps_0 > pb_0:
+                    pb_0 = ps_0
+            first_prices.append((pb_0, ps_0))
+
+        if curve == 'parametric':
+            usage = first_step_curve(load, pb, ps, first_prices, controller.charge, controller.b_max,
+                                     controller.b_min, controller.eff_c, controller.eff_d,
+                                     controller.d_max, controller.d_min, commitments)
+        else:
+            usage = []
+            for pb_0, ps_0 in first_prices:
+                pb_1 = pb.copy()
+                ps_1 = ps.copy()
+                pb_1[0], ps_1[0] = pb_0, ps_0
+                r = controller.find_optimal_step(load, pb_1, ps_1, commitments) #
+                usage.append(r[2][0]) # first battery usage
+
+        for fp, x in zip(future_prices, usage):
+            q = x / controller.eff_c if x > 0 else x * controller.eff_d
+            q += load[0] #* controller.resolution
+            if not np.allclose(q, 0) and ((buying and q > 0) or (not buying and q < 0)):
+                accumulated_bids.append([np.abs(q), fp, buying])
+
+    bids_sorted = sorted(accumulated_bids, key=itemgetter(1, 0, 2), reverse=True)
+    return accumulated_bids
+
+
+def _action_worker(conn):
+    """
+    Loop of a process of `ActionPool`, which keeps its prosumers between
+    the commands
+    """
+    prosumers = []
+    while True:
+        command, data = conn.recv()
+        if command == 'load':
+            prosumers = data
+        elif command == 'step':
+            out = []
+            try:
+                for p in prosumers:
+                    t = p.time
+                    p.take_action()
+                    out.append((p.charge, p.net_demand[t]))
+                    p.move_forward()
+            except Exception:
+                # The traceback, since the exception may not be picklable
+                conn.send(('error', (p.owner_id, traceback.format_exc())))
+                break
+            conn.send(('ok', out))
+        elif command == 'collect':
+            conn.send(('ok', [p.register[p.day]['initial_course'] for p in prosumers]))
+        else:
+            break
+    conn.close()
+
+
+class ActionPool:
+    """
+    Processes that take the actions of the prosumers in every timeslot
+    of the execution after the pre-trade. Every prosumer is pinned to one
+    process for the whole day, so it is only sent once (see `load`), and
+    only its charge and net demand come back after each step. The
+    prosumers with the `persistent` engine keep their model and act in
+    this process.
+
+    If the action of a prosumer fails in a process, or a process stops
+    or does not answer within `timeout`, the pool is shut down and a
+    RuntimeError is raised.
+
+    Params:
+        workers, int: number of processes
+        timeout, float: seconds to wait for the answer of a process, or
+            None to wait as long as it is alive
+    """
+
+    def __init__(self, workers, timeout=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.connections = []
+        self.processes = []
+        self.prosumers = []
+        self.local = []
+        self.pinned = []
+        for _ in range(workers):
+            conn, child = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_action_worker, args=(child,), daemon=True)
+            proc.start()
+            child.close()
+            self.connections.append(conn)
+            self.processes.append(proc)
+
+    def load(self, prosumers):
+        """
+        Sends the current state of `prosumers` to the processes, split in
+        consecutive groups
+        """
+        self.prosumers = prosumers
+        remote = [i for i, p in enumerate(prosumers) if p.engine != 'persistent']
+        self.local = [i for i, p in enumerate(prosumers) if p.engine == 'persistent']
+        self.pinned = [list(idx) for idx in np.array_split(remote, self.workers)]
+        for conn, idx in zip(self.connections, self.pinned):
+            conn.send(('load', [prosumers[i].action_copy() for i in idx]))
+
+    def step(self):
+        """
+        Takes the action of the current timeslot of every prosumer, as
+        `Prosumer.take_action`. The prosumers are not moved forward.
+        """
+        self.send('step')
+        try:
+            for i in self.local:
+                self.prosumers[i].take_action()
+        except Exception:
+            self.terminate()
+            raise
+        for k, idx in enumerate(self.pinned):
+            for i, (charge, q) in zip(idx, self.receive(k)):
+                p = self.prosumers[i]
+                p.charge = charge
+                p.net_demand[p.time] = q
+
+    def collect(self):
+        """
+        Copies the initial course of the day of every prosumer back to
+        its register
+        """
+        self.send('collect')
+        for k, idx in enumerate(self.pinned):
+            for i, course in zip(idx, self.receive(k)):
+                p = self.prosumers[i]
+                p.register[p.day]['initial_course'].update(course)
+
+    def send(self, command):
+        """
+        Sends `command` to every process
+        """
+        for k, conn in enumerate(self.connections):
+            try:
+                conn.send((command, None))
+            except OSError:
+                self.terminate()
+                raise RuntimeError("Action process {0} closed its connection".format(k))
+
+    def receive(self, k):
+        """
+        Answer of the process `k`, waiting while it is alive
+        """
+        conn = self.connections[k]
+        proc = self.processes[k]
+        start = time.time()
+        while not conn.poll(0.1):
+            if not proc.is_alive():
+                self.terminate()
+                raise RuntimeError("Action process {0} stopped with exit code {1}".format(k, proc.exitcode))
+            if self.timeout is not None and time.time() - start > self.timeout:
+                self.terminate()
+                raise RuntimeError("Action process {0} did not answer in {1} seconds".format(k, self.timeout))
+        try:
+            status, data = conn.recv()
+        except EOFError:
+            self.terminate()
+            raise RuntimeError("Action process {0} closed its connection".format(k))
+        if status == 'error':
+            owner_id, trace = data
+            self.terminate()
+            raise RuntimeError("Action of prosumer {0} failed:\n{1}".format(owner_id, trace))
+        return data
+
+    def terminate(self):
+        """
+        Stops the processes without waiting for their answers
+        """
+        for conn, proc in zip(self.connections, self.processes):
+            conn.close()
+            proc.terminate()
+            proc.join()
+        self.connections = []
+        self.processes = []
+        self.pinned = []
+        self.local = []
+
+    def close(self):
+        for conn, proc in zip(self.connections, self.processes):
+            try:
+                conn.send(('close', None))
+            except (BrokenPipeError, OSError):
+                pass
+            conn.close()
+            proc.join()
+        self.connections = []
+        self.processes = []
+
@@ -6,11 +6,17 @@ import time
 import matplotlib.pyplot as plt
 from lemsim.simulation_runner import simulation_run, global_metrics
 from lemsim.utils import create_bid
+from lemsim.wdp_cache import SolutionCache
+from lemsim.bid_book import BidBookStore
 
 def run_one_day(day, PARAMS, onoff=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1], nick=''):
     start = time.time()
     sims = []
     rows = []
+    # The combflex runs with the same signaling share their bids, and those
+    # that only differ in alpha and beta also share the solutions
+    cache = SolutionCache()
+    bid_books = BidBookStore()
 
     if onoff[0]:
         param_ = {
@@ -20,7 +26,7 @@ def run_one_day(day, PARAMS, onoff=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1], n
             'market_type': 'combflex'
         }
         sim_ = simulation_run(
-        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, **PARAMS
+        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, cache=cache, bid_books=bid_books, **PARAMS
         )
         sims.append(sim_)
 
@@ -32,7 +38,7 @@ def run_one_day(day, PARAMS, onoff=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1], n
             'market_type': 'combflex_split'
         }
         sim_ = simulation_run(
-        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, **PARAMS
+        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, cache=cache, bid_books=bid_books, **PARAMS
         )
         sims.append(sim_)
 
@@ -44,7 +50,7 @@ def run_one_day(day, PARAMS, onoff=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1], n
             'market_type': 'combflex_vcg'
         }
         sim_ = simulation_run(
-        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, **PARAMS
+        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, cache=cache, bid_books=bid_books, **PARAMS
         )
         sims.append(sim_)
 
@@ -58,7 +64,7 @@ def run_one_day(day, PARAMS, onoff=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1], n
             'combflex_beta': 0.5
         }
         sim_ = simulation_run(
-        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, **PARAMS
+        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, cache=cache, bid_books=bid_books, **PARAMS
         )
         sims.append(sim_)
 
@@ -72,7 +78,7 @@ def run_one_day(day, PARAMS, onoff=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1], n
             'combflex_beta': 0.5
         }
         sim_ = simulation_run(
-        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, **PARAMS
+        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, cache=cache, bid_books=bid_books, **PARAMS
         )
         sims.append(sim_)
 
@@ -86,7 +92,7 @@ def run_one_day(day, PARAMS, onoff=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1], n
             'combflex_beta': 0.5
         }
         sim_ = simulation_run(
-        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, **PARAMS
+        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, cache=cache, bid_books=bid_books, **PARAMS
         )
         sims.append(sim_)    
 
@@ -98,7 +104,7 @@ def run_one_day(day, PARAMS, onoff=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1], n
             'market_type': 'combflex'
         }
         sim_ = simulation_run(
-        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, **PARAMS
+        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, cache=cache, bid_books=bid_books, **PARAMS
         )
         sims.append(sim_)
 
@@ -110,7 +116,7 @@ def run_one_day(day, PARAMS, onoff=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1], n
             'market_type': 'combflex_split'
         }
         sim_ = simulation_run(
-        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, **PARAMS
+        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, cache=cache, bid_books=bid_books, **PARAMS
         )
         sims.append(sim_)
 
@@ -122,7 +128,7 @@ def run_one_day(day, PARAMS, onoff=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1], n
             'market_type': 'combflex_vcg'
         }
         sim_ = simulation_run(
-        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, **PARAMS
+        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, cache=cache, bid_books=bid_books, **PARAMS
         )
         sims.append(sim_)
 
@@ -134,7 +140,7 @@ def run_one_day(day, PARAMS, onoff=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1], n
             'market_type': 'huang'
         }
         sim_ = simulation_run(
-        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, **PARAMS
+        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, cache=cache, bid_books=bid_books, **PARAMS
         )
         sims.append(sim_)    
 
@@ -146,7 +152,7 @@ def run_one_day(day, PARAMS, onoff=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1], n
             'market_type': 'muda'
         }
         sim_ = simulation_run(
-        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, **PARAMS
+        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, cache=cache, bid_books=bid_books, **PARAMS
         )
         sims.append(sim_)
 
@@ -158,7 +164,7 @@ def run_one_day(day, PARAMS, onoff=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1], n
             'market_type': 'muda'
         }
         sim_ = simulation_run(
-        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, **PARAMS
+        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, cache=cache, bid_books=bid_books, **PARAMS
         )
         sims.append(sim_)    
 
@@ -170,7 +176,7 @@ def run_one_day(day, PARAMS, onoff=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1], n
             'market_type': 'p2p'
         }
         sim_ = simulation_run(
-        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, **PARAMS
+        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, cache=cache, bid_books=bid_books, **PARAMS
         )
         sims.append(sim_)    
 
@@ -184,7 +190,7 @@ def run_one_day(day, PARAMS, onoff=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1], n
             'combflex_beta': 0.5
         }
         sim_ = simulation_run(
-        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, **PARAMS
+        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, cache=cache, bid_books=bid_books, **PARAMS
         )
         sims.append(sim_)
 
@@ -198,7 +204,7 @@ def run_one_day(day, PARAMS, onoff=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1], n
             'combflex_beta': 0.5
         }
         sim_ = simulation_run(
-        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, **PARAMS
+        nick + '-'.join(map(str, param_.values())), settings=param_, DATE=day, cache=cache, bid_books=bid_books, **PARAMS
         )
         sims.append(sim_)
 
@@ -19,7 +19,8 @@ def cost_given_prices(load, pb, ps):
     return cost
 
 def simulation_run(nick, settings, N, b_min, b_max, eff_c,
-                   eff_d, d_max, d_min, seed, PRICES_BUY, PRICES_SELL, T, PATHTODATA, DATE, DAYS, savepath):
+                   eff_d, d_max, d_min, seed, PRICES_BUY, PRICES_SELL, T, PATHTODATA, DATE, DAYS, savepath,
+                   cache=None, bid_books=None):
     
     """
     
@@ -31,6 +32,22 @@ def simulation_run(nick, settings, N, b_min, b_max, eff_c,
         `pre_trade`: whether to pre-trade or trade periodicaly ('True', 'False')
         `bid_type`: type of bid to use (`short`, `long`, `flex`)
         `signaling`: type of signaling (`none`, `ismarket`, `clearing price`)
+        `backend`: solver to use (`cplex`, `highs`, `cbc`), optional
+        `workers`: number of processes for the market problems, optional
+        `partitions`: number of random splits of `combflex_split`, optional
+        `decompose`: solve the disjoint groups of bids of `combflex` apart, optional
+        `pricing`: pricing rule of the combinatorial markets (`alphabeta`, `duals`), optional
+        `presolve`: remove the offers that cannot trade before solving the WDPs, optional
+        `curve`: how the `long` bids are computed (`resolve`, `parametric`), optional
+        `foresight`: how the profiles with only the battery are computed (`auto`, `full`, `stepwise`), optional
+        `batch`: solve the control problems of all the prosumers together, optional
+        `bid_workers`: number of processes for the bids of the prosumers, optional
+        `action_workers`: number of processes for the pre-trade actions of the prosumers, optional
+
+    cache: SolutionCache
+        Solutions of the WDPs shared with other runs, optional
+    bid_books: BidBookStore
+        Bids of the combinatorial markets shared with other runs, optional
     
     """
     filename = savepath + nick + DATE
@@ -69,15 +86,28 @@ def simulation_run(nick, settings, N, b_min, b_max, eff_c,
 
     
     sim = lcore.MainSim(brokers, r, settings['bid_type'], settings['pre_trade'],
-                        settings['signaling'], settings['market_type'], nickname=nick, seed=seed)
+                        settings['signaling'], settings['market_type'], nickname=nick, seed=seed,
+                        batch=settings.get('batch', False),
+                        backend=settings.get('backend'), workers=settings.get('workers'),
+                        partitions=settings.get('partitions', 1),
+                        decompose=settings.get('decompose', False),
+                        pricing=settings.get('pricing', 'alphabeta'),
+                        presolve=settings.get('presolve', False), cache=cache,
+                        bid_books=bid_books, curve=settings.get('curve'),
+                        foresight=settings.get('foresight'),
+                        bid_workers=settings.get('bid_workers'),
+                        action_workers=settings.get('action_workers'))
     
     a = settings.get('combflex_alpha', 0)
     b = settings.get('combflex_beta', 1)
-    for D in range(DAYS):
-        sim.simulate_day(alpha=a, beta=b)
-        data = next(DATA)
-        packed = dict((p.owner_id, {'load': data[:, i].copy()}) for i, p in enumerate(prosumers))
-        sim.change_day(packed)
+    try:
+        for D in range(DAYS):
+            sim.simulate_day(alpha=a, beta=b)
+            data = next(DATA)
+            packed = dict((p.owner_id, {'load': data[:, i].copy()}) for i, p in enumerate(prosumers))
+            sim.change_day(packed)
+    finally:
+        sim.close()
 
     
     #print(param1, end - start)
@@ -0,0 +1,454 @@
+"""
+Solver backends for the linear programs of the simulator.
+
+Every backend solves a `LinearProgram` given as sparse matrices, or a
+model built with PuLP, and reports the result as a `SolverResult`, so the
+battery problems and the winner determination problem can be solved with
+CPLEX, HiGHS (through scipy) or CBC (through PuLP) interchangeably.
+"""
+import os
+from collections import namedtuple
+
+import numpy as np
+import pulp as plp
+import scipy.sparse as sp
+
+LinearProgram = namedtuple("LinearProgram", ["c", "A_ub", "b_ub", "A_eq", "b_eq", "lb", "ub"])
+LinearProgram.__doc__ = """
+min c x subject to A_ub x <= b_ub, A_eq x == b_eq and lb <= x <= ub
+"""
+
+SolverResult = namedtuple("SolverResult", ["status", "objective", "x", "duals"], defaults=(None,))
+SolverResult.__doc__ = """
+Result of a solve. `status` is 'optimal' when a solution was found, in
+which case `objective` is its value and `x` the values of the variables.
+Otherwise they are None. `duals` are the dual values of the equality
+constraints, the derivatives of the objective with respect to `b_eq`,
+if the backend gives them.
+"""
+
+DEFAULT_BACKEND = "highs"
+
+
+def pulp_to_lp(problem):
+    """
+    Extracts the matrices of a PuLP model
+
+    Parameters
+    -----------
+    problem : plp.LpProblem
+
+    Returns
+    --------
+    lp : LinearProgram
+        The problem, always as a minimization
+    variables : list of plp.LpVariable
+        The variable associated to each column
+    maximize : bool
+        True if the objective of `problem` is maximized (`lp.c` is
+        then the opposite of the objective)
+    """
+    variables = problem.variables()
+    index = {v.name: j for j, v in enumerate(variables)}
+    n = len(variables)
+    maximize = problem.sense == plp.LpMaximize
+
+    c = np.zeros(n)
+    for v, a in problem.objective.items():
+        c[index[v.name]] = a
+    if maximize:
+        c = -c
+
+    rows = {"ub": ([], [], [], []), "eq": ([], [], [], [])}
+    for cons in problem.constraints.values():
+        kind = "eq" if cons.sense == plp.LpConstraintEQ else "ub"
+        sign = -1 if cons.sense == plp.LpConstraintGE else 1
+        r, cols, data, rhs = rows[kind]
+        m = len(rhs)
+        for v, a in cons.items():
+            r.append(m)
+            cols.append(index[v.name])
+            data.append(sign * a)
+        rhs.append(-sign * cons.constant)
+
+    mats = {}
+    for kind, (r, cols, data, rhs) in rows.items():
+        mats[kind] = (
+            sp.coo_matrix((data, (r, cols)), shape=(len(rhs), n)).tocsr(),
+            np.array(rhs, dtype=float),
+        )
+
+    lb = np.array([-np.inf if v.lowBound is None else v.lowBound for v in variables], dtype=float)
+    ub = np.array([np.inf if v.upBound is None else v.upBound for v in variables], dtype=float)
+    lp = LinearProgram(c, mats["ub"][0], mats["ub"][1], mats["eq"][0], mats["eq"][1], lb, ub)
+    return lp, variables, maximize
+
+
+def lp_to_pulp(lp, name="LP"):
+    """
+    Builds a PuLP model (a minimization) from a LinearProgram
+
+    Returns
+    --------
+    problem : plp.LpProblem
+    variables : list of plp.LpVariable
+    """
+    problem = plp.LpProblem(name=name, sense=plp.LpMinimize)
+    n = lp.c.shape[0]
+    variables = [
+        plp.LpVariable(
+            "x{0}".format(j),
+            lowBound=None if np.isinf(lp.lb[j]) else lp.lb[j],
+            upBound=None if np.isinf(lp.ub[j]) else lp.ub[j],
+        )
+        for j in range(n)
+    ]
+    problem.setObjective(plp.LpAffineExpression([(variables[j], lp.c[j]) for j in range(n)]))
+    rows = [("ub", lp.A_ub, lp.b_ub, plp.LpConstraintLE), ("eq", lp.A_eq, lp.b_eq, plp.LpConstraintEQ)]
+    for prefix, A, b, sense in rows:
+        A = sp.csr_matrix(A)
+        for i in range(A.shape[0]):
+            cols = A.indices[A.indptr[i]: A.indptr[i + 1]]
+            vals = A.data[A.indptr[i]: A.indptr[i + 1]]
+            expr = plp.LpAffineExpression([(variables[j], a) for j, a in zip(cols, vals)])
+            problem += plp.LpConstraint(e=expr, sense=sense, rhs=b[i], name="{0}{1}".format(prefix, i))
+    return problem, variables
+
+
+class SolverBackend:
+    """
+    Base class of the solver backends
+
+    Parameters
+    -----------
+    seed : int
+        Random seed given to the solver, when it accepts one
+    """
+
+    name = None
+    # True if `solve_lp` calls the solver inside this process, without
+    # writing any file
+    in_process = True
+
+    def __init__(self, seed=420):
+        self.seed = seed
+
+    def solve_lp(self, lp):
+        """
+        Solves the minimization problem `lp`
+
+        Returns
+        --------
+        SolverResult
+        """
+        raise NotImplementedError
+
+    def session(self, lp):
+        """
+        Returns an LPSession to solve `lp` several times changing the
+        bounds of its variables
+        """
+        return LPSession(self, lp)
+
+    def solve_pulp(self, problem):
+        """
+        Solves a PuLP model. The values of the solution are also stored
+        in the variables of the model.
+
+        Returns
+        --------
+        SolverResult
+            `x` follows the order of `problem.variables()`
+        """
+        return self.solve_pulp_in_memory(problem)
+
+    def solve_pulp_in_memory(self, problem):
+        """
+        Solves a PuLP model by passing its matrices to `solve_lp`, instead
+        of going through the LP files of the PuLP solvers. Same returns as
+        `solve_pulp`.
+        """
+        lp, variables, maximize = pulp_to_lp(problem)
+        res = self.solve_lp(lp)
+        if res.x is None:
+            return res
+        for v, val in zip(variables, res.x):
+            v.varValue = val
+        problem.status = plp.LpStatusOptimal
+        objective = -res.objective if maximize else res.objective
+        return SolverResult(res.status, objective + problem.objective.constant, res.x, res.duals)
+
+
+class LPSession:
+    """
+    A LinearProgram kept between solves, whose variable bounds can be
+    changed. This implementation solves from scratch every time, the
+    backends that can warm-start override it.
+
+    Parameters
+    -----------
+    backend : SolverBackend
+    lp : LinearProgram
+        The bounds are copied, `lp` is not modified
+    """
+
+    def __init__(self, backend, lp):
+        self.backend = backend
+        self.lp = lp._replace(lb=lp.lb.copy(), ub=lp.ub.copy())
+
+    def set_bounds(self, cols, lb, ub):
+        """
+        Sets the bounds of the variables `cols`. `lb` and `ub` are
+        scalars or arrays of the same length as `cols`.
+        """
+        self.lp.lb[cols] = lb
+        self.lp.ub[cols] = ub
+
+    def append(self, lp):
+        """
+        Replaces the problem by `lp`, which has the same columns and
+        inequality rows followed by new ones, and the same equality rows
+        """
+        self.lp = lp._replace(lb=lp.lb.copy(), ub=lp.ub.copy())
+
+    def solve(self):
+        """
+        Returns
+        --------
+        SolverResult
+        """
+        return self.backend.solve_lp(self.lp)
+
+
+class CplexSession(LPSession):
+    """
+    Keeps the CPLEX model, and every solve starts from the optimal
+    basis of the first one, so the result does not depend on the order
+    of the solves
+    """
+
+    def __init__(self, backend, lp):
+        super().__init__(backend, lp)
+        self.cpx = backend.load(lp)
+        self.basis = None
+        # Rows of the model for the inequality and equality rows of `lp`
+        self.ub_rows = np.arange(lp.A_ub.shape[0])
+        self.eq_rows = lp.A_ub.shape[0] + np.arange(lp.A_eq.shape[0])
+        self.appended = False
+
+    def set_bounds(self, cols, lb, ub):
+        import cplex
+
+        super().set_bounds(cols, lb, ub)
+        cols = np.atleast_1d(cols).tolist()
+        lb = np.maximum(self.lp.lb[cols], -cplex.infinity).tolist()
+        ub = np.minimum(self.lp.ub[cols], cplex.infinity).tolist()
+        if len(cols) > 0:
+            self.cpx.variables.set_lower_bounds(list(zip(cols, lb)))
+            self.cpx.variables.set_upper_bounds(list(zip(cols, ub)))
+
+    def append(self, lp):
+        """
+        Adds the new columns and rows to the model. They extend the
+        starting basis as nonbasic columns and basic rows, which is
+        still primal feasible, so the next solve uses the primal simplex.
+        """
+        import cplex
+
+        n, m = self.lp.c.shape[0], self.ub_rows.shape[0]
+        super().append(lp)
+        lb = np.maximum(lp.lb[n:], -cplex.infinity)
+        ub = np.minimum(lp.ub[n:], cplex.infinity)
+        self.cpx.variables.add(obj=lp.c[n:].tolist(), lb=lb.tolist(), ub=ub.tolist())
+        first = self.cpx.linear_constraints.get_num()
+        self.cpx.linear_constraints.add(senses="L" * (lp.A_ub.shape[0] - m), rhs=lp.b_ub[m:].tolist())
+        self.ub_rows = np.concatenate([self.ub_rows, first + np.arange(lp.A_ub.shape[0] - m)])
+
+        # Coefficients of the new columns, and of the new rows on the old columns
+        A_ub = sp.coo_matrix(lp.A_ub)
+        new = (A_ub.col >= n) | (A_ub.row >= m)
+        A_eq = sp.coo_matrix(lp.A_eq)
+        eq_new = A_eq.col >= n
+        rows = np.concatenate([self.ub_rows[A_ub.row[new]], self.eq_rows[A_eq.row[eq_new]]])
+        cols = np.concatenate([A_ub.col[new], A_eq.col[eq_new]])
+        data = np.concatenate([A_ub.data[new], A_eq.data[eq_new]])
+        if data.shape[0] > 0:
+            self.cpx.linear_constraints.set_coefficients(list(zip(rows.tolist(), cols.tolist(), data.tolist())))
+
+        if self.basis is not None:
+            status = self.cpx.start.status
+            at_lb = np.where(np.isfinite(lp.lb[n:]), status.at_lower_bound,
+                             np.where(np.isfinite(lp.ub[n:]), status.at_upper_bound, status.free_nonbasic))
+            self.basis = (self.basis[0] + at_lb.tolist(),
+                          self.basis[1] + [status.basic] * (lp.A_ub.shape[0] - m))
+        self.appended = True
+
+    def solve(self):
+        if self.basis is not None:
+            self.cpx.start.set_start(self.basis[0], self.basis[1], [], [], [], [])
+        lpmethod = self.cpx.parameters.lpmethod
+        lpmethod.set(lpmethod.values.primal if self.appended else lpmethod.values.auto)
+        self.appended = False
+        result = self.backend.solve_loaded(self.cpx)
+        if self.basis is None and result.status == 'optimal':
+            self.basis = tuple(list(statuses) for statuses in self.cpx.solution.basis.get_basis())
+        return result
+
+
+class CplexBackend(SolverBackend):
+    """
+    CPLEX, through its Python API for matrices and through the
+    command line executable in `CPLEXPATH` for PuLP models
+    """
+
+    name = "cplex"
+
+    def solve_lp(self, lp):
+        return self.solve_loaded(self.load(lp))
+
+    def session(self, lp):
+        return CplexSession(self, lp)
+
+    def load(self, lp):
+        """
+        Creates a CPLEX model of `lp`
+        """
+        import cplex
+
+        cpx = cplex.Cplex()
+        cpx.set_log_stream(None)
+        cpx.set_results_stream(None)
+        cpx.set_warning_stream(None)
+        cpx.parameters.randomseed.set(self.seed)
+        cpx.objective.set_sense(cpx.objective.sense.minimize)
+        lb = np.maximum(lp.lb, -cplex.infinity)
+        ub = np.minimum(lp.ub, cplex.infinity)
+        cpx.variables.add(obj=lp.c.tolist(), lb=lb.tolist(), ub=ub.tolist())
+
+        A = sp.vstack([lp.A_ub, lp.A_eq], format="coo")
+        senses = "L" * lp.A_ub.shape[0] + "E" * lp.A_eq.shape[0]
+        rhs = np.concatenate([lp.b_ub, lp.b_eq]).tolist()
+        cpx.linear_constraints.add(senses=senses, rhs=rhs)
+        if A.nnz > 0:
+            cpx.linear_constraints.set_coefficients(
+                list(zip(A.row.tolist(), A.col.tolist(), A.data.tolist()))
+            )
+        return cpx
+
+    def solve_loaded(self, cpx):
+        """
+        Solves a model created with `load`
+        """
+        from cplex.exceptions import CplexSolverError
+
+        try:
+            cpx.solve()
+            status = cpx.solution.get_status_string()
+            x = np.array(cpx.solution.get_values())
+            objective = cpx.solution.get_objective_value()
+            equality = np.array(cpx.linear_constraints.get_senses(), dtype=str) == "E"
+            duals = np.array(cpx.solution.get_dual_values())[equality]
+        except CplexSolverError:
+            return SolverResult("error", None, None)
+        if status != "optimal":
+            return SolverResult(status, None, None)
+        return SolverResult(status, objective, x, duals)
+
+    def solve_pulp(self, problem):
+        CPLEXPATH = os.environ.get('CPLEXPATH', None)
+        solver = plp.CPLEX_CMD(path=CPLEXPATH, msg=False, options=['set randomseed {0}'.format(self.seed)])
+        return solve_with_pulp(problem, solver)
+
+
+class HighsBackend(SolverBackend):
+    """
+    HiGHS, through `scipy.optimize.linprog`
+    """
+
+    name = "highs"
+
+    STATUS = {0: "optimal", 2: "infeasible", 3: "unbounded"}
+
+    def solve_lp(self, lp):
+        from scipy.optimize import linprog
+
+        has_ub = lp.A_ub.shape[0] > 0
+        has_eq = lp.A_eq.shape[0] > 0
+        res = linprog(
+            lp.c,
+            A_ub=lp.A_ub if has_ub else None,
+            b_ub=lp.b_ub if has_ub else None,
+            A_eq=lp.A_eq if has_eq else None,
+            b_eq=lp.b_eq if has_eq else None,
+            bounds=np.column_stack([lp.lb, lp.ub]),
+            method="highs",
+        )
+        status = self.STATUS.get(res.status, "error")
+        if status != "optimal":
+            return SolverResult(status, None, None)
+        duals = res.eqlin.marginals if has_eq else np.zeros(0)
+        return SolverResult(status, res.fun, res.x, duals)
+
+
+class CbcBackend(SolverBackend):
+    """
+    CBC, through the executable distributed with PuLP
+    """
+
+    name = "cbc"
+    in_process = False
+
+    def solver(self):
+        return plp.PULP_CBC_CMD(msg=False, options=['randomSeed {0}'.format(self.seed)])
+
+    def solve_lp(self, lp):
+        problem, variables = lp_to_pulp(lp)
+        res = solve_with_pulp(problem, self.solver())
+        if res.x is None:
+            return res
+        x = np.array([v.varValue for v in variables], dtype=float)
+        duals = np.array([problem.constraints["eq{0}".format(i)].pi for i in range(lp.A_eq.shape[0])], dtype=float)
+        return SolverResult(res.status, res.objective, x, duals)
+
+    def solve_pulp(self, problem):
+        return solve_with_pulp(problem, self.solver())
+
+
+def solve_with_pulp(problem, solver):
+    """
+    Solves a PuLP model with one of the solvers of PuLP
+    """
+    problem.solve(solver)
+    status = plp.LpStatus[problem.status].lower()
+    if status != "optimal":
+        return SolverResult(status, None, None)
+    x = np.array([v.varValue for v in problem.variables()], dtype=float)
+    return SolverResult(status, plp.value(problem.objective), x)
+
+
+BACKENDS = {
+    "cplex": CplexBackend,
+    "highs": HighsBackend,
+    "cbc": CbcBackend,
+}
+
+
+def get_backend(backend=None, seed=420):
+    """
+    Returns a solver backend
+
+    Parameters
+    -----------
+    backend : str, SolverBackend or None
+        Name of the backend (one of `BACKENDS`), a backend instance that
+        is returned as it is, or None for `DEFAULT_BACKEND`
+    seed : int
+        Random seed for the solver
+    """
+    if isinstance(backend, SolverBackend):
+        return backend
+    if backend is None:
+        backend = DEFAULT_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError("Unknown solver backend {0}".format(backend))
+    return BACKENDS[backend](seed)
@@ -1,3 +1,4 @@
+import itertools
 import numbers
 import numpy as np
 from lemsim.bid import Bid
@@ -31,114 +32,126 @@ SELLING_STATES = [
     PRODUCE_IDLE_SELL,
 ]
 
-def derive_bid(load, bat_usage, price_buy, price_sell):
-    
+# Code of each combination of load, battery and net states, -1 if it is not a state
+_LOAD_STATES = ["NONE", "CONSUME", "PRODUCE"]
+_BAT_STATES = ["IDLE", "CHARGE", "DISCHARGE"]
+_NET_STATES = ["NONE", "BUY", "SELL"]
+_STATE_NAMES = ["_".join(k) for k in itertools.product(_LOAD_STATES, _BAT_STATES, _NET_STATES)]
+_STATE_CODES = np.array([globals().get(name, -1) for name in _STATE_NAMES])
+
+
+def _sign_state(x):
+    """
+    0 where `x` is close to zero, 1 where it is positive, 2 where it is
+    negative and -1 where it is not a number
+    """
+    return np.select([np.abs(x) <= 1e-8, x > 0, x < 0], [0, 1, 2], -1)
+
+
+def classify(load, bat_usage):
+    """
+    State of each timeslot, one of the `CONSUME_*`, `NONE_*` and
+    `PRODUCE_*` codes, from the load, the use of the battery and their
+    sum. Works with arrays of any shape, e.g. (N x T) for N prosumers.
+    """
+    load = np.asarray(load, dtype=float)
+    bat_usage = np.asarray(bat_usage, dtype=float)
+    signs = [_sign_state(load), _sign_state(bat_usage), _sign_state(bat_usage + load)]
+    if any((x < 0).any() for x in signs):
+        raise ValueError("The load and the use of the battery must be numbers")
+    combination = signs[0] * 9 + signs[1] * 3 + signs[2]
+    action = _STATE_CODES[combination]
+    if (action < 0).any():
+        name = _STATE_NAMES[combination[action < 0].flat[0]]
+        raise NameError("name '{0}' is not defined".format(name))
+    return action
+
+
+def _runs(mask):
+    """
+    Start and end (included) of the runs of True in `mask`, without
+    the one that is still open at the end
+    """
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1) - 1
+    closed = ends < mask.shape[0] - 1
+    return starts[closed], ends[closed]
+
+
+def derive_bid(load, bat_usage, price_buy, price_sell, action=None):
+    """
+    Pieces of the bid of a prosumer from its load and the use of its
+    battery
+
+    Parameters
+    -----------
+    load, bat_usage : np.ndarray of float
+    price_buy, price_sell : np.ndarray of float
+    action : np.ndarray of int
+        States of the timeslots (see `classify`), computed if None
+
+    Returns
+    --------
+    action : list of int
+        State of each timeslot
+    bid_list : list of tuples
+        `('buyone', t, quantity)` for the single items to buy,
+        `('buybundle', start, end, quantity, remove)` for the bundles to
+        buy and `('sellbundle', start, end, capacities, keep)` for the
+        bundles to sell
+    """
     EPS = 1e-9
-    
-    bat_usage = bat_usage
-    load = load
-    
+    price_buy = np.asarray(price_buy)
     net = bat_usage + load
-    #print('Net', net)
-    
-    action = []
-    for l, b, n in zip(load, bat_usage, net):
-        ac = ""
-        if np.allclose(l, 0):
-            ac += "NONE_"
-        elif l > 0:
-            ac += "CONSUME_"
-        elif l < 0:
-            ac += "PRODUCE_"
-        if np.allclose(b, 0):
-            ac += "IDLE_"
-        elif b > 0:
-            ac += "CHARGE_"
-        elif b < 0:
-            ac += "DISCHARGE_"
-        if np.allclose(n, 0):
-            ac += "NONE"
-        elif n > 0:
-            ac += "BUY"
-        elif n < 0:
-            ac += "SELL"
-
-        action.append(eval(ac))
+    action = classify(load, bat_usage) if action is None else np.asarray(action)
+    T = action.shape[0]
 
     bid_list = []
 
-    cant_ = 0
-    for t, a in enumerate(action):
-        if a in [CONSUME_CHARGE_BUY, CONSUME_IDLE_BUY]:
-            cant_ = load[t]
-        elif a == CONSUME_DISCHARGE_BUY:
-            cant_ = net[t]
-        if cant_ > EPS:
-            bid_ = ('buyone', t, cant_)
-            bid_list.append(bid_)
-            cant_ = 0
-
-    build_buy_cant = 0
-    building_buy = False
-    building_buy_start_time = -1
-    building_buy_end_time = -1
-    for t, a in enumerate(action):
-        #print(t, build_buy_cant)
-        if a in BUYING_STATES and (not building_buy):
-            building_buy = True
-            building_buy_start_time = t
-            pb_start = price_buy[t]
-            bb_remove = []
-        if (a not in BUYING_STATES) and (building_buy is True) and (price_buy[t] <= pb_start):
-            building_buy = False
-            building_buy_end_time = t - 1
-            bid_ = ('buybundle', building_buy_start_time, building_buy_end_time, build_buy_cant, bb_remove)
-            if build_buy_cant > EPS:
-                bid_list.append(bid_)
-            build_buy_cant = 0
-            bb_remove = []
-        if building_buy is True:
-            bb_remove.append(min(load[t], 0))
-            if a in [CONSUME_CHARGE_BUY, NONE_CHARGE_BUY]:
-                build_buy_cant += bat_usage[t]
-            elif a == PRODUCE_CHARGE_BUY:
-                build_buy_cant += net[t]
-
-    build_sell_cant = 0
-    building_sell = False
-    building_sell_start_time = -1
-    building_sell_end_time = -1
-    for t, a in enumerate(action):
-        if a in SELLING_STATES and (not building_sell):
-            building_sell = True
-            building_sell_start_time = t
-            building_sell_capacities = []
-            building_sell_keep = 0
-        if (a not in SELLING_STATES) and building_sell:
-            building_sell_capacities = np.abs(np.array(building_sell_capacities))
-            building_sell = False
-            building_sell_end_time = t - 1
-            bid_ = ('sellbundle', building_sell_start_time, building_sell_end_time,
-                    building_sell_capacities, building_sell_keep)
-            if building_sell_capacities.sum() - building_sell_keep > EPS:
-                bid_list.append(bid_)
-
-        if building_sell:
-
-            building_sell_capacities.append(load[t])
-            if a in [PRODUCE_CHARGE_SELL, PRODUCE_CHARGE_NONE]:
-                building_sell_keep += bat_usage[t]
-
-    return action, bid_list
-
-
-
-def create_bid(uid, load, bat_usage, price_buy, price_sell, ramp_up=None, ramp_down=None, efc=0.95, efd=0.95):
+    # Single items to buy
+    cant = np.where(action == CONSUME_DISCHARGE_BUY, net, load)
+    single = np.isin(action, [CONSUME_CHARGE_BUY, CONSUME_IDLE_BUY, CONSUME_DISCHARGE_BUY]) & (cant > EPS)
+    bid_list.extend(('buyone', t, cant[t]) for t in np.flatnonzero(single).tolist())
+
+    # Bundles to buy, from a buying state until the first state that is
+    # not buying at a price not higher than the one of the start
+    buying = np.isin(action, BUYING_STATES)
+    charge = np.where(np.isin(action, [CONSUME_CHARGE_BUY, NONE_CHARGE_BUY]), bat_usage, 0.0)
+    charge = np.where(action == PRODUCE_CHARGE_BUY, net, charge)
+    t = 0
+    while t < T:
+        start = t + np.argmax(buying[t:])
+        if not buying[start]:
+            break
+        closing = np.flatnonzero(~buying[start + 1:] & (price_buy[start + 1:] <= price_buy[start]))
+        if closing.shape[0] == 0:
+            break
+        end = start + closing[0]
+        quantity = np.cumsum(charge[start: end + 1])[-1]
+        if quantity > EPS:
+            remove = list(np.minimum(load[start: end + 1], 0))
+            bid_list.append(('buybundle', int(start), int(end), quantity, remove))
+        t = end + 2
+
+    # Bundles to sell, along the runs of selling states
+    keeping = np.where(np.isin(action, [PRODUCE_CHARGE_SELL, PRODUCE_CHARGE_NONE]), bat_usage, 0.0)
+    for start, end in zip(*_runs(np.isin(action, SELLING_STATES))):
+        capacities = np.abs(np.array(load[start: end + 1]))
+        keep = np.cumsum(keeping[start: end + 1])[-1]
+        if capacities.sum() - keep > EPS:
+            bid_list.append(('sellbundle', int(start), int(end), capacities, keep))
+
+    return action.tolist(), bid_list
+
+
+def create_bid(uid, load, bat_usage, price_buy, price_sell, ramp_up=None, ramp_down=None, efc=0.95, efd=0.95,
+               action=None):
     
     load = load.copy()
     bat_usage = bat_usage.copy()
     new_bid = Bid(uid)
-    ac, bids = derive_bid(load, bat_usage, price_buy, price_sell)
+    ac, bids = derive_bid(load, bat_usage, price_buy, price_sell, action)
     #print('-'*50)
     
     #print(ac)
@@ -172,6 +185,8 @@ def create_bid(uid, load, bat_usage, price_buy, price_sell, ramp_up=None, ramp_d
             up_bound = up_bound.astype('float')
             #print(up_bound, remove)
             up_bound += remove
+            # The discharge of the battery can exceed the ramp
+            up_bound = np.maximum(up_bound, 0)
             cons = new_bid.add_bundle(start=t_start,
                                end=t_end,
                                quantity=quant,
@@ -208,3 +223,44 @@ def create_bid(uid, load, bat_usage, price_buy, price_sell, ramp_up=None, ramp_d
         if cons is False:
             allin = False
     return new_bid, allin
+
+
+def create_bids(uids, loads, bat_usages, prices_buy, prices_sell, ramp_up=None, ramp_down=None, efc=0.95,
+                efd=0.95):
+    """
+    Bids of a whole population, as `create_bid` for each prosumer. The
+    states of all the timeslots of all the prosumers are classified at
+    once (see `classify`).
+
+    Parameters
+    -----------
+    uids : list
+        Identifier of each of the N prosumers
+    loads, bat_usages : np.ndarray of float
+        (N x T) load and use of the battery of each prosumer
+    prices_buy, prices_sell : np.ndarray of float
+        (N x T) prices of each prosumer, or T prices for all of them
+    ramp_up, ramp_down : None, float or list
+        Same as in `create_bid` for all the prosumers, or a list with
+        the value of each one
+
+    Returns
+    --------
+    list of tuples
+        (Bid, status) of each prosumer, as returned by `create_bid`
+    """
+    loads = np.asarray(loads, dtype=float)
+    bat_usages = np.asarray(bat_usages, dtype=float)
+    actions = classify(loads, bat_usages)
+    prices_buy = np.broadcast_to(prices_buy, loads.shape)
+    prices_sell = np.broadcast_to(prices_sell, loads.shape)
+    N = loads.shape[0]
+    if ramp_up is None or isinstance(ramp_up, numbers.Number):
+        ramp_up = [ramp_up] * N
+    if ramp_down is None or isinstance(ramp_down, numbers.Number):
+        ramp_down = [ramp_down] * N
+    return [
+        create_bid(uids[n], loads[n], bat_usages[n], prices_buy[n], prices_sell[n], ramp_up[n], ramp_down[n],
+                   efc, efd, action=actions[n])
+        for n in range(N)
+    ]
@@ -5,15 +5,163 @@ Winner determination problem for the combinatorial flexiblilty auction
 """
 import itertools
 from collections import defaultdict
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
 
 import pulp as plp
 import numpy as np
-import os
+from lemsim.solvers import SolverResult, get_backend
+from lemsim.wdp_cache import lp_key
+from lemsim.wdp_matrix import Presolve, append_bid, build_wdp, column_names, components, presolve, sub_lp
+
+PULP_STATUS = {
+    'optimal': 'Optimal',
+    'infeasible': 'Infeasible',
+    'unbounded': 'Unbounded',
+}
+
 
 class InvalidBid(Exception):
     pass
 
 
+class WDPResult:
+    """
+    Allocation of a solved WDP as dense arrays, with one row per bidder
+
+    Parameters
+    -----------
+    uids : np.ndarray of str
+        Identifier of the bidder of each row
+    buy : np.ndarray of shape (bidders, M)
+        Quantity bought by each bidder in each timeslot
+    sell : np.ndarray of shape (bidders, M)
+        Quantity sold by each bidder in each timeslot
+    payment : np.ndarray of shape (bidders,)
+        Payment of each bidder in the solution of the WDP
+    """
+
+    __slots__ = ('uids', 'buy', 'sell', 'payment')
+
+    def __init__(self, uids, buy, sell, payment):
+        self.uids = uids
+        self.buy = buy
+        self.sell = sell
+        self.payment = payment
+
+    @classmethod
+    def from_columns(cls, M, uids, slots, isbuying, x, payment_uids, payment_x):
+        """
+        Adds up the values `x` of the buying and selling variables, and the
+        payments, of each bidder. The bidders are sorted by first appearance.
+        """
+        all_uids = np.concatenate([uids, payment_uids]).astype(str)
+        unique, first, inverse = np.unique(all_uids, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(order.shape[0])
+        rows = rank[inverse]
+        n = uids.shape[0]
+
+        buy = np.zeros((unique.shape[0], M))
+        sell = np.zeros((unique.shape[0], M))
+        inside = (slots >= 0) & (slots < M)
+        for target, select in [(buy, inside & isbuying), (sell, inside & ~isbuying)]:
+            np.add.at(target, (rows[:n][select], slots[select]), x[select])
+        payment = np.bincount(rows[n:], weights=payment_x, minlength=unique.shape[0])
+        return cls(unique[order], buy, sell, payment)
+
+    @classmethod
+    def concat(cls, results):
+        """
+        Joins the results of WDPs with disjoint sets of bidders
+        """
+        return cls(
+            np.concatenate([r.uids for r in results]),
+            np.concatenate([r.buy for r in results]),
+            np.concatenate([r.sell for r in results]),
+            np.concatenate([r.payment for r in results]),
+        )
+
+    @classmethod
+    def mean(cls, results):
+        """
+        Average of several results, a bidder missing from a result counts
+        as zero. The bidders are sorted by first appearance.
+        """
+        uids = np.array(list(dict.fromkeys(np.concatenate([r.uids for r in results]))), dtype=str)
+        row = {uid: k for k, uid in enumerate(uids)}
+        M = results[0].buy.shape[1]
+        buy = np.zeros((uids.shape[0], M))
+        sell = np.zeros((uids.shape[0], M))
+        payment = np.zeros(uids.shape[0])
+        for r in results:
+            rows = np.array([row[uid] for uid in r.uids], dtype=int)
+            buy[rows] += r.buy
+            sell[rows] += r.sell
+            payment[rows] += r.payment
+        n = len(results)
+        return cls(uids, buy / n, sell / n, payment / n)
+
+    @property
+    def net(self):
+        """
+        Quantity bought minus quantity sold
+        """
+        return self.buy - self.sell
+
+    def costs(self, price_buy, price_sell):
+        """
+        Cost of each bidder at the given prices
+        """
+        return self.buy @ np.asarray(price_buy, dtype=float) - self.sell @ np.asarray(price_sell, dtype=float)
+
+    def as_dicts(self):
+        """
+        The allocation as dictionaries of the quantities bought, sold
+        and the payment of each uid
+        """
+        varbuy = dict(zip(self.uids, self.buy))
+        varsell = dict(zip(self.uids, self.sell))
+        payment = dict(zip(self.uids, self.payment))
+        return varbuy, varsell, payment
+
+
+class NamedSolution(Mapping):
+    """
+    Values of the columns of a SparseWDP by the names that the PuLP
+    model gives to its variables. The names are only built when a value
+    is looked up.
+
+    Parameters
+    -----------
+    columns : np.ndarray
+        Columns of the SparseWDP
+    x : np.ndarray
+        Value of each column
+    """
+
+    def __init__(self, columns, x):
+        self.columns = columns
+        self.x = x
+        self._values = None
+
+    @property
+    def values_by_name(self):
+        if self._values is None:
+            self._values = dict(zip(column_names(self.columns), self.x))
+        return self._values
+
+    def __getitem__(self, name):
+        return self.values_by_name[name]
+
+    def __iter__(self):
+        return iter(self.values_by_name)
+
+    def __len__(self):
+        return len(self.x)
+
+
 class WinnerDeterminationProblem:
 
     """
@@ -24,9 +172,50 @@ class WinnerDeterminationProblem:
     -----------
     M : int
         Quantity of goods that can be traded
+    backend : str or SolverBackend
+        Solver to use, see `lemsim.solvers.get_backend`
+    mode : str
+        `memory` passes the matrices of the problem to the solver inside
+        the process, `file` lets PuLP write an LP file and call the solver
+        executable, and `auto` uses `memory` if the backend supports it
+    builder : str
+        `matrix` builds the problem directly as sparse matrices (see
+        `lemsim.wdp_matrix`) and `pulp` builds it with PuLP objects
+    keepable : str
+        Formulation of the quantity to keep of the selling bundles,
+        `compact` or `enumerate` (see `keepable_constraints`)
+    decompose : bool
+        If True the groups of bids that do not share any timeslot are
+        solved as separate problems (see `solve_blocks`), only for the
+        `matrix` builder
+    workers : int
+        Number of processes that solve the separate problems, None
+        solves them in this process
+    pricing : str
+        `alphabeta` sets the prices between the highest selling and the
+        lowest buying unit cost that trade, with `a` and `b`, and `duals`
+        uses the dual values of the balance constraints, the same price
+        to buy and to sell (see `clearing_prices`). `duals` needs the
+        `matrix` builder
+    presolve : bool
+        If True the quantities that cannot trade are removed before
+        solving (see `lemsim.wdp_matrix.presolve`), only for the `matrix`
+        builder. The results still include every bid.
+    cache : SolutionCache
+        Solutions reused when the same problem is solved again with the
+        same solver settings, only for the `matrix` builder. The prices
+        are computed with `a` and `b` of this problem (see
+        `lemsim.wdp_cache`).
     """
 
-    def __init__(self, M, a=0, b=1, seed=420):
+    MODES = ['auto', 'memory', 'file']
+    BUILDERS = ['matrix', 'pulp']
+    KEEPABLE = ['compact', 'enumerate']
+    PRICINGS = ['alphabeta', 'duals']
+
+    def __init__(self, M, a=0, b=1, seed=420, backend=None, mode='auto', builder='matrix',
+                 keepable='compact', decompose=False, workers=None, pricing='alphabeta',
+                 presolve=False, cache=None):
         self.M = M
         self.vars_buying = defaultdict(list)
         self.vars_selling = defaultdict(list)
@@ -34,6 +223,7 @@ class WinnerDeterminationProblem:
         self.vars_payment = []
         self.constraints = []
         self.bids = []
+        self.book = None
         self.model = None
         self.is_solved = False
         self.price_buy = None
@@ -41,12 +231,49 @@ class WinnerDeterminationProblem:
         self.a = a
         self.b = b
         self.seed = seed
+        self.backend = backend
+        assert mode in self.MODES
+        self.mode = mode
+        assert builder in self.BUILDERS
+        self.builder = builder
+        assert keepable in self.KEEPABLE
+        self.keepable = keepable
+        assert not decompose or builder == 'matrix', "decompose needs the matrix builder"
+        self.decompose = decompose
+        self.workers = workers
+        assert pricing in self.PRICINGS
+        assert pricing == 'alphabeta' or builder == 'matrix', "duals pricing needs the matrix builder"
+        self.pricing = pricing
+        assert not presolve or builder == 'matrix', "presolve needs the matrix builder"
+        self.presolve = presolve
+        assert cache is None or builder == 'matrix', "cache needs the matrix builder"
+        self.cache = cache
+        self.presolved = None
+        self.solution = None
+        self.duals = None
+        self.index = None
+        self.result = None
+        self.session = None
+        self.session_cols = None
+        self.budgetbalanced = False
+        self.budget_row = None
+        self.withdrawn = set()
+
+    def __getstate__(self):
+        # The solver session stays in its process
+        state = self.__dict__.copy()
+        state['session'] = None
+        return state
 
     def add_bid(self, bid):
         """
         Adds the bid to the problem. There
         are different types of bids.
 
+        If the problem is already built, its columns and rows are added
+        to the matrices (see `lemsim.wdp_matrix.append_bid`) and the next
+        solve starts from the current one. Only for the `matrix` builder.
+
         Parameters
         ----------
 
@@ -60,19 +287,101 @@ class WinnerDeterminationProblem:
         """
         try:
             check_bid(bid, self.M)
-            self.bids.append(bid)
-            return True
         except InvalidBid as e:
             print(e)
             return False
 
+        self.bids.append(bid)
+        self.book = None
+        self.price_buy = None
+        self.price_sell = None
+        if self.model is not None:
+            assert self.builder == 'matrix', "changing a built problem needs the matrix builder"
+            self.model = append_bid(self.model, bid, self.budget_row, self.budgetbalanced, self.keepable)
+            self.withdrawn.discard(str(bid.uid))
+            if self.session is not None and not self.presolve:
+                self.session.append(self.model.lp)
+                self.session_cols = np.arange(len(self.model.columns))
+        return True
+
+    def add_book(self, book):
+        """
+        Adds all the bids of a BidBook, checked at once (see
+        `lemsim.bid_book.BidBook.check`). If they are the only bids of
+        the problem, the `matrix` builder builds it from the arrays of
+        the book (see `lemsim.wdp_matrix.book_wdp`).
+
+        Parameters
+        ----------
+
+        book : BidBook
+
+        Returns
+        ---------
+        np.ndarray of bool:
+            True for the bidders whose bid was added
+        """
+        valid = book.check(self.M)
+        for uid in book.uids[~valid]:
+            print(InvalidBid("Invalid bid of {0}".format(uid)))
+        if not valid.all():
+            book = book.take(np.flatnonzero(valid))
+        if self.bids or self.model is not None:
+            for bd in book.bids:
+                self.add_bid(bd)
+        else:
+            self.bids = list(book.bids)
+            self.book = book
+        return valid
+
+    def remove_bid(self, uid):
+        """
+        Removes the bids of `uid` from the problem. If the problem is
+        already built, their quantities and payments are fixed at zero
+        and they are left out of the results, so the next solve starts
+        from the current one. Only for the `matrix` builder.
+
+        Returns
+        ---------
+        bool:
+            True if there was a bid of `uid`
+        """
+        found = any(str(bd.uid) == str(uid) for bd in self.bids)
+        self.bids = [bd for bd in self.bids if str(bd.uid) != str(uid)]
+        if found:
+            self.book = None
+            self.price_buy = None
+            self.price_sell = None
+        if self.model is not None and found:
+            assert self.builder == 'matrix', "changing a built problem needs the matrix builder"
+            columns = self.model.columns
+            own = (columns['uid'].astype(str) == str(uid)) & (columns['kind'] != 'keep')
+            self.model.lp.lb[own] = 0
+            self.model.lp.ub[own] = 0
+            self.withdrawn.add(str(uid))
+        return found
+
     def build_problem(self, budgetbalanced=False):
         """
-        Creates a new model in PulP to solve the WDP
+        Creates a new model to solve the WDP, a SparseWDP or a PuLP
+        model depending on the builder
         """
+        if self.builder == 'matrix':
+            bids = self.bids if self.book is None else self.book
+            self.model = build_wdp(bids, self.M, budgetbalanced, self.keepable)
+            self.budgetbalanced = budgetbalanced
+            # The budget balance is the last inequality row of `build_wdp`
+            self.budget_row = self.model.lp.A_ub.shape[0] - 1
+            self.withdrawn = set()
+            self.session = None
+            self.presolved = None
+            self.is_solved = False
+            return self.model
 
         mdl = plp.LpProblem(name="WDP")
         #mdl.parameters.randomseed.set(seed)
+        index_vars = []
+        payment_vars = []
 
         cost_buying = []
         cost_selling = []
@@ -90,7 +399,10 @@ class WinnerDeterminationProblem:
                 elif b_.type == "sellingbundle":
                     fun = generate_selling_bundle
 
-                var_d, cons_l, pay_l, cost, isbuying = fun(b_, i, uid)
+                if b_.type == "sellingbundle":
+                    var_d, cons_l, pay_l, cost, isbuying = fun(b_, i, uid, self.keepable)
+                else:
+                    var_d, cons_l, pay_l, cost, isbuying = fun(b_, i, uid)
 
                 for k, v in var_d.items():
                     vars_.append(v)
@@ -99,6 +411,8 @@ class WinnerDeterminationProblem:
                         self.vars_buying[k].append(v)
                     else:
                         self.vars_selling[k].append(v)
+                    index_vars.append((v, uid, k, isbuying, b_.unitcost))
+                payment_vars.extend((v, uid) for v in pay_l)
 
                 self.constraints.extend(cons_l)
                 self.vars_payment.extend(pay_l)
@@ -143,12 +457,23 @@ class WinnerDeterminationProblem:
 
         self.model = mdl
         self.is_solved = False
+        variables, uids, slots, isbuying, unitcost = zip(*index_vars) if index_vars else [()] * 5
+        payments, payment_uids = zip(*payment_vars) if payment_vars else [()] * 2
+        self.index = (
+            list(variables),
+            np.array(uids, dtype=object),
+            np.array(slots, dtype=int),
+            np.array(isbuying, dtype=bool),
+            np.array(unitcost, dtype=float),
+            list(payments),
+            np.array(payment_uids, dtype=object),
+        )
         return mdl
 
     def solve(self):
         """
-        Solves the model if it has one
-        #TODO: check different solvers
+        Solves the model if it has one, with the solver backend
+        of the problem
 
         Returns
         --------
@@ -160,21 +485,67 @@ class WinnerDeterminationProblem:
         vars_ : dict
             A list of pairs with the names of the variables and their value
             in the solution
+        summary_ : tuple
+            The allocation as dictionaries, see `WDPResult.as_dicts`
+        costs : dict
+            Cost of each bidder at the prices of the solution
+
+        The allocation is also stored as a WDPResult in `self.result`.
         """
 
-        CPLEXPATH = os.environ.get('CPLEXPATH', None)
         vars_ = dict()
         status_ = None
         objective_ = None
+        # The prices of the last solve do not hold for the new solution
+        self.price_buy = None
+        self.price_sell = None
         if self.model is not None:
-            self.model.solve(plp.CPLEX_CMD(CPLEXPATH, options=['set randomseed {0}'.format(self.seed)]))
+            backend = get_backend(self.backend, self.seed)
+            mode = self.mode
+            if mode == 'auto':
+                mode = 'memory' if backend.in_process else 'file'
+            if mode == 'memory':
+                assert backend.in_process, "{0} cannot solve in memory".format(backend.name)
+
+            if self.builder == 'matrix':
+                cached = None
+                if self.cache is not None:
+                    key = self.cache_key()
+                    cached = self.cache.get(key)
+                if cached is not None:
+                    # The session and presolve of the last solve may not match the problem
+                    self.presolved = None
+                    status, objective, x, duals = cached
+                else:
+                    self.presolved = self.presolved_model()
+                    if self.decompose:
+                        status, objective, x, duals = self.solve_blocks(self.presolved.model)
+                    else:
+                        status, objective, x, duals = self.solver_session(self.presolved).solve()
+                    if x is not None:
+                        x, duals = self.expand(x, duals)
+                    if self.cache is not None:
+                        self.cache.put(key, SolverResult(status, objective, x, duals))
+                status_ = PULP_STATUS.get(status, 'Undefined')
+                if x is not None:
+                    # The matrices minimize the opposite of the welfare
+                    objective_ = -objective
+                    vars_ = NamedSolution(self.model.columns, x)
+                self.solution = x
+                self.duals = duals
+            else:
+                if mode == 'memory':
+                    backend.solve_pulp_in_memory(self.model)
+                else:
+                    backend.solve_pulp(self.model)
 
-            status_ = plp.LpStatus[self.model.status]
-            objective_ = plp.value(self.model.objective)
-            for v in self.model.variables():
-                vars_[v.name] = v.varValue
+                status_ = plp.LpStatus[self.model.status]
+                objective_ = plp.value(self.model.objective)
+                for v in self.model.variables():
+                    vars_[v.name] = v.varValue
                 
-        summary_ = compute_results(vars_, self.M)
+        self.result = self.build_result()
+        summary_ = self.result.as_dicts()
         self.summary = summary_
         self.is_solved = True
         costs = self.get_costs()
@@ -183,6 +554,30 @@ class WinnerDeterminationProblem:
     
     
     
+    def cache_key(self):
+        """
+        Key of the matrices and the solver settings in the solution
+        cache (see `lemsim.wdp_cache.lp_key`)
+        """
+        backend = get_backend(self.backend, self.seed)
+        return lp_key(self.model.lp, backend=backend.name, seed=self.seed,
+                      presolve=self.presolve, decompose=self.decompose)
+
+    def reprice(self, a, b):
+        """
+        Prices the current allocation again with `a` and `b`, without
+        solving the problem
+
+        Returns
+        --------
+        costs : dict
+            Cost of each bidder at the new prices
+        """
+        self.a = a
+        self.b = b
+        self.get_prices()
+        return self.get_costs()
+
     def get_prices(self):
         """
         For each time-slot determines the maximum selling price
@@ -198,37 +593,280 @@ class WinnerDeterminationProblem:
         list of tuples:
             For each time-slot, the (minimum buying price, maximum selling price)
 
+        """
+        price_buy, price_sell = self.clearing_prices()
+        self.price_buy = price_buy
+        self.price_sell = price_sell
+        return list(zip(price_buy, price_sell))
+
+    def clearing_prices(self, x=None, duals=None):
+        """
+        Buying and selling price of each time-slot as in `get_prices`,
+        for the solution `x` of the matrices and the dual values `duals`
+        of its equality constraints, or for the current solution.
+
+        With the `duals` pricing, the price of a time-slot is the change
+        of the welfare for one more unit of energy offered in it, which is
+        the opposite of the dual value of its balance constraint.
         """
         a = self.a
         b = self.b
         M = self.M
         price_buy = np.ones(M) * -1.0
         price_sell = np.ones(M) * -1.0
-        if self.is_solved and (b >= a):
-            res = []
-            for t in range(M):
-                selling, buying = [], []
-                for v in self.model.variables():
-                    if v.name in [x._LpElement__name for x in self.vars_buying[t]]:
-                        if v.varValue > 0:
-                            buying.append(self.vars_unitcost[v.name])
-                    if v.name in [x._LpElement__name for x in self.vars_selling[t]]:
-                        if v.varValue > 0:
-                            selling.append(self.vars_unitcost[v.name])
-                min_b = min(buying) if len(buying) > 0 else -1
-                max_s = max(selling) if len(selling) > 0 else -1
-                if min_b != -1 and max_s != -1:
-                    ps = max_s * (1 - a) + a * min_b
-                    pb = max_s * (1 - b) + b * min_b
-                else:
-                    pb, ps = -1, -1
-                price_buy[t] = pb
-                price_sell[t] = ps
-                res.append((pb, ps))
+        if (self.is_solved or x is not None) and (b >= a or self.pricing == 'duals'):
+            _, slots, isbuying, unitcost, x = self.quantity_index(x)
+            traded = (x > 0) & (slots >= 0) & (slots < M)
+            buying = traded & isbuying
+            selling = traded & ~isbuying
+            min_b = np.full(M, np.inf)
+            np.minimum.at(min_b, slots[buying], unitcost[buying])
+            max_s = np.full(M, -np.inf)
+            np.maximum.at(max_s, slots[selling], unitcost[selling])
+            both = np.isfinite(min_b) & np.isfinite(max_s)
+            if self.pricing == 'duals':
+                duals = self.duals if duals is None else duals
+                price_buy[both] = price_sell[both] = -duals[:M][both]
+            else:
+                price_sell[both] = max_s[both] * (1 - a) + a * min_b[both]
+                price_buy[both] = max_s[both] * (1 - b) + b * min_b[both]
+        return price_buy, price_sell
+
+    def quantity_index(self, x=None):
+        """
+        Describes the buying and selling variables of the problem. With
+        the `matrix` builder, `x` replaces the solution of the problem.
 
-        self.price_buy = price_buy
-        self.price_sell = price_sell
-        return res
+        Returns
+        --------
+        uids : np.ndarray
+            Bidder of each variable
+        slots : np.ndarray of int
+            Timeslot of each variable
+        isbuying : np.ndarray of bool
+        unitcost : np.ndarray of float
+        x : np.ndarray of float
+            Value of each variable in the solution, 0 if it is not solved
+        """
+        if self.builder == 'matrix':
+            columns = self.model.columns
+            select = np.isin(columns['kind'], ['buy', 'sell'])
+            x = self.current_solution() if x is None else x
+            return (columns['uid'][select], columns['timeslot'][select], columns['kind'][select] == 'buy',
+                    columns['unitcost'][select], x[select])
+
+        variables, uids, slots, isbuying, unitcost, _, _ = self.index
+        x = np.array([v.varValue or 0 for v in variables], dtype=float)
+        return uids, slots, isbuying, unitcost, x
+
+    def payment_index(self, x=None):
+        """
+        Bidder of each payment variable and its value in the solution
+        """
+        if self.builder == 'matrix':
+            columns = self.model.columns
+            select = columns['kind'] == 'payment'
+            x = self.current_solution() if x is None else x
+            return columns['uid'][select], x[select]
+
+        _, _, _, _, _, payments, payment_uids = self.index
+        return payment_uids, np.array([v.varValue or 0 for v in payments], dtype=float)
+
+    def current_solution(self):
+        """
+        Solution of the matrices, zero if the problem is not solved
+        """
+        if self.solution is None:
+            return np.zeros(len(self.model.columns))
+        return self.solution
+
+    def build_result(self, x=None):
+        """
+        Returns the WDPResult of the current solution, or of the
+        solution `x` of the matrices
+        """
+        uids, slots, isbuying, _, x_ = self.quantity_index(x)
+        result = WDPResult.from_columns(self.M, uids, slots, isbuying, x_, *self.payment_index(x))
+        if self.withdrawn:
+            keep = ~np.isin(result.uids, list(self.withdrawn))
+            result = WDPResult(result.uids[keep], result.buy[keep], result.sell[keep], result.payment[keep])
+        return result
+
+    def presolved_model(self):
+        """
+        The matrices to solve, as a Presolve: the presolved problem if
+        `presolve` is True and the whole problem otherwise
+        """
+        if self.presolve:
+            return presolve(self.model)
+        return Presolve(self.model, np.arange(len(self.model.columns)), np.arange(self.model.lp.A_eq.shape[0]))
+
+    def expand(self, x, duals):
+        """
+        Values of all the columns and equality rows of the problem from
+        the solution of the presolved one
+        """
+        x_ = np.zeros(len(self.model.columns))
+        x_[self.presolved.cols] = x
+        if duals is None:
+            return x_, None
+        duals_ = np.zeros(self.model.lp.A_eq.shape[0])
+        duals_[self.presolved.eq_rows] = duals
+        return x_, duals_
+
+    def solve_blocks(self, model=None):
+        """
+        Solves the matrices as one problem for each group of bids that
+        are connected through the timeslots they trade in (see
+        `lemsim.wdp_matrix.components`), in parallel if `workers` is
+        larger than one. Every group keeps its own budget balance, which
+        gives the same welfare as the whole problem.
+
+        Parameters
+        -----------
+        model : SparseWDP
+            The matrices to solve, those of the problem by default
+
+        Returns
+        --------
+        SolverResult
+            The solution of the whole problem, or the status of the
+            first group that could not be solved
+        """
+        model = self.model if model is None else model
+        backend = get_backend(self.backend, self.seed)
+        blocks = components(model.columns, self.M)
+        lps = [sub_lp(model.lp, cols) for cols in blocks]
+        if self.workers is not None and self.workers > 1 and len(lps) > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                results = list(pool.map(backend.solve_lp, lps))
+        else:
+            results = [backend.solve_lp(lp) for lp in lps]
+
+        x = np.zeros(len(model.columns))
+        duals = np.zeros(model.lp.A_eq.shape[0])
+        for cols, (status, _, x_, duals_) in zip(blocks, results):
+            if x_ is None:
+                return SolverResult(status, None, None)
+            x[cols] = x_
+            duals[np.flatnonzero(model.lp.A_eq[:, cols].getnnz(axis=1))] = duals_
+        return SolverResult('optimal', sum(r.objective for r in results), x, duals)
+
+    def solver_session(self, presolved=None):
+        """
+        Solver session of the matrices (see `lemsim.solvers.LPSession`),
+        created on the first call and updated with the current bounds of
+        the model, e.g. after `restrict_to_prices`. With CPLEX the next
+        solves start from the optimal basis of the first one. A new
+        session is created if the presolve keeps other columns.
+
+        Parameters
+        -----------
+        presolved : Presolve
+            The matrices to solve, `presolved_model()` by default
+        """
+        presolved = self.presolved_model() if presolved is None else presolved
+        lp = presolved.model.lp
+        if self.session is None or not np.array_equal(self.session_cols, presolved.cols):
+            self.session = get_backend(self.backend, self.seed).session(lp)
+            self.session_cols = presolved.cols
+        else:
+            changed = np.flatnonzero((self.session.lp.lb != lp.lb) | (self.session.lp.ub != lp.ub))
+            self.session.set_bounds(changed, lp.lb[changed], lp.ub[changed])
+        return self.session
+
+    def solve_without(self, uid):
+        """
+        Solves the problem without the bidder `uid` by fixing its
+        quantities and payments at zero, for the VCG payments. The model
+        is kept by a solver session between calls (see
+        `lemsim.solvers.LPSession`), which starts from the solution of
+        the whole problem, and the solution of the problem is not
+        modified. Only for the `matrix` builder.
+
+        Parameters
+        -----------
+        uid : str or int
+            Identifier of the bidder to leave out
+
+        Returns
+        --------
+        objective_ : float
+            The welfare without the bidder
+        result : WDPResult
+            The allocation without the bidder
+        costs : dict
+            Cost of each bidder at the prices of the new solution
+        """
+        assert self.builder == 'matrix', "solve_without needs the matrix builder"
+        if self.presolved is None:
+            self.presolved = self.presolved_model()
+        if self.session is None or not np.array_equal(self.session_cols, self.presolved.cols):
+            self.solver_session(self.presolved).solve()
+
+        # Columns of the bidder in the presolved problem
+        columns = self.presolved.model.columns
+        own = columns['uid'].astype(str) == str(uid)
+        cols = np.flatnonzero(own & (columns['kind'] != 'keep'))
+        lb, ub = self.session.lp.lb[cols], self.session.lp.ub[cols]
+        self.session.set_bounds(cols, 0, 0)
+        try:
+            status, objective, x, duals = self.session.solve()
+        finally:
+            # The session is shared by the next calls and by `solve`
+            self.session.set_bounds(cols, lb, ub)
+        if x is None:
+            print('Solver error', status)
+            raise ValueError
+        x, duals = self.expand(x, duals)
+
+        result = self.build_result(x)
+        costs = defaultdict(float)
+        costs.update(zip(result.uids, result.costs(*self.clearing_prices(x, duals))))
+        return -objective, result, costs
+
+    def restrict_to_prices(self, prices, EPS=1e-4):
+        """
+        Removes the offers that would not trade at the given prices:
+        buying offers below the buying price and selling offers above
+        the selling price. The timeslots without prices are closed.
+
+        Parameters
+        -----------
+        prices : list of tuples
+            For each time-slot, (buying price, selling price) as
+            returned by `get_prices`
+        """
+        if self.builder == 'matrix':
+            columns = self.model.columns
+            ub = self.model.lp.ub
+            inside = (columns['timeslot'] >= 0) & (columns['timeslot'] < self.M)
+            slots = np.where(inside, columns['timeslot'], 0)
+            limit_buy = np.array([p[0] for p in prices])[slots]
+            limit_sell = np.array([p[1] for p in prices])[slots]
+            unitcost = columns['unitcost']
+            kill_buy = np.isclose(limit_buy, -1) | (limit_buy - unitcost > EPS)
+            kill_sell = np.isclose(limit_sell, -1) | (unitcost - limit_sell > EPS)
+            ub[inside & (columns['kind'] == 'buy') & kill_buy] = 0
+            ub[inside & (columns['kind'] == 'sell') & kill_sell] = 0
+            return
+
+        for t in range(self.M):
+            limit_buy = prices[t][0]
+            limit_sell = prices[t][1]
+
+            for var in self.vars_buying[t]:
+                unitcost = self.vars_unitcost[var.name]
+                if np.allclose(limit_buy, -1): #  kill variable
+                    var.upBound = 0
+                elif (limit_buy - unitcost > EPS):
+                    var.upBound = 0
+            for var in self.vars_selling[t]:
+                unitcost = self.vars_unitcost[var.name]
+                if np.allclose(limit_sell, -1): #  kill variable
+                    var.upBound = 0
+                elif (unitcost - limit_sell > EPS):
+                    var.upBound = 0
 
     def get_costs(self, price_buy=None, price_sell=None):
 
@@ -242,38 +880,9 @@ class WinnerDeterminationProblem:
             price_sell = self.price_sell
 
         costs = defaultdict(float)
-        vb, vs, _ = self.summary
-        for k, v in vb.items():
-            for t in range(self.M):
-                costs[k] += v[t] * price_buy[t]
-        for k, v in vs.items():
-            for t in range(self.M):
-                costs[k] -= v[t] * price_sell[t]
-
+        costs.update(zip(self.result.uids, self.result.costs(price_buy, price_sell)))
         return costs
     
-def compute_results(sol, T):
-    varbuy = defaultdict(lambda :np.zeros(T))
-    varsell = defaultdict(lambda :np.zeros(T))
-    payment = defaultdict(float)
-    for k, v in sol.items():
-        sp = k.split('_')
-        if sp[0] == 'payment':
-            uid = sp[2]
-            payment[uid] += v
-        elif sp[0] == 'x':
-            t = int(sp[2])
-            uid = sp[-1]
-            if sp[1] == 'sellingbundle':
-                varsell[uid][t] += v
-            elif sp[1] == 'bundle':
-                varbuy[uid][t] += v
-            elif sp[1] == 'single':
-                varbuy[uid][t] += v
-        
-    return varbuy, varsell, payment    
-    
-
 def generate_single_constraints(bid, i, uid):
     """
     Generates all the constraints for a singleitem
@@ -410,7 +1019,7 @@ def generate_bundle_constraints(bundle, i, uid):
     return vars_dict, constraints_list, payment_list, cost, isbuying
 
 
-def generate_selling_bundle(bundle, i, uid):
+def generate_selling_bundle(bundle, i, uid, keepable='compact'):
     """
     Generates all the selling bundle_associated
     variables and constraints
@@ -423,6 +1032,8 @@ def generate_selling_bundle(bundle, i, uid):
         Identifier of the bundle inside the bid
     uid: str
         Identifier of the agent
+    keepable: str
+        How the quantity to keep is enforced, see `keepable_constraints`
     """
 
     vars_list = []
@@ -431,12 +1042,8 @@ def generate_selling_bundle(bundle, i, uid):
     payment_list = []
     start = bundle.start
     end = bundle.end
-    keep = bundle.keep
     quantities = bundle.quantities
     unitcost = bundle.unitcost
-    keep_quantities = bundle.keep_quantities
-    threshold = bundle.threshold
-    L = end - start + 1
 
     # Create a variable for each item desired
     for t in range(start, end + 1):
@@ -449,21 +1056,7 @@ def generate_selling_bundle(bundle, i, uid):
         vars_dict[t] = var_
         vars_list.append(var_)
 
-    count = 0
-    for k in range(0, threshold):
-        for ele in itertools.combinations(range(L), k):
-
-            sum_qs = sum(quantities[t] for t in range(L) if t not in ele)
-            sum_comp = sum(keep_quantities[t] for t in ele)
-
-            cons_ = plp.LpConstraint(
-                e=plp.lpSum(vars_dict[t] for t in range(start, end + 1) if t not in ele),
-                sense=plp.LpConstraintLE,
-                rhs=sum_qs + sum_comp - keep,
-                name="cons_sellingbundle_keepable_{0}_{1}_{2}".format(count, i, uid),
-            )
-            constraints_list.append(cons_)
-            count += 1
+    constraints_list.extend(keepable_constraints(bundle, vars_dict, i, uid, keepable))
 
     # Add a constraint on the total quantity desired
     # cons_sum = plp.LpConstraint(
@@ -499,6 +1092,77 @@ def generate_selling_bundle(bundle, i, uid):
     return vars_dict, constraints_list, payment_list, cost, False
 
 
+def keepable_constraints(bundle, vars_dict, i, uid, keepable='compact'):
+    """
+    Constraints that keep at least `keep` of a selling bundle. For every
+    set S of at most K = `threshold` - 1 timeslots,
+
+        sum_{t not in S} x_t <= sum_{t not in S} q_t + sum_{t in S} kq_t - keep
+
+    `enumerate` adds one constraint per set, which is exponential in the
+    length of the bundle. `compact` adds the LP dual of the maximization
+    over S, with L + 1 auxiliary variables and L + 1 constraints:
+
+        K * lambda + sum_t mu_t + sum_t x_t <= sum_t q_t - keep
+        mu_t + x_t + lambda >= q_t - kq_t,  lambda, mu_t >= 0
+    """
+    start = bundle.start
+    keep = bundle.keep
+    quantities = bundle.quantities
+    keep_quantities = bundle.keep_quantities
+    threshold = bundle.threshold
+    L = bundle.end - start + 1
+    constraints_list = []
+
+    if keepable == 'enumerate':
+        count = 0
+        for k in range(0, threshold):
+            for ele in itertools.combinations(range(L), k):
+
+                sum_qs = sum(quantities[t] for t in range(L) if t not in ele)
+                sum_comp = sum(keep_quantities[t] for t in ele)
+
+                cons_ = plp.LpConstraint(
+                    e=plp.lpSum(vars_dict[start + t] for t in range(L) if t not in ele),
+                    sense=plp.LpConstraintLE,
+                    rhs=sum_qs + sum_comp - keep,
+                    name="cons_sellingbundle_keepable_{0}_{1}_{2}".format(count, i, uid),
+                )
+                constraints_list.append(cons_)
+                count += 1
+        return constraints_list
+
+    lambda_ = plp.LpVariable(
+        cat=plp.LpContinuous,
+        lowBound=0,
+        name="keep_lambda_{0}_{1}".format(i, uid),
+    )
+    mus = []
+    for t in range(start, start + L):
+        mu_ = plp.LpVariable(
+            cat=plp.LpContinuous,
+            lowBound=0,
+            name="keep_mu_{0}_{1}_{2}".format(t, i, uid),
+        )
+        mus.append(mu_)
+        cons_ = plp.LpConstraint(
+            e=mu_ + vars_dict[t] + lambda_,
+            sense=plp.LpConstraintGE,
+            rhs=quantities[t - start] - keep_quantities[t - start],
+            name="cons_sellingbundle_keepdual_{0}_{1}_{2}".format(t, i, uid),
+        )
+        constraints_list.append(cons_)
+
+    cons_ = plp.LpConstraint(
+        e=(threshold - 1) * lambda_ + plp.lpSum(mus) + plp.lpSum(vars_dict.values()),
+        sense=plp.LpConstraintLE,
+        rhs=sum(quantities) - keep,
+        name="cons_sellingbundle_keepable_{0}_{1}".format(i, uid),
+    )
+    constraints_list.append(cons_)
+    return constraints_list
+
+
 def check_bid(bid, M):
     """
     Checks whether the bid fits the problem
@@ -0,0 +1,111 @@
+"""
+Cache of the solutions of the WDP, addressed by the content of the
+problem.
+
+The key of a problem is a hash of its matrices, which are built from the
+bid book in a fixed order, together with the settings of the solver
+that can change which optimal solution is returned (backend, seed,
+presolve and decomposition). The prices do not enter the problem, so the
+allocation of a bid book can be reused for every alpha and beta and only
+the prices have to be computed again (see
+`lemsim.wdp.WinnerDeterminationProblem.reprice`).
+"""
+import hashlib
+import os
+
+import numpy as np
+import scipy.sparse as sp
+from lemsim.solvers import SolverResult
+
+
+def lp_key(lp, **settings):
+    """
+    Canonical hash of a LinearProgram and the solver settings
+
+    Parameters
+    -----------
+    lp : LinearProgram
+    settings :
+        Any other values that identify the solution, compared by
+        their `repr`
+
+    Returns
+    --------
+    str
+        Hexadecimal SHA-256 digest
+    """
+    h = hashlib.sha256()
+    for v in [lp.c, lp.b_ub, lp.b_eq, lp.lb, lp.ub]:
+        v = np.ascontiguousarray(v, dtype=np.float64)
+        h.update(str(v.shape).encode())
+        h.update(v.tobytes())
+    for A in [lp.A_ub, lp.A_eq]:
+        # Same matrix, same arrays: sorted indices without duplicates
+        A = sp.csr_matrix(A, dtype=np.float64, copy=True)
+        A.sum_duplicates()
+        h.update(str(A.shape).encode())
+        for v in [A.indptr.astype(np.int64), A.indices.astype(np.int64), A.data]:
+            h.update(v.tobytes())
+    h.update(repr(sorted(settings.items())).encode())
+    return h.hexdigest()
+
+
+class SolutionCache:
+    """
+    Solutions of the WDP by the key of the problem (see `lp_key`). Only
+    optimal solutions are stored.
+
+    Parameters
+    -----------
+    path : str
+        Directory where the solutions are also saved as `{key}.npz`
+        files, so that they are shared between processes and runs. If
+        None they are only kept in memory.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.solutions = dict()
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def __getstate__(self):
+        # The solutions in memory are not pickled with the simulations
+        state = self.__dict__.copy()
+        state['solutions'] = dict()
+        return state
+
+    def __len__(self):
+        return len(self.solutions)
+
+    def filename(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def get(self, key):
+        """
+        Returns the SolverResult stored with `key`, or None
+        """
+        result = self.solutions.get(key)
+        if result is None and self.path is not None and os.path.isfile(self.filename(key)):
+            with np.load(self.filename(key)) as data:
+                duals = data['duals'] if data['duals'].size > 0 else None
+                result = SolverResult('optimal', float(data['objective']), data['x'], duals)
+            self.solutions[key] = result
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """
+        Stores the SolverResult `result` with `key` if it is optimal
+        """
+        if result.status != 'optimal':
+            return
+        self.solutions[key] = result
+        if self.path is not None:
+            duals = np.zeros(0) if result.duals is None else result.duals
+            np.savez(self.filename(key), objective=result.objective, x=result.x, duals=duals)
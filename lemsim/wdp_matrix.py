@@ -0,0 +1,543 @@
+"""
+Winner determination problem of `lemsim.wdp` built directly as sparse
+matrices from the bids, without creating PuLP variables and constraints.
+
+Every column is described by an entry of a structured array (see
+`COLUMN_DTYPE`), which maps it back to the bid, the piece of the bid and
+the timeslot it belongs to.
+
+The bids are only coupled through the balance constraint of each
+timeslot and the budget balance. The groups of bids that share no
+timeslot (see `components`) can be solved as separate problems, each one
+with its own budget balance. The payments can be balanced whenever the
+welfare of the trades is not negative, and trading nothing is feasible,
+so the optimal welfare of every group is not negative. The welfare is
+then the same as solving the whole problem, and the union of the
+solutions satisfies its budget balance.
+"""
+import itertools
+import math
+from collections import namedtuple
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+from lemsim.bid_book import BidBook, BUNDLE, SELLING, ragged_arange
+from lemsim.solvers import LinearProgram
+
+COLUMN_DTYPE = np.dtype([
+    ("bid", np.int64),        # Position of the bid in the list of bids
+    ("uid", object),          # Identifier of the bidder
+    ("piece", np.int64),      # Position of the piece inside the bid
+    ("type", "U13"),          # `single`, `bundle` or `sellingbundle`
+    ("timeslot", np.int64),   # -1 for the payments
+    ("kind", "U7"),           # `buy`, `sell`, `payment` or `keep`
+    ("unitcost", np.float64),
+])
+
+PIECE_TYPES = {
+    "singleitem": "single",
+    "simplebundle": "bundle",
+    "sellingbundle": "sellingbundle",
+}
+
+SparseWDP = namedtuple("SparseWDP", ["lp", "columns", "M"])
+SparseWDP.__doc__ = """
+The WDP as a minimization `LinearProgram` (the opposite of the welfare)
+and the description of its columns. The first `M` rows of `lp.A_eq` are
+the balance constraints of each timeslot.
+"""
+
+Presolve = namedtuple("Presolve", ["model", "cols", "eq_rows"])
+Presolve.__doc__ = """
+The reduced problem of `presolve` as a SparseWDP, and the columns and
+equality rows of the whole problem that it keeps. The rest of the columns
+are zero in every optimal solution.
+"""
+
+
+def piece_columns(piece):
+    """
+    Timeslots, upper bounds and side of the quantity columns of a piece
+    """
+    if piece.type == "singleitem":
+        return np.array([piece.item]), np.array([piece.quantity], dtype=float), piece.isbuying
+    slots = np.arange(piece.start, piece.end + 1)
+    if piece.type == "simplebundle":
+        return slots, np.asarray(piece.upper_bound, dtype=float), piece.isbuying
+    return slots, np.asarray(piece.quantities, dtype=float), False
+
+
+def keepable_rows(bundle):
+    """
+    Constraints of a selling bundle on the energy that has to be kept,
+    enumerating every set S of less than `threshold` timeslots:
+    sum_{t not in S} x_t <= sum_{t not in S} q_t + sum_{t in S} kq_t - keep
+    (see `lemsim.wdp.keepable_constraints`)
+
+    Returns
+    --------
+    mask : np.ndarray of bool
+        One row per constraint, True for the timeslots in the sum
+    rhs : np.ndarray
+    """
+    L = bundle.end - bundle.start + 1
+    q = np.asarray(bundle.quantities, dtype=float)
+    kq = np.asarray(bundle.keep_quantities, dtype=float)
+    masks = []
+    for k in range(0, bundle.threshold):
+        combs = np.fromiter(
+            itertools.chain.from_iterable(itertools.combinations(range(L), k)), dtype=np.int64
+        ).reshape(math.comb(L, k), k)
+        mask = np.ones((combs.shape[0], L), dtype=bool)
+        mask[np.arange(combs.shape[0])[:, None], combs] = False
+        masks.append(mask)
+    mask = np.concatenate(masks)
+    rhs = mask @ q + (~mask) @ kq - bundle.keep
+    return mask, rhs
+
+
+def build_wdp(bids, M, budgetbalanced=False, keepable='compact'):
+    """
+    Builds the WDP of `WinnerDeterminationProblem.build_problem`
+
+    Parameters
+    -----------
+    bids : list of Bid or BidBook
+        A BidBook is built from its arrays (see `book_wdp`)
+    M : int
+        Number of timeslots
+    budgetbalanced : bool
+        If True the payments add up to zero, otherwise they are
+        weakly budget balanced
+    keepable : str
+        Formulation of the quantity to keep of the selling bundles,
+        `compact` or `enumerate` (see `lemsim.wdp.keepable_constraints`)
+
+    Returns
+    --------
+    SparseWDP
+    """
+    if isinstance(bids, BidBook):
+        if keepable == 'compact' or not (bids.type == SELLING).any():
+            return book_wdp(bids, M, budgetbalanced)
+        bids = bids.bids
+    blocks = []
+    lb, ub = [], []
+    rows, cols, data, b_ub = [], [], [], []
+    n = 0
+    m = 0
+    for k, bid_ in enumerate(bids):
+        pieces = bid_.bundles + bid_.singles + bid_.sellingbundles
+        for i, b_ in enumerate(pieces):
+            slots, upper, isbuying = piece_columns(b_)
+            L = slots.shape[0]
+            x = n + np.arange(L)
+            payment = n + L
+            # Dual variables mu and lambda of the compact keepable constraints
+            n_keep = L + 1 if b_.type == "sellingbundle" and keepable == "compact" else 0
+            mu = payment + 1 + np.arange(n_keep - 1)
+            lambda_ = payment + n_keep
+
+            block = np.zeros(L + 1 + n_keep, dtype=COLUMN_DTYPE)
+            block["bid"] = k
+            block["uid"] = bid_.uid
+            block["piece"] = i
+            block["type"] = PIECE_TYPES[b_.type]
+            block["timeslot"] = -1
+            block["timeslot"][:L] = slots
+            if n_keep > 0:
+                block["timeslot"][mu - n] = slots
+            block["kind"][:L] = "buy" if isbuying else "sell"
+            block["kind"][L] = "payment"
+            block["kind"][L + 1:] = "keep"
+            block["unitcost"] = b_.unitcost
+            blocks.append(block)
+
+            lb.extend([np.zeros(L), [0 if isbuying else -np.inf], np.zeros(n_keep)])
+            ub.extend([upper, [np.inf if isbuying else 0], np.repeat(np.inf, n_keep)])
+
+            # Total quantity of a bundle
+            if b_.type == "simplebundle":
+                rows.append(np.repeat(m, L))
+                cols.append(x)
+                data.append(np.ones(L))
+                b_ub.append([b_.quantity])
+                m += 1
+
+            # Quantity to keep of a selling bundle
+            if n_keep > 0:
+                # -mu_t - x_t - lambda <= kq_t - q_t
+                q = np.asarray(b_.quantities, dtype=float)
+                kq = np.asarray(b_.keep_quantities, dtype=float)
+                r_ = m + np.arange(L)
+                rows.extend([r_, r_, r_])
+                cols.extend([mu, x, np.repeat(lambda_, L)])
+                data.extend([-np.ones(L), -np.ones(L), -np.ones(L)])
+                b_ub.append(kq - q)
+                m += L
+                # K * lambda + sum_t mu_t + sum_t x_t <= sum_t q_t - keep
+                rows.append(np.repeat(m, 2 * L + 1))
+                cols.append(np.concatenate([mu, x, [lambda_]]))
+                data.append(np.concatenate([np.ones(2 * L), [b_.threshold - 1]]))
+                b_ub.append([q.sum() - b_.keep])
+                m += 1
+            elif b_.type == "sellingbundle":
+                mask, rhs = keepable_rows(b_)
+                r_, c_ = np.nonzero(mask)
+                rows.append(m + r_)
+                cols.append(x[c_])
+                data.append(np.ones(r_.shape[0]))
+                b_ub.append(rhs)
+                m += rhs.shape[0]
+
+            # Individual rationality, payment <= +-unitcost * sum_t x_t
+            sign = 1 if isbuying else -1
+            rows.append(np.repeat(m, L + 1))
+            cols.append(np.append(x, payment))
+            data.append(np.append(np.repeat(-sign * b_.unitcost, L), 1))
+            b_ub.append([0])
+            m += 1
+
+            n += L + 1 + n_keep
+
+    columns = np.concatenate(blocks) if blocks else np.zeros(0, dtype=COLUMN_DTYPE)
+    return assemble_wdp(columns, lb, ub, rows, cols, data, b_ub, m, M, budgetbalanced)
+
+
+def book_wdp(book, M, budgetbalanced=False):
+    """
+    Builds the WDP of `build_wdp` with the `compact` formulation straight
+    from the arrays of a BidBook, with the same columns and rows
+
+    Parameters
+    -----------
+    book : BidBook
+    M : int
+        Number of timeslots
+    budgetbalanced : bool
+
+    Returns
+    --------
+    SparseWDP
+    """
+    P = book.type.shape[0]
+    bundle = book.type == BUNDLE
+    selling = book.type == SELLING
+    L = np.diff(book.offsets)
+    owner = book.owner
+
+    # Quantities, payment, mu and lambda of each piece
+    size = L + 1 + np.where(selling, L + 1, 0)
+    first = np.cumsum(size) - size
+    n = int(size.sum())
+    piece = np.repeat(np.arange(P), size)
+    pos = ragged_arange(size)
+    L_ = L[piece]
+    isbuying = book.isbuying[piece]
+    is_x = pos < L_
+    is_payment = pos == L_
+    is_mu = (pos > L_) & (pos <= 2 * L_)
+
+    columns = np.zeros(n, dtype=COLUMN_DTYPE)
+    columns["bid"] = owner[piece]
+    columns["uid"] = book.uids[owner][piece]
+    columns["piece"] = (np.arange(P) - book.bid_offsets[owner])[piece]
+    columns["type"] = np.array(["bundle", "single", "sellingbundle"])[book.type][piece]
+    columns["timeslot"] = np.where(is_x, book.start[piece] + pos,
+                                   np.where(is_mu, book.start[piece] + pos - L_ - 1, -1))
+    columns["kind"] = np.where(is_x, np.where(isbuying, "buy", "sell"),
+                               np.where(is_payment, "payment", "keep"))
+    columns["unitcost"] = book.unitcost[piece]
+
+    x = np.flatnonzero(is_x)
+    lb = np.where(is_payment & ~isbuying, -np.inf, 0.0)
+    ub = np.where(is_payment & ~isbuying, 0.0, np.inf)
+    ub[x] = book.values[book.offsets[piece[x]] + pos[x]]
+
+    # Rows of each piece: the total of a bundle, the quantity to keep of
+    # a selling bundle and the individual rationality
+    n_rows = bundle + np.where(selling, L + 1, 0) + 1
+    row = np.cumsum(n_rows) - n_rows
+    m = int(n_rows.sum())
+    b_ub = np.zeros(m)
+    rows, cols, data = [], [], []
+
+    x_bundle = x[bundle[piece[x]]]
+    rows.append(row[piece[x_bundle]])
+    cols.append(x_bundle)
+    data.append(np.ones(x_bundle.shape[0]))
+    b_ub[row[bundle]] = book.quantity[bundle]
+
+    # -mu_t - x_t - lambda <= kq_t - q_t
+    x_sell = x[selling[piece[x]]]
+    p_sell = piece[x_sell]
+    t_sell = pos[x_sell]
+    mu = x_sell + L[p_sell] + 1
+    lambda_ = first[p_sell] + 2 * L[p_sell] + 1
+    r_ = row[p_sell] + t_sell
+    rows.extend([r_, r_, r_])
+    cols.extend([mu, x_sell, lambda_])
+    data.extend([-np.ones(r_.shape[0])] * 3)
+    v = book.offsets[p_sell] + t_sell
+    b_ub[r_] = book.keep_values[v] - book.values[v]
+    # K * lambda + sum_t mu_t + sum_t x_t <= sum_t q_t - keep
+    s_ = np.flatnonzero(selling)
+    r_ = row[s_] + L[s_]
+    r_x = r_[np.searchsorted(s_, p_sell)]
+    rows.extend([r_x, r_x, r_])
+    cols.extend([mu, x_sell, first[s_] + 2 * L[s_] + 1])
+    data.extend([np.ones(x_sell.shape[0])] * 2 + [book.threshold[s_] - 1.0])
+    q = [book.values[book.offsets[i]: book.offsets[i + 1]].sum() for i in s_]
+    b_ub[r_] = np.asarray(q, dtype=float) - book.keep[s_]
+
+    # Individual rationality, payment <= +-unitcost * sum_t x_t
+    r_ = row + n_rows - 1
+    sign = np.where(book.isbuying, 1.0, -1.0)
+    rows.extend([r_[piece[x]], r_])
+    cols.extend([x, first + L])
+    data.extend([-(sign * book.unitcost)[piece[x]], np.ones(P)])
+
+    return assemble_wdp(columns, [lb], [ub], rows, cols, data, [b_ub], m, M, budgetbalanced)
+
+
+def assemble_wdp(columns, lb, ub, rows, cols, data, b_ub, m, M, budgetbalanced):
+    """
+    Adds the balance of every timeslot and the budget balance to the
+    rows of the pieces, given as lists of arrays, and builds the
+    SparseWDP
+    """
+    n = columns.shape[0]
+    is_buy = columns["kind"] == "buy"
+    is_sell = columns["kind"] == "sell"
+    is_payment = np.flatnonzero(columns["kind"] == "payment")
+
+    c = np.where(is_buy, -columns["unitcost"], 0) + np.where(is_sell, columns["unitcost"], 0)
+
+    # Selling and buying should be the same for all timeslots
+    quantity = np.flatnonzero((is_buy | is_sell) & (columns["timeslot"] < M))
+    eq_rows = [columns["timeslot"][quantity]]
+    eq_cols = [quantity]
+    eq_data = [np.where(is_buy[quantity], 1.0, -1.0)]
+    b_eq = np.zeros(M)
+
+    # Weakly budget balanced payments
+    if budgetbalanced:
+        eq_rows.append(np.repeat(M, is_payment.shape[0]))
+        eq_cols.append(is_payment)
+        eq_data.append(np.ones(is_payment.shape[0]))
+        b_eq = np.zeros(M + 1)
+    else:
+        rows.append(np.repeat(m, is_payment.shape[0]))
+        cols.append(is_payment)
+        data.append(-np.ones(is_payment.shape[0]))
+        b_ub.append([0])
+        m += 1
+
+    A_ub = sp.coo_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(m, n),
+    ).tocsr()
+    A_eq = sp.coo_matrix(
+        (np.concatenate(eq_data), (np.concatenate(eq_rows), np.concatenate(eq_cols))),
+        shape=(b_eq.shape[0], n),
+    ).tocsr()
+    lp = LinearProgram(
+        c,
+        A_ub,
+        np.concatenate(b_ub).astype(float),
+        A_eq,
+        b_eq,
+        np.concatenate(lb).astype(float) if lb else np.zeros(0),
+        np.concatenate(ub).astype(float) if ub else np.zeros(0),
+    )
+    return SparseWDP(lp, columns, M)
+
+
+def append_bid(model, bid, budget_row, budgetbalanced=False, keepable='compact'):
+    """
+    Adds the columns and rows of a bid to a model of `build_wdp`, after
+    the existing ones. The payments of the bid join the budget balance,
+    which is the row `budget_row` of `A_ub`, or the last row of `A_eq`
+    if `budgetbalanced`.
+
+    Returns
+    --------
+    SparseWDP
+    """
+    lp, columns, M = model
+    new = build_wdp([bid], M, budgetbalanced, keepable)
+    n, k = columns.shape[0], new.columns.shape[0]
+    block = new.columns.copy()
+    block["bid"] = columns["bid"].max() + 1 if n > 0 else 0
+
+    A_ub, b_ub = new.lp.A_ub, new.lp.b_ub
+    joined = sp.csr_matrix((lp.A_ub.shape[0], k))
+    if not budgetbalanced:
+        # The last row of the bid is its own budget balance
+        budget = A_ub[-1].tocoo()
+        joined = sp.coo_matrix(
+            (budget.data, (np.repeat(budget_row, budget.nnz), budget.col)), shape=joined.shape
+        ).tocsr()
+        A_ub, b_ub = A_ub[:-1], b_ub[:-1]
+
+    lp = LinearProgram(
+        np.concatenate([lp.c, new.lp.c]),
+        sp.bmat([[lp.A_ub, joined], [None, A_ub]], format="csr")
+        if A_ub.shape[0] > 0 else sp.hstack([lp.A_ub, joined], format="csr"),
+        np.concatenate([lp.b_ub, b_ub]),
+        sp.hstack([lp.A_eq, new.lp.A_eq], format="csr"),
+        lp.b_eq,
+        np.concatenate([lp.lb, new.lp.lb]),
+        np.concatenate([lp.ub, new.lp.ub]),
+    )
+    return SparseWDP(lp, np.concatenate([columns, block]), M)
+
+
+def components(columns, M):
+    """
+    Splits the columns into the groups of bids that are connected through
+    the balance constraints, i.e. whose pieces share a timeslot directly
+    or through other bids.
+
+    Returns
+    --------
+    list of np.ndarray
+        The columns of each group, sorted by their first bid
+    """
+    if columns.shape[0] == 0:
+        return []
+    n_bids = columns["bid"].max() + 1
+    quantity = np.isin(columns["kind"], ["buy", "sell"]) & (columns["timeslot"] >= 0) & (columns["timeslot"] < M)
+    # Bipartite graph of the bids and the timeslots they trade in
+    graph = sp.coo_matrix(
+        (
+            np.ones(np.count_nonzero(quantity)),
+            (columns["bid"][quantity], n_bids + columns["timeslot"][quantity]),
+        ),
+        shape=(n_bids + M, n_bids + M),
+    )
+    _, labels = connected_components(graph, directed=False)
+    block = labels[columns["bid"]]
+    _, first = np.unique(block, return_index=True)
+    return [np.flatnonzero(block == block[k]) for k in np.sort(first)]
+
+
+def sub_lp(lp, cols):
+    """
+    The problem restricted to the columns `cols`, with the rows that have
+    coefficients on them. A row shared with other columns, such as the
+    budget balance, only keeps the terms of `cols`.
+    """
+    A_ub = lp.A_ub[:, cols]
+    A_eq = lp.A_eq[:, cols]
+    rows = np.flatnonzero(A_ub.getnnz(axis=1))
+    eq_rows = np.flatnonzero(A_eq.getnnz(axis=1))
+    return LinearProgram(
+        lp.c[cols],
+        A_ub[rows],
+        lp.b_ub[rows],
+        A_eq[eq_rows],
+        lp.b_eq[eq_rows],
+        lp.lb[cols],
+        lp.ub[cols],
+    )
+
+
+def presolve(model):
+    """
+    Removes the quantities that cannot trade in an optimal solution:
+
+    - Buying quantities with a unit cost below every selling one in the
+      same timeslot, and selling quantities with a unit cost above every
+      buying one. Reducing both sides of such a trade increases the
+      welfare and keeps the solution feasible. This includes the
+      timeslots with only buyers or only sellers.
+    - Quantities whose upper bound is already zero, e.g. after
+      `restrict_to_prices`.
+
+    The rules are applied until nothing else is removed. The payments of
+    the pieces without quantities left, which can be zero, are removed too,
+    and so are the rows left without coefficients. The upper bound of the
+    remaining quantities is tightened to the total upper bound of the
+    other side in their timeslot.
+
+    Parameters
+    -----------
+    model : SparseWDP
+
+    Returns
+    --------
+    Presolve
+    """
+    lp, columns, M = model
+    if columns.shape[0] == 0:
+        return Presolve(model, np.arange(0), np.arange(lp.A_eq.shape[0]))
+    kind = columns["kind"]
+    is_buy = kind == "buy"
+    is_sell = kind == "sell"
+    quantity = (is_buy | is_sell) & (columns["timeslot"] >= 0) & (columns["timeslot"] < M)
+    slots = np.where(quantity, columns["timeslot"], 0)
+    unitcost = columns["unitcost"]
+    ub = lp.ub.copy()
+
+    while True:
+        live = quantity & (ub > 0)
+        max_b = np.full(M, -np.inf)
+        np.maximum.at(max_b, slots[live & is_buy], unitcost[live & is_buy])
+        min_s = np.full(M, np.inf)
+        np.minimum.at(min_s, slots[live & is_sell], unitcost[live & is_sell])
+        dominated = live & (
+            (is_buy & (unitcost < min_s[slots])) | (is_sell & (unitcost > max_b[slots]))
+        )
+        if not dominated.any():
+            break
+        ub[dominated] = 0
+
+    # The quantity of a side in a timeslot is at most what the other side offers
+    live = quantity & (ub > 0)
+    offered_b = np.bincount(slots[live & is_buy], weights=ub[live & is_buy], minlength=M)
+    offered_s = np.bincount(slots[live & is_sell], weights=ub[live & is_sell], minlength=M)
+    ub[live & is_buy] = np.minimum(ub[live & is_buy], offered_s[slots[live & is_buy]])
+    ub[live & is_sell] = np.minimum(ub[live & is_sell], offered_b[slots[live & is_sell]])
+
+    # Pieces that can still trade
+    _, piece = np.unique(columns["bid"] * (columns["piece"].max() + 1) + columns["piece"], return_inverse=True)
+    trades = np.bincount(piece[live], minlength=piece.max() + 1) > 0
+    removed = (quantity & ~live) | ((kind == "payment") & ~trades[piece])
+    cols = np.flatnonzero(~removed)
+
+    A_ub = lp.A_ub[:, cols]
+    A_eq = lp.A_eq[:, cols]
+    rows = np.flatnonzero(A_ub.getnnz(axis=1))
+    eq_rows = np.flatnonzero(A_eq.getnnz(axis=1))
+    reduced = LinearProgram(
+        lp.c[cols],
+        A_ub[rows],
+        lp.b_ub[rows],
+        A_eq[eq_rows],
+        lp.b_eq[eq_rows],
+        lp.lb[cols],
+        ub[cols],
+    )
+    return Presolve(SparseWDP(reduced, columns[cols], M), cols, eq_rows)
+
+
+def column_names(columns):
+    """
+    Names that the PuLP model of `lemsim.wdp` gives to each column
+    """
+    names = []
+    for col in columns:
+        if col["kind"] == "payment":
+            names.append("payment_{0}_{1}_{2}".format(col["type"], col["uid"], col["piece"]))
+        elif col["kind"] == "keep" and col["timeslot"] == -1:
+            names.append("keep_lambda_{0}_{1}".format(col["piece"], col["uid"]))
+        elif col["kind"] == "keep":
+            names.append("keep_mu_{0}_{1}_{2}".format(col["timeslot"], col["piece"], col["uid"]))
+        elif col["type"] == "single":
+            names.append("x_single_{0}_{1}".format(col["timeslot"], col["uid"]))
+        else:
+            names.append("x_{0}_{1}_{2}_{3}".format(col["type"], col["timeslot"], col["piece"], col["uid"]))
+    return names
+
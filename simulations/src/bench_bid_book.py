@@ -0,0 +1,59 @@
+"""
+Time to build the WDP of N bidders from a list of `Bid`, from the views
+of a `BidBook` and from the arrays of the same BidBook (see
+`lemsim.wdp_matrix.book_wdp`), which give the same problem.
+"""
+import os, sys, inspect
+import time
+
+import numpy as np
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(os.path.dirname(currentdir))
+sys.path.insert(0, parentdir)
+
+from lemsim.bid_book import BidBook
+from lemsim.lp_with_reg import solve_bat
+from lemsim.utils import create_bid
+from lemsim.wdp_matrix import build_wdp
+
+SIZES = [50, 150, 500]
+T = 24
+REPEATS = 5
+
+
+def random_bids(N, r):
+    bids = []
+    for uid in range(N):
+        load = r.uniform(-1.5, 1.5, T)
+        pb = r.choice([12.0, 16.0], T)
+        ps = r.uniform(5, 10, T)
+        _, _, sol, _ = solve_bat(load, pb, ps, 0, 2, 0, 0.95, 0.95, 1, -1)
+        bat = np.where(sol > 0, sol / 0.95, sol * 0.95)
+        bd, status = create_bid(uid, load, bat, pb, ps, 1, 1)
+        if status:
+            bids.append(bd)
+    return bids
+
+
+def build_time(bids):
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        model = build_wdp(bids, T)
+    return model, (time.perf_counter() - start) / REPEATS
+
+
+if __name__ == '__main__':
+    r = np.random.RandomState(0)
+    header = '{0:>5} {1:>8} {2:>10} {3:>10} {4:>10}'
+    print(header.format('N', 'columns', 'bids(s)', 'views(s)', 'book(s)'))
+    for N in SIZES:
+        bids = random_bids(N, r)
+        book = BidBook.from_bids(bids)
+        model, t_bids = build_time(bids)
+        _, t_views = build_time(book.bids)
+        model_book, t_book = build_time(book)
+        assert np.array_equal(model.columns, model_book.columns)
+        assert (model.lp.A_ub != model_book.lp.A_ub).nnz == 0
+        print(header.format(N, model.columns.shape[0], '{0:.4f}'.format(t_bids),
+                            '{0:.4f}'.format(t_views), '{0:.4f}'.format(t_book)))
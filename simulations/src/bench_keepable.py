@@ -0,0 +1,69 @@
+"""
+Size and build time of the WDP of a single selling bundle with the
+`enumerate` and `compact` formulations of the quantity to keep, against
+the length L of the bundle.
+
+The quantity to keep is half of what can be kept, so the number of
+subsets enumerated is close to the worst case. The enumeration is
+skipped when it would have more than MAX_ROWS constraints.
+"""
+import os, sys, inspect
+import time
+from math import comb
+
+import numpy as np
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(os.path.dirname(currentdir))
+sys.path.insert(0, parentdir)
+
+from lemsim.bid import Bid
+from lemsim.wdp import WinnerDeterminationProblem
+
+LENGTHS = [4, 8, 12, 16, 20, 24, 32, 40, 48]
+MAX_ROWS = 200000
+
+
+def bundle_bids(L, r):
+    q = r.uniform(0.5, 1.5, L)
+    seller = Bid(0)
+    seller.add_bundle_selling(0, L - 1, q, q.sum() / 2, 8.0)
+    buyer = Bid(1)
+    buyer.add_bundle(0, L - 1, q.sum(), 14.0, True, upper_bound=q)
+    return [seller, buyer]
+
+
+def build(bids, L, builder, keepable):
+    wdp = WinnerDeterminationProblem(L, builder=builder, keepable=keepable)
+    [wdp.add_bid(bd) for bd in bids]
+    start = time.perf_counter()
+    model = wdp.build_problem()
+    elapsed = time.perf_counter() - start
+    if builder == 'matrix':
+        rows = model.lp.A_ub.shape[0] + model.lp.A_eq.shape[0]
+        nnz = model.lp.A_ub.nnz + model.lp.A_eq.nnz
+    else:
+        rows = len(model.constraints)
+        nnz = sum(len(c) for c in model.constraints.values())
+    return wdp, rows, nnz, elapsed
+
+
+if __name__ == '__main__':
+    r = np.random.RandomState(0)
+    header = '{0:>3} {1:>4} {2:>10} {3:>14} {4:>10} {5:>10} {6:>9}'
+    print(header.format('L', 'K', 'formul.', 'builder', 'rows', 'nnz', 'build(s)'))
+    for L in LENGTHS:
+        bids = bundle_bids(L, r)
+        K = bids[0].sellingbundles[0].threshold - 1
+        enumerated = sum(comb(L, k) for k in range(K + 1))
+        objectives = {}
+        for keepable in ['enumerate', 'compact']:
+            for builder in ['pulp', 'matrix']:
+                if keepable == 'enumerate' and enumerated > MAX_ROWS:
+                    print(header.format(L, K, keepable, builder, enumerated, '-', 'skipped'))
+                    continue
+                wdp, rows, nnz, elapsed = build(bids, L, builder, keepable)
+                objectives[(keepable, builder)] = wdp.solve()[1]
+                print(header.format(L, K, keepable, builder, rows, nnz, '{0:.4f}'.format(elapsed)))
+        values = list(objectives.values())
+        assert np.allclose(values, values[0]), objectives
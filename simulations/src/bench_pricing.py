@@ -0,0 +1,54 @@
+"""
+Runtime and costs of the two pricing rules of the WDP, `alphabeta` with
+the default a=0, b=1 and `duals`, on the bid books of the tests:
+`generate_bids` of `tests/test_wdp.py` for several seeds and sizes.
+
+For each book, prints the time to solve and to get the prices with each
+rule, the sum of the costs (what the buyers pay minus what the sellers
+receive) and the largest difference between the costs of a bidder with
+the two rules.
+"""
+import os, sys, inspect
+import time
+
+import numpy as np
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(os.path.dirname(currentdir))
+sys.path.insert(0, parentdir)
+sys.path.insert(0, os.path.join(parentdir, 'tests'))
+
+from lemsim.wdp import WinnerDeterminationProblem
+from test_wdp import generate_bids
+
+BOOKS = [(seed, N) for N in [8, 32, 128] for seed in range(3)]
+REPEAT = 20
+
+
+def run(bids, T, pricing):
+    wdp = WinnerDeterminationProblem(T, pricing=pricing)
+    [wdp.add_bid(bd) for bd in bids]
+    wdp.build_problem()
+    start = time.perf_counter()
+    wdp.solve()
+    solve = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        prices = wdp.get_prices()
+    elapsed = (time.perf_counter() - start) / REPEAT
+    return wdp.get_costs(), solve, elapsed
+
+
+if __name__ == '__main__':
+    header = '{0:>4} {1:>4} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10} {7:>10} {8:>9}'
+    print(header.format('seed', 'N', 'solve ab', 'solve dual', 'price ab', 'price dual',
+                        'budget ab', 'budget dual', 'max diff'))
+    for seed, N in BOOKS:
+        T, bids = generate_bids(seed, N=N)
+        costs_ab, solve_ab, time_ab = run(bids, T, 'alphabeta')
+        costs_d, solve_d, time_d = run(bids, T, 'duals')
+        diff = max(abs(costs_ab[k] - costs_d[k]) for k in set(costs_ab) | set(costs_d))
+        print(header.format(seed, N, '{0:.4f}'.format(solve_ab), '{0:.4f}'.format(solve_d),
+                            '{0:.6f}'.format(time_ab), '{0:.6f}'.format(time_d),
+                            '{0:.3f}'.format(sum(costs_ab.values())), '{0:.3f}'.format(sum(costs_d.values())),
+                            '{0:.3f}'.format(diff)))
@@ -0,0 +1,55 @@
+import pytest
+
+import numpy as np
+from lemsim.bid import Bid, intervals_intercept
+
+
+def naive_intercept(s1, e1, s2, e2):
+    return len(set(range(s1, e1 + 1)) & set(range(s2, e2 + 1))) > 0
+
+
+def naive_consistent(bid, kind, start, end, isbuying):
+    """
+    Consistency of a new piece checked against every piece of the bid
+    """
+    slots = set(range(start, end + 1))
+    for b in bid.bundles + bid.sellingbundles:
+        if kind != 'single' and naive_intercept(b.start, b.end, start, end):
+            return False
+        if kind == 'single' and start in range(b.start, b.end + 1):
+            side = b.isbuying if b.type == 'simplebundle' else False
+            if side != isbuying:
+                return False
+    for s in bid.singles:
+        if kind == 'single' and s.item == start:
+            return False
+        if kind != 'single' and s.item in slots and s.isbuying != isbuying:
+            return False
+    return True
+
+
+def test_intervals_intercept():
+    for s1, e1, s2, e2 in np.random.RandomState(0).randint(0, 12, (500, 4)):
+        assert intervals_intercept(s1, e1, s2, e2) == naive_intercept(s1, e1, s2, e2)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_add_pieces(seed):
+    r = np.random.RandomState(seed)
+    T = 48
+    bid = Bid(0)
+    for _ in range(300):
+        kind = r.choice(['bundle', 'single', 'selling'])
+        start = r.randint(T)
+        end = start if kind == 'single' else min(T - 1, start + r.randint(4))
+        isbuying = bool(r.rand() < 0.5) if kind != 'selling' else False
+        expected = naive_consistent(bid, kind, start, end, isbuying)
+        if kind == 'bundle':
+            added = bid.add_bundle(start, end, 1.0, 10.0, isbuying)
+        elif kind == 'single':
+            added = bid.add_single(start, 1.0, 10.0, isbuying)
+        else:
+            q = np.ones(end - start + 1)
+            added = bid.add_bundle_selling(start, end, q, 0.5, 10.0)
+        assert added == expected
+    assert len(bid.bundles + bid.singles + bid.sellingbundles) > 10
@@ -0,0 +1,135 @@
+import pytest
+
+import numpy as np
+from lemsim.bid import Bid
+from lemsim.bid_book import BidBook, BidView
+from lemsim.mechanism_variants import simple_split_mechanism
+from lemsim.wdp import WinnerDeterminationProblem, InvalidBid, check_bid
+from lemsim.wdp_matrix import build_wdp
+from tests.test_wdp import generate_bids
+
+FIELDS = {
+    'simplebundle': ['start', 'end', 'quantity', 'unitcost', 'isbuying', 'upper_bound'],
+    'singleitem': ['item', 'quantity', 'unitcost', 'isbuying'],
+    'sellingbundle': ['start', 'end', 'quantities', 'keep', 'unitcost', 'keep_quantities', 'threshold'],
+}
+
+
+def assert_same_bids(bids, views):
+    assert len(bids) == len(views)
+    for bd, view in zip(bids, views):
+        assert bd.uid == view.uid
+        for kind in ['bundles', 'singles', 'sellingbundles']:
+            pieces, pieces_ = getattr(bd, kind), getattr(view, kind)
+            assert len(pieces) == len(pieces_)
+            for x, x_ in zip(pieces, pieces_):
+                assert x.type == x_.type
+                for name in FIELDS[x.type]:
+                    assert np.array_equal(getattr(x, name), getattr(x_, name))
+
+
+def test_from_bids():
+    T, bids = generate_bids(0, N=12)
+    single = Bid('single')
+    single.add_single(3, 1.5, 14.0, True)
+    single.add_single(5, 0.5, 7.0, False)
+    bids.append(single)
+    book = BidBook.from_bids(bids, key='k')
+    assert len(book) == len(bids)
+    assert_same_bids(bids, book.bids)
+    assert all(isinstance(bd, BidView) for bd in book)
+    with pytest.raises(AttributeError):
+        book.bids[0].color = 'red'
+
+    # The views give the same problem
+    objectives = []
+    for bids_ in [bids, book.bids]:
+        wdp = WinnerDeterminationProblem(T)
+        [wdp.add_bid(bd) for bd in bids_]
+        wdp.build_problem()
+        objectives.append(wdp.solve()[1])
+        assert list(wdp.result.uids) == [str(bd.uid) for bd in bids]
+    assert np.isclose(*objectives)
+
+
+def test_save_load(tmp_path):
+    _, bids = generate_bids(1)
+    book = BidBook.from_bids(bids, key='abc')
+    book.save(str(tmp_path / 'book.npz'))
+    loaded = BidBook.load(str(tmp_path / 'book.npz'))
+    assert loaded.key == 'abc'
+    assert_same_bids(bids, loaded.bids)
+    assert all(type(u) is int for u in loaded.uids)
+
+
+def test_check():
+    T, bids = generate_bids(2)
+    late = Bid('late')
+    late.add_bundle(T - 2, T + 3, 1.0, 14.0, True)
+    bids.insert(2, late)
+    book = BidBook.from_bids(bids)
+    valid = []
+    for bd in bids:
+        try:
+            valid.append(check_bid(bd, T))
+        except InvalidBid:
+            valid.append(False)
+    assert list(book.check(T)) == valid
+    assert not all(valid)
+
+
+def assert_same_lp(a, b):
+    assert np.array_equal(a.columns, b.columns)
+    for name in ['c', 'b_ub', 'b_eq', 'lb', 'ub']:
+        assert np.array_equal(getattr(a.lp, name), getattr(b.lp, name))
+    for name in ['A_ub', 'A_eq']:
+        A, B = getattr(a.lp, name), getattr(b.lp, name)
+        assert A.shape == B.shape
+        for v in ['indptr', 'indices', 'data']:
+            assert np.array_equal(getattr(A, v), getattr(B, v))
+
+
+@pytest.mark.parametrize('budgetbalanced', [False, True])
+@pytest.mark.parametrize('keepable', ['compact', 'enumerate'])
+def test_book_wdp(budgetbalanced, keepable):
+    T, bids = generate_bids(3, N=12)
+    single = Bid('single')
+    single.add_single(3, 1.5, 14.0, True)
+    single.add_single(5, 0.5, 7.0, False)
+    bids.append(single)
+    book = BidBook.from_bids(bids)
+    assert_same_lp(build_wdp(bids, T, budgetbalanced, keepable),
+                   build_wdp(book, T, budgetbalanced, keepable))
+
+
+def test_take():
+    _, bids = generate_bids(4)
+    book = BidBook.from_bids(bids)
+    idx = [5, 0, 2]
+    assert_same_bids([bids[i] for i in idx], book.take(idx).bids)
+    assert len(book.take([])) == 0
+
+
+def test_add_book():
+    T, bids = generate_bids(2)
+    late = Bid('late')
+    late.add_bundle(T - 2, T + 3, 1.0, 14.0, True)
+    bids.insert(2, late)
+    book = BidBook.from_bids(bids)
+
+    wdp = WinnerDeterminationProblem(T)
+    [wdp.add_bid(bd) for bd in bids]
+    wdp.build_problem()
+    wdp_book = WinnerDeterminationProblem(T)
+    assert list(wdp_book.add_book(book)) == list(book.check(T))
+    wdp_book.build_problem()
+    assert wdp_book.book is not None
+    assert_same_lp(wdp.model, wdp_book.model)
+    assert np.isclose(wdp.solve()[1], wdp_book.solve()[1])
+
+    # Only the split of the bidders is drawn from the random state
+    _, result, costs = simple_split_mechanism(bids, np.random.RandomState(0), T=T)
+    _, result_book, costs_book = simple_split_mechanism(book, np.random.RandomState(0), T=T)
+    assert list(result.uids) == list(result_book.uids)
+    assert np.allclose(result.net, result_book.net)
+    assert costs.keys() == costs_book.keys()
@@ -47,3 +47,108 @@ def test_update(new_battery):
         bat.reset(0)
         res = bat.find_optimal_step(load, pb, ps, commitment={}, reg=False)
         assert np.allclose(res[1], results[i])
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_dp_engine_matches_lp(seed):
+    """
+    The dynamic programming engine finds the same optimal cost as the LP,
+    also when there are commitments
+    """
+    import lemsim.batterycontroller as lbat
+
+    r = np.random.RandomState(seed)
+    T = 24
+    load = r.uniform(-1, 2, T)
+    pb = r.choice([12.0, 14.0, 16.0], T)
+    ps = r.uniform(5, 10, T)
+    commitment = {t: load[t] + r.uniform(-0.5, 0.5) for t in range(0, T, 5)}
+
+    lp = lbat.BatteryController(0, 5, 0, 0.95, 0.9, 1.5, -2, engine='lp')
+    dp = lbat.BatteryController(0, 5, 0, 0.95, 0.9, 1.5, -2, engine='dp')
+    for bat in [lp, dp]:
+        bat.reset(2)
+
+    res_lp = lp.find_optimal_step(load, pb, ps, commitment)
+    res_dp = dp.find_optimal_step(load, pb, ps, commitment)
+    assert res_dp[0] == 'optimal'
+    assert np.allclose(res_lp[1], res_dp[1])
+
+    charge = 2 + np.cumsum(res_dp[2])
+    assert (charge >= -1e-9).all() and (charge <= 5 + 1e-9).all()
+    assert (res_dp[2] <= 1.5 + 1e-9).all() and (res_dp[2] >= -2 - 1e-9).all()
+
+
+def test_persistent_engine_receding_horizon():
+    """
+    Solving a shrinking horizon with the persistent model gives the
+    same optimal costs as building the LP from scratch at every step
+    """
+    import lemsim.batterycontroller as lbat
+
+    r = np.random.RandomState(3)
+    T = 24
+    load = r.uniform(-1, 2, T)
+    pb = r.choice([12.0, 14.0, 16.0], T)
+    ps = r.uniform(5, 10, T)
+
+    lp = lbat.BatteryController(0, 5, 0, 0.95, 0.9, 1.5, -2, engine='lp')
+    pers = lbat.BatteryController(0, 5, 0, 0.95, 0.9, 1.5, -2, engine='persistent')
+    for t in range(T):
+        commitment = {0: load[t] + 0.2} if t % 4 == 1 else {}
+        res_pers = pers.find_optimal_step(load[t:], pb[t:], ps[t:], commitment)
+        lp.charge = pers.charge
+        res_lp = lp.find_optimal_step(load[t:], pb[t:], ps[t:], commitment)
+        assert res_pers[2].shape[0] == T - t
+        assert np.allclose(res_lp[1], res_pers[1])
+        pers.update_charge(res_pers[2][0])
+
+
+@pytest.mark.parametrize('engine', ['lp', 'dp', 'persistent'])
+def test_infeasible_commitment(engine):
+    """
+    A commitment that the battery cannot meet is an error in every engine
+    """
+    import lemsim.batterycontroller as lbat
+
+    T = 6
+    load = np.ones(T)
+    pb = np.ones(T) * 14
+    ps = np.ones(T) * 8
+    bat = lbat.BatteryController(0, 5, 0, 0.95, 0.9, 1.5, -2, engine=engine)
+    # The persistent model has the solution of this solve to return
+    bat.find_optimal_step(load, pb, ps, {})
+    # Selling 5 in the first timeslot needs more than the battery has
+    with pytest.raises(ValueError):
+        bat.find_optimal_step(load, pb, ps, {0: -5})
+
+
+def test_find_optimal_steps_mixed_engines():
+    """
+    Each battery is solved with its own engine and backend
+    """
+    import lemsim.batterycontroller as lbat
+
+    r = np.random.RandomState(5)
+    T = 12
+    controllers, problems = [], []
+    for engine, backend in [('lp', 'highs'), ('dp', None), ('lp', 'cplex'), ('persistent', None), ('lp', 'highs')]:
+        bat = lbat.BatteryController(0, 5, 0, 0.95, 0.9, 1.5, -2, engine=engine, backend=backend)
+        bat.charge = r.uniform(0, 5)
+        controllers.append(bat)
+        problems.append((r.uniform(-1, 2, T), r.choice([12.0, 14.0, 16.0], T), r.uniform(5, 10, T), {}))
+    results = lbat.find_optimal_steps(controllers, problems)
+    for bat, problem, res in zip(controllers, problems, results):
+        expected = bat.find_optimal_step(*problem)
+        assert np.isclose(res[1], expected[1])
+        assert res[2].shape[0] == T
+
+
+@pytest.mark.parametrize('engine', ['dp', 'persistent'])
+def test_reg_needs_lp_engine(engine):
+    import lemsim.batterycontroller as lbat
+
+    T = 6
+    bat = lbat.BatteryController(0, 5, 0, 0.95, 0.9, 1.5, -2, engine=engine)
+    with pytest.raises(ValueError, match=engine):
+        bat.find_optimal_step(np.ones(T), np.ones(T) * 14, np.ones(T) * 8, {}, reg=True)
@@ -0,0 +1,77 @@
+import pytest
+
+import numpy as np
+from lemsim.lp_with_reg import solve_bat
+from lemsim.central_planner import solve_all
+from lemsim.solvers import BACKENDS
+
+FORMULATIONS = ['cumulative', 'state']
+
+
+@pytest.mark.parametrize('backend', list(BACKENDS))
+@pytest.mark.parametrize('formulation', FORMULATIONS)
+def test_solve_bat_basic(backend, formulation):
+    load = np.array([0, 1, 1])
+    pb = np.array([2, 10, 11])
+    ps = np.array([1, 1, 1])
+
+    status, value, sol, _ = solve_bat(load, pb, ps, 0, 3, 0, 1, 1, 1, -1,
+                                      formulation=formulation, backend=backend)
+    assert status == 'optimal'
+    assert np.allclose(value, 12)
+    assert np.allclose(sol, [1, 0, -1])
+
+
+@pytest.mark.parametrize('backend', list(BACKENDS))
+@pytest.mark.parametrize('formulation', FORMULATIONS)
+def test_solve_bat_commitments(backend, formulation):
+    r = np.random.RandomState(0)
+    T = 48
+    load = r.uniform(-1, 2, T)
+    pb = r.choice([12.0, 14.0, 16.0], T)
+    ps = r.uniform(5, 10, T)
+    commitments = {t: load[t] + 0.3 for t in range(0, T, 6)}
+
+    status, value, sol, _ = solve_bat(load, pb, ps, 2, 6, 0, 0.95, 0.95, 2, -2,
+                                      commitments, formulation=formulation, backend=backend)
+    assert status == 'optimal'
+    assert np.allclose(value, 388.4883437969735)
+
+    charge = 2 + np.cumsum(sol)
+    assert (charge > -1e-6).all() and (charge < 6 + 1e-6).all()
+
+
+@pytest.mark.parametrize('backend', list(BACKENDS))
+@pytest.mark.parametrize('formulation', FORMULATIONS)
+@pytest.mark.parametrize('d_max,expected', [(1, 0), (0.25, 1)])
+def test_solve_all(backend, formulation, d_max, expected):
+    loads = [np.array([-1.0, 0.0]), np.array([0.0, 1.0])]
+    pbs = [np.array([2.0, 2.0])] * 2
+    pss = [np.array([1.0, 1.0])] * 2
+
+    status, value, sol, _ = solve_all(loads, pbs, pss, [None, None], 0, 1, 0,
+                                      1, 1, d_max, -d_max, formulation=formulation, backend=backend)
+    assert status == 'optimal'
+    assert np.allclose(value, expected)
+
+
+def test_solve_bat_reg():
+    load = np.array([0, 1, 1])
+    pb = np.array([2, 10, 11])
+    ps = np.array([1, 1, 1])
+
+    # Without a backend the regularization is solved with docplex
+    status, value, sol, _ = solve_bat(load, pb, ps, 0, 3, 0, 1, 1, 1, -1, reg=True)
+    assert status == 'optimal'
+    assert np.allclose(value, 12, atol=1e-4)
+    assert np.allclose(sol, [1, 0, -1], atol=1e-4)
+    with pytest.raises(ValueError, match='highs'):
+        solve_bat(load, pb, ps, 0, 3, 0, 1, 1, 1, -1, reg=True, backend='highs')
+
+
+@pytest.mark.parametrize('backend', list(BACKENDS))
+def test_solve_bat_prices(backend):
+    load = np.array([0, 1, 1])
+    with pytest.raises(AssertionError):
+        solve_bat(load, np.array([2, 10, 11]), np.array([1, 12, 1]), 0, 3, 0, 1, 1, 1, -1,
+                  backend=backend)
@@ -222,7 +222,7 @@ def test_changing_days(new_prosumer_2):
     The data used is sampled every 15 minutes
 
     """
-    pro = lpro.Prosumer(*new_prosumer_2)
+    pro = lpro.Prosumer(*new_prosumer_2, backend='cplex')
 
     profile = np.array([2, 0, 2, 0])
     assert np.allclose(pro.get_profile_only_battery(0), profile)
@@ -259,6 +259,8 @@ def test_changing_days(new_prosumer_2):
     pro.finish_day()
     pro.new_day(pb, ps, load)
 
+    # With unit efficiencies several profiles are optimal, this is
+    # the one found by CPLEX
     new_profile = np.array([1, 1, 3, 0])
     assert np.allclose(pro.get_profile_only_battery(1), new_profile)
     assert np.allclose(pro.charge, 0)
@@ -284,3 +286,114 @@ def test_changing_days(new_prosumer_2):
 
     assert np.allclose(pro.get_final_cost(0), 6)
     assert np.allclose(pro.get_final_cost(1), 10)
+
+
+def test_batch(new_prosumer_1, new_prosumer_2):
+    """
+    Solving the problems of all the prosumers in a single LP gives
+    the same bids and actions as solving them one by one
+    """
+    pro_1 = lpro.Prosumer(*new_prosumer_1)
+    pro_2 = lpro.Prosumer(*new_prosumer_2)
+    prosumers = [pro_1, pro_2]
+
+    b1, b2 = lpro.get_bids(prosumers, 'long')
+    assert np.allclose([[1, 2, True]], b1)
+    assert np.allclose([[2, 2, True], [4, 1, True]], b2)
+
+    charges_1 = [1, 1, 0]
+    charges_2 = [1, 0, 1, 0]
+    for t in range(4):
+        active = [p for p in prosumers if p.time < p.T]
+        lpro.take_actions(active)
+        if t < 3:
+            assert np.allclose(pro_1.charge, charges_1[t])
+        assert np.allclose(pro_2.charge, charges_2[t])
+        for p in active:
+            p.move_forward()
+
+    assert np.allclose(pro_1.get_final_cost(0), 12)
+    assert np.allclose(pro_2.get_final_cost(0), 6)
+
+
+def test_add_commitments(new_prosumer_1):
+    pro = lpro.Prosumer(*new_prosumer_1)
+    other = lpro.Prosumer(*new_prosumer_1)
+    quantities = np.array([0.5, 1e-6, -0.3])
+    pro.add_commitments(quantities)
+    for t, q in enumerate(quantities):
+        other.add_commitment(t, q)
+    assert pro.commitments == other.commitments
+    assert pro.commitments[1] is None
+
+
+@pytest.mark.parametrize('engine', ['lp', 'dp'])
+def test_parametric_long_bid(engine):
+    T = 24
+    checked = 0
+    for seed in range(10):
+        r = np.random.RandomState(seed)
+        pb = r.choice([12.0, 14.0, 16.0, 20.0], T)
+        ps = r.uniform(5, 10, T)
+        p = lpro.Prosumer(0, 2, 0, 0.95, 0.95, 1, -1, pb, ps, r.uniform(-1.5, 1.5, T), engine=engine)
+        p.time = r.randint(T - 3)
+        p.charge = r.uniform(0, 2)
+        bids = p.get_bid('long')
+        p.curve = 'parametric'
+        bids_ = p.get_bid('long')
+        assert len(bids) == len(bids_)
+        for (q, price, buying), (q_, price_, buying_) in zip(bids, bids_):
+            assert np.isclose(q, q_) and price == price_ and buying == buying_
+        checked += len(bids) > 1
+    assert checked > 0
+
+
+@pytest.mark.parametrize('engine', ['lp', 'dp'])
+def test_full_foresight(engine):
+    T = 24
+    for seed in range(5):
+        r = np.random.RandomState(seed)
+        pb = r.choice([12.0, 14.0, 16.0, 20.0], T)
+        ps = r.uniform(5, 10, T)
+        load = r.uniform(-1.5, 1.5, T)
+        profiles = []
+        for foresight in ['stepwise', 'full']:
+            p = lpro.Prosumer(0, 2, 0, 0.95, 0.95, 1, -1, pb, ps, load, engine=engine, foresight=foresight)
+            p.time = 5
+            profiles.append(p.get_profile_only_battery(0))
+            assert p.time == 5
+        stepwise, full = profiles
+        # The linear program can break the ties in another way
+        cost = [np.maximum(pb * a, ps * a).sum() for a in profiles]
+        assert np.isclose(*cost)
+        if engine == 'dp':
+            assert np.allclose(stepwise, full)
+    assert lpro.Prosumer(0, 2, 0, 0.95, 0.95, 1, -1, pb, ps, load, engine=engine).full_foresight() == (engine == 'dp')
+
+
+def test_action_pool_errors():
+    T = 6
+    r = np.random.RandomState(0)
+    pb = r.choice([12.0, 14.0, 16.0], T)
+    ps = r.uniform(5, 10, T)
+    prosumers = [lpro.Prosumer(n, 2, 0, 0.95, 0.95, 1, -1, pb, ps, r.uniform(-1.5, 1.5, T))
+                 for n in range(4)]
+
+    # The battery cannot sell 10 in one timeslot
+    prosumers[3].add_commitment(0, -10)
+    pool = lpro.ActionPool(2)
+    pool.load(prosumers)
+    with pytest.raises(RuntimeError, match='prosumer 3'):
+        pool.step()
+    assert pool.processes == []
+    pool.close()
+
+    prosumers[3].add_commitment(0, 0)
+    pool = lpro.ActionPool(2)
+    pool.load(prosumers)
+    process = pool.processes[1]
+    process.terminate()
+    process.join()
+    with pytest.raises(RuntimeError, match='Action process 1'):
+        pool.step()
+    assert pool.processes == [] and not process.is_alive()
@@ -3,6 +3,7 @@ import numpy as np
 from lemsim.core import MainSim
 import lemsim.prosumer as lpro
 import lemsim.broker as lbro
+from lemsim.bid_book import BidBookStore, build_bid_book
 
 
 def test_simple_simulation():
@@ -94,3 +95,89 @@ def test_simple_simulation():
                                          (12, 0, 0),
                                          (13, -1.0, -2.7)]
 
+
+
+@pytest.mark.parametrize('signaling', ['none', 'ismarket'])
+def test_shared_bid_books(signaling, tmp_path):
+    T = 24
+    r = np.random.RandomState(0)
+    pb = np.where(np.arange(T) % 6 < 3, 16.0, 12.0)
+    ps = np.ones(T) * 8.0
+    prosumers = [lpro.Prosumer(n, 2, 0, 0.95, 0.95, 1, -1, pb, ps, r.uniform(-1.5, 1.5, T))
+                 for n in range(6)]
+    brokers = [lbro.ProsumerBroker(pro) for pro in prosumers]
+
+    store = BidBookStore(str(tmp_path))
+    results = []
+    for market_type in ['combflex', 'combflex_vcg']:
+        sim = MainSim(brokers, pre_trade='yes', bid_type='flexible', signaling=signaling,
+                      market_type=market_type, bid_books=store)
+        bid_list, _, _, _, _ = sim.sim_comb_trade()
+        results.append(bid_list)
+    assert (store.hits, store.misses) == (1, 1)
+    assert len(results[0]) > 0 and results[0] is results[1]
+
+    # Same bids as building them for this simulation alone, also from disk
+    book = build_bid_book([b.prosumer for b in brokers], signaling == 'ismarket')
+    loaded = BidBookStore(str(tmp_path)).get([b.prosumer for b in brokers], signaling == 'ismarket')
+    assert book.key == loaded.key
+    for bids in [book.bids, loaded.bids]:
+        assert [bd.uid for bd in bids] == [bd.uid for bd in results[0]]
+        for bd, bd_ in zip(bids, results[0]):
+            for kind in ['bundles', 'singles', 'sellingbundles']:
+                pieces, pieces_ = getattr(bd, kind), getattr(bd_, kind)
+                assert len(pieces) == len(pieces_)
+                for x, x_ in zip(pieces, pieces_):
+                    assert x.type == x_.type and x.unitcost == x_.unitcost
+
+
+@pytest.mark.parametrize('bid_type', ['short', 'long'])
+def test_parallel_bids(bid_type):
+    T = 12
+    r = np.random.RandomState(1)
+    pb = np.where(np.arange(T) % 4 < 2, 16.0, 12.0)
+    ps = np.ones(T) * 8.0
+    prosumers = [lpro.Prosumer(n, 2, 0, 0.95, 0.95, 1, -1, pb, ps, r.uniform(-1.5, 1.5, T))
+                 for n in range(8)]
+    brokers = [lbro.ProsumerBroker(pro) for pro in prosumers]
+
+    sims = []
+    for bid_workers in [None, 2]:
+        sim = MainSim(brokers, randomstate=np.random.RandomState(0), bid_type=bid_type,
+                      market_type='muda', bid_workers=bid_workers)
+        sim.simulate_day()
+        assert (sim.bid_pool is not None) == (bid_workers is not None)
+        sim.close()
+        assert sim.bid_pool is None
+        sims.append(sim)
+    for b, b_ in zip(*[sim.brokers for sim in sims]):
+        assert np.array_equal(b.prosumer.net_demand, b_.prosumer.net_demand)
+        assert b.prosumer.commitments == b_.prosumer.commitments
+        assert b.prosumer.extra_cost == b_.prosumer.extra_cost
+
+
+def test_parallel_actions():
+    T = 12
+    r = np.random.RandomState(2)
+    pb = np.where(np.arange(T) % 4 < 2, 16.0, 12.0)
+    ps = np.ones(T) * 8.0
+    prosumers = [lpro.Prosumer(n, 2, 0, 0.95, 0.95, 1, -1, pb, ps, r.uniform(-1.5, 1.5, T))
+                 for n in range(7)]
+    brokers = [lbro.ProsumerBroker(pro) for pro in prosumers]
+
+    sims = []
+    for action_workers in [None, 3]:
+        sim = MainSim(brokers, pre_trade='yes', bid_type='flexible', signaling='none',
+                      market_type='combflex', action_workers=action_workers)
+        sim.simulate_day()
+        sim.close()
+        assert sim.action_pool is None
+        sims.append(sim)
+    for b, b_ in zip(*[sim.brokers for sim in sims]):
+        p, p_ = b.prosumer, b_.prosumer
+        assert p.charge == p_.charge
+        assert np.array_equal(p.register[0]['net_demand'], p_.register[0]['net_demand'])
+        course, course_ = p.register[0]['initial_course'], p_.register[0]['initial_course']
+        assert sorted(course) == sorted(course_) == list(range(T))
+        for t in course:
+            assert np.array_equal(course[t][2], course_[t][2])
@@ -0,0 +1,169 @@
+import os
+import pytest
+
+import numpy as np
+import pulp as plp
+import scipy.sparse as sp
+from lemsim.solvers import LinearProgram, get_backend, BACKENDS
+from lemsim.lp_with_reg import solve_bat
+from lemsim.utils import create_bid
+from lemsim.wdp import WinnerDeterminationProblem
+
+PULP_BACKENDS = ['highs', 'cbc']
+if plp.CPLEX_CMD(path=os.environ.get('CPLEXPATH', None)).available():
+    PULP_BACKENDS.append('cplex')
+
+
+@pytest.fixture
+def small_lp():
+    """
+    min -x - 2y s.t. x + y <= 4, x - y == 1, 0 <= x <= 3, 0 <= y <= 10
+    """
+    return LinearProgram(
+        np.array([-1.0, -2.0]),
+        sp.csr_matrix([[1.0, 1.0]]),
+        np.array([4.0]),
+        sp.csr_matrix([[1.0, -1.0]]),
+        np.array([1.0]),
+        np.array([0.0, 0.0]),
+        np.array([3.0, 10.0]),
+    )
+
+
+@pytest.fixture
+def bids():
+    r = np.random.RandomState(3)
+    T = 8
+    bids = []
+    for uid in range(6):
+        load = r.uniform(-1, 1, T)
+        pb = r.choice([12.0, 16.0], T)
+        ps = r.uniform(5, 10, T)
+        _, _, sol, _ = solve_bat(load, pb, ps, 0, 2, 0, 0.95, 0.95, 1, -1)
+        bat = np.where(sol > 0, sol / 0.95, sol * 0.95)
+        bd, status = create_bid(uid, load, bat, pb, ps, 1, 1)
+        if status:
+            bids.append(bd)
+    return T, bids
+
+
+@pytest.mark.parametrize('backend', list(BACKENDS))
+def test_solve_lp(small_lp, backend):
+    status, objective, x, _ = get_backend(backend).solve_lp(small_lp)
+    assert status == 'optimal'
+    assert np.allclose(objective, -5.5)
+    assert np.allclose(x, [2.5, 1.5])
+
+
+@pytest.mark.parametrize('backend', list(BACKENDS))
+def test_solve_lp_infeasible(small_lp, backend):
+    lp = small_lp._replace(lb=np.array([3.0, 3.0]))
+    status, objective, x, _ = get_backend(backend).solve_lp(lp)
+    assert status != 'optimal'
+    assert objective is None and x is None
+
+
+@pytest.mark.parametrize('backend', PULP_BACKENDS)
+def test_solve_pulp(backend):
+    problem = plp.LpProblem(name='test', sense=plp.LpMaximize)
+    x = plp.LpVariable('x', lowBound=0, upBound=3)
+    y = plp.LpVariable('y', lowBound=0)
+    problem.setObjective(x + 2 * y + 1)
+    problem += x + y <= 4
+    problem += x - y == 1
+
+    status, objective, _, _ = get_backend(backend).solve_pulp(problem)
+    assert status == 'optimal'
+    assert np.allclose(objective, 6.5)
+    assert np.allclose([x.varValue, y.varValue], [2.5, 1.5])
+    assert plp.LpStatus[problem.status] == 'Optimal'
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        get_backend('gurobi')
+
+
+@pytest.mark.parametrize('backend', PULP_BACKENDS)
+def test_wdp_backends(bids, backend):
+    T, bid_list = bids
+    objectives = []
+    for b in ['cbc', backend]:
+        wdp = WinnerDeterminationProblem(T, seed=0, backend=b)
+        [wdp.add_bid(bd) for bd in bid_list]
+        wdp.build_problem()
+        status, objective, _, _, _ = wdp.solve()
+        assert status == 'Optimal'
+        objectives.append(objective)
+    assert np.allclose(*objectives)
+
+
+@pytest.mark.parametrize('backend', ['cplex', 'highs'])
+def test_wdp_in_memory(bids, backend, tmp_path, monkeypatch):
+    T, bid_list = bids
+    monkeypatch.chdir(tmp_path)
+    objectives = []
+    for b, mode in [('cbc', 'file'), (backend, 'memory')]:
+        wdp = WinnerDeterminationProblem(T, seed=0, backend=b, mode=mode)
+        [wdp.add_bid(bd) for bd in bid_list]
+        wdp.build_problem()
+        status, objective, _, _, _ = wdp.solve()
+        assert status == 'Optimal'
+        objectives.append(objective)
+        if mode == 'memory':
+            assert list(tmp_path.iterdir()) == []
+    assert np.allclose(*objectives)
+
+
+def test_wdp_in_memory_needs_in_process_backend(bids):
+    T, bid_list = bids
+    wdp = WinnerDeterminationProblem(T, backend='cbc', mode='memory')
+    [wdp.add_bid(bd) for bd in bid_list]
+    wdp.build_problem()
+    with pytest.raises(AssertionError):
+        wdp.solve()
+
+
+@pytest.mark.parametrize('backend', list(BACKENDS))
+def test_session(small_lp, backend):
+    session = get_backend(backend).session(small_lp)
+    assert np.allclose(session.solve()[1], -5.5)
+    # Fixing x at 0 makes x - y == 1 infeasible, y at 0 leaves x == 1
+    session.set_bounds([0], 0, 0)
+    assert session.solve()[0] != 'optimal'
+    session.set_bounds([0, 1], [0, 0], [3, 0])
+    status, objective, x, _ = session.solve()
+    assert status == 'optimal'
+    assert np.allclose(x, [1, 0])
+    assert np.allclose(small_lp.ub, [3, 10])
+
+
+@pytest.mark.parametrize('backend', list(BACKENDS))
+def test_duals(small_lp, backend):
+    _, objective, _, duals = get_backend(backend).solve_lp(small_lp)
+    # Derivative of the objective with respect to the right hand side of x - y == 1
+    moved = get_backend(backend).solve_lp(small_lp._replace(b_eq=np.array([1.01])))
+    assert np.allclose(duals, (moved.objective - objective) / 0.01)
+
+
+@pytest.mark.parametrize('backend', list(BACKENDS))
+def test_session_append(small_lp, backend):
+    session = get_backend(backend).session(small_lp)
+    session.solve()
+    # A new column z with -3z in the objective, x + y + z <= 4 and z <= 0.5 as a new row
+    lp = LinearProgram(
+        np.array([-1.0, -2.0, -3.0]),
+        sp.csr_matrix([[1.0, 1.0, 1.0], [0.0, 0.0, 1.0]]),
+        np.array([4.0, 0.5]),
+        sp.csr_matrix([[1.0, -1.0, 0.0]]),
+        np.array([1.0]),
+        np.zeros(3),
+        np.array([3.0, 10.0, 10.0]),
+    )
+    session.append(lp)
+    status, objective, x, duals = session.solve()
+    expected = get_backend(backend).solve_lp(lp)
+    assert status == 'optimal'
+    assert np.allclose(objective, expected.objective)
+    assert np.allclose(x, expected.x)
+    assert np.allclose(duals, expected.duals)
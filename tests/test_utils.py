@@ -0,0 +1,75 @@
+import pytest
+
+import numpy as np
+import lemsim.utils as lut
+from lemsim.utils import classify, derive_bid, create_bid, create_bids
+from lemsim.lp_with_reg import solve_bat
+
+
+def naive_state(l, b):
+    names = []
+    for x, signs in [(l, ['NONE', 'CONSUME', 'PRODUCE']), (b, ['IDLE', 'CHARGE', 'DISCHARGE']),
+                     (l + b, ['NONE', 'BUY', 'SELL'])]:
+        names.append(signs[0] if np.allclose(x, 0) else signs[1] if x > 0 else signs[2])
+    return getattr(lut, '_'.join(names))
+
+
+def profiles(seed, N=20, T=24):
+    r = np.random.RandomState(seed)
+    loads, bats, pbs, pss = [], [], [], []
+    for _ in range(N):
+        load = r.uniform(-1.5, 1.5, T)
+        load[r.rand(T) < 0.1] = 0
+        pb = r.choice([12.0, 16.0], T)
+        ps = r.uniform(5, 10, T)
+        _, _, sol, _ = solve_bat(load, pb, ps, 0, 2, 0, 0.95, 0.95, 1, -1)
+        loads.append(load)
+        bats.append(np.where(sol > 0, sol / 0.95, sol * 0.95))
+        pbs.append(pb)
+        pss.append(ps)
+    return [np.array(x) for x in [loads, bats, pbs, pss]]
+
+
+def test_classify():
+    loads, bats, _, _ = profiles(0)
+    action = classify(loads, bats)
+    assert action.shape == loads.shape
+    for a, l, b in zip(action.flat, loads.flat, bats.flat):
+        assert a == naive_state(l, b)
+    with pytest.raises(NameError):
+        classify([9e-9], [9e-9])
+
+
+def test_derive_bid():
+    load = np.array([1.0, 1.0, -1.0, -1.0, 0.0, 1.0])
+    bat = np.array([1.0, 0.0, 0.5, 0.0, 0.0, 0.0])
+    pb = np.array([16.0, 16.0, 12.0, 12.0, 12.0, 16.0])
+    ps = np.ones(6) * 8.0
+    action, bids = derive_bid(load, bat, pb, ps)
+    assert action == [lut.CONSUME_CHARGE_BUY, lut.CONSUME_IDLE_BUY, lut.PRODUCE_CHARGE_SELL,
+                      lut.PRODUCE_IDLE_SELL, lut.NONE_IDLE_NONE, lut.CONSUME_IDLE_BUY]
+    assert bids[:3] == [('buyone', 0, 1.0), ('buyone', 1, 1.0), ('buyone', 5, 1.0)]
+    # The bundle closes at the first slot that does not buy, priced not above its start
+    assert bids[3] == ('buybundle', 0, 1, 1.0, [0.0, 0.0])
+    kind, start, end, capacities, keep = bids[4]
+    assert (kind, start, end, keep) == ('sellbundle', 2, 3, 0.5)
+    assert np.array_equal(capacities, [1.0, 1.0])
+    assert len(bids) == 5
+
+
+@pytest.mark.parametrize('ramp', [None, 1, 'each'])
+def test_create_bids(ramp):
+    loads, bats, pbs, pss = profiles(1)
+    N = loads.shape[0]
+    ramps = list(np.linspace(0.5, 1.5, N)) if ramp == 'each' else [ramp] * N
+    created = create_bids(list(range(N)), loads, bats, pbs, pss, ramps if ramp == 'each' else ramp,
+                          ramps if ramp == 'each' else ramp)
+    for n, (bd, status) in enumerate(created):
+        bd_, status_ = create_bid(n, loads[n], bats[n], pbs[n], pss[n], ramps[n], ramps[n])
+        assert status == status_ and bd.uid == bd_.uid
+        for kind in ['bundles', 'singles', 'sellingbundles']:
+            pieces, pieces_ = getattr(bd, kind), getattr(bd_, kind)
+            assert len(pieces) == len(pieces_)
+            for x, x_ in zip(pieces, pieces_):
+                for name, v in vars(x).items():
+                    assert np.array_equal(v, vars(x_)[name])
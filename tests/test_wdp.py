@@ -0,0 +1,489 @@
+import pytest
+
+import numpy as np
+from collections import defaultdict
+from lemsim.lp_with_reg import solve_bat
+from lemsim.utils import create_bid
+from lemsim.bid import Bid
+from lemsim.wdp import WinnerDeterminationProblem
+from lemsim.wdp_matrix import column_names, components, presolve
+from lemsim.wdp_cache import SolutionCache
+from lemsim.mechanism_variants import vcg_mechanism, simple_split_mechanism, split_partition
+
+
+def generate_bids(seed, N=8, T=24):
+    """
+    Bids of `N` prosumers with random loads and prices
+    """
+    r = np.random.RandomState(seed)
+    bids = []
+    for uid in range(N):
+        load = r.uniform(-1.5, 1.5, T)
+        pb = r.choice([12.0, 16.0], T)
+        ps = r.uniform(5, 10, T)
+        _, _, sol, _ = solve_bat(load, pb, ps, 0, 2, 0, 0.95, 0.95, 1, -1)
+        bat = np.where(sol > 0, sol / 0.95, sol * 0.95)
+        bd, status = create_bid(uid, load, bat, pb, ps, 1, 1)
+        if status:
+            bids.append(bd)
+    return T, bids
+
+
+def build(bids, T, builder, budgetbalanced=False, keepable='compact'):
+    wdp = WinnerDeterminationProblem(T, builder=builder, keepable=keepable)
+    [wdp.add_bid(bd) for bd in bids]
+    wdp.build_problem(budgetbalanced)
+    return wdp
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('budgetbalanced', [False, True])
+@pytest.mark.parametrize('keepable', ['compact', 'enumerate'])
+def test_matrix_builder_matches_pulp(seed, budgetbalanced, keepable):
+    T, bids = generate_bids(seed)
+    wdp_pulp = build(bids, T, 'pulp', budgetbalanced, keepable)
+    wdp_matrix = build(bids, T, 'matrix', budgetbalanced, keepable)
+    status_p, obj_p, _, _, _ = wdp_pulp.solve()
+    status_m, obj_m, _, (vb, vs, pay), _ = wdp_matrix.solve()
+    assert status_p == status_m == 'Optimal'
+    assert np.allclose(obj_p, obj_m)
+
+    # The solution of the matrices is feasible for the PuLP model
+    variables = {v.name: v for v in wdp_pulp.model.variables()}
+    names = column_names(wdp_matrix.model.columns)
+    assert set(names) == set(variables)
+    for name, x in zip(names, wdp_matrix.solution):
+        variables[name].varValue = x
+    assert wdp_pulp.model.valid(1e-6)
+
+    # Trades are balanced in every timeslot
+    assert np.allclose(sum(vb.values()), sum(vs.values()))
+
+
+def test_column_index():
+    T, bids = generate_bids(0)
+    wdp = build(bids, T, 'matrix')
+    columns = wdp.model.columns
+    lp = wdp.model.lp
+    assert columns.shape[0] == lp.c.shape[0]
+    quantity = np.isin(columns['kind'], ['buy', 'sell'])
+    assert (columns['timeslot'][quantity] >= 0).all()
+    assert (columns['timeslot'][columns['kind'] == 'payment'] == -1).all()
+    assert set(columns['uid']) == set(bd.uid for bd in bids)
+    # Buying columns add to the welfare and selling ones subtract
+    assert np.allclose(lp.c[columns['kind'] == 'buy'], -columns['unitcost'][columns['kind'] == 'buy'])
+    assert np.allclose(lp.c[columns['kind'] == 'sell'], columns['unitcost'][columns['kind'] == 'sell'])
+
+
+def test_restrict_to_prices():
+    T, bids = generate_bids(1)
+    _, other = generate_bids(2)
+    objectives = []
+    for builder in ['pulp', 'matrix']:
+        wdp = build(bids, T, builder)
+        wdp.solve()
+        prices = wdp.get_prices()
+        wdp_other = build(other, T, builder)
+        wdp_other.restrict_to_prices(prices)
+        objectives.append(wdp_other.solve()[1])
+    assert np.allclose(*objectives)
+
+
+
+@pytest.mark.parametrize('builder', ['pulp', 'matrix'])
+def test_get_prices(builder):
+    T, bids = generate_bids(0)
+    wdp = build(bids, T, builder)
+    wdp.a, wdp.b = 0.25, 0.75
+    _, _, values, _, costs = wdp.solve()
+    prices = wdp.get_prices()
+
+    # Unit costs of the traded pieces in each timeslot
+    buying, selling = defaultdict(list), defaultdict(list)
+    for bd in bids:
+        pieces = bd.bundles + bd.singles + bd.sellingbundles
+        for i, piece in enumerate(pieces):
+            if piece.type == 'singleitem':
+                names = {piece.item: 'x_single_{0}_{1}'.format(piece.item, bd.uid)}
+            else:
+                names = {t: 'x_{0}_{1}_{2}_{3}'.format(piece.type.replace('simple', ''), t, i, bd.uid)
+                         for t in range(piece.start, piece.end + 1)}
+            isbuying = piece.type != 'sellingbundle' and piece.isbuying
+            for t, name in names.items():
+                if values[name] > 0:
+                    (buying if isbuying else selling)[t].append(piece.unitcost)
+
+    for t in range(T):
+        if buying[t] and selling[t]:
+            min_b, max_s = min(buying[t]), max(selling[t])
+            assert np.allclose(prices[t], (0.25 * max_s + 0.75 * min_b, 0.75 * max_s + 0.25 * min_b))
+        else:
+            assert np.allclose(prices[t], (-1, -1))
+
+    vb, vs, _ = wdp.summary
+    for k in costs:
+        expected = (vb[k] * wdp.price_buy).sum() if k in vb else 0
+        expected -= (vs[k] * wdp.price_sell).sum() if k in vs else 0
+        assert np.allclose(costs[k], expected)
+
+
+@pytest.mark.parametrize('builder', ['pulp', 'matrix'])
+@pytest.mark.parametrize('seed', range(3))
+def test_compact_keepable(builder, seed):
+    T, bids = generate_bids(seed, N=12)
+    objectives = [build(bids, T, builder, keepable=k).solve()[1] for k in ['compact', 'enumerate']]
+    assert np.allclose(*objectives)
+
+
+def test_compact_keepable_single_bundle():
+    """
+    Only the compact formulation is tractable for a long bundle, check
+    the solution against the worst set of every size
+    """
+    T = 40
+    q = np.linspace(0.5, 1.5, T)
+    kq = q * np.linspace(0.2, 0.8, T)
+    keep = kq.sum() / 2
+    seller = Bid(0)
+    seller.add_bundle_selling(0, T - 1, q, keep, 1.0, keep_quantities=kq)
+    buyer = Bid(1)
+    buyer.add_bundle(0, T - 1, q.sum(), 10.0, True, upper_bound=q)
+    K = seller.sellingbundles[0].threshold - 1
+    assert K > 10
+
+    wdp = build([seller, buyer], T, 'matrix')
+    status, objective, _, (vb, vs, _), _ = wdp.solve()
+    assert status == 'Optimal'
+    x = vs['0']
+    # The worst set S of at most K timeslots takes the K largest q_t - kq_t - x_t
+    gains = np.sort(q - kq - x)[::-1]
+    for k in range(K + 1):
+        rhs = q.sum() - keep - gains[:k].sum()
+        assert x.sum() <= rhs + 1e-6
+    # And it is binding, otherwise more could be sold
+    assert np.isclose(x.sum(), q.sum() - keep - np.maximum(gains[:K], 0).sum())
+
+
+@pytest.mark.parametrize('builder', ['pulp', 'matrix'])
+def test_result(builder):
+    T, bids = generate_bids(0)
+    wdp = build(bids, T, builder)
+    _, _, values, _, costs = wdp.solve()
+    result = wdp.result
+    assert list(result.uids) == [str(bd.uid) for bd in bids]
+    assert result.buy.shape == result.sell.shape == (len(bids), T)
+    assert np.allclose(result.net, result.buy - result.sell)
+    assert np.allclose(result.net.sum(axis=0), 0)
+
+    # Same allocation as parsing the names of the variables
+    for uid, buy, sell, payment in zip(result.uids, result.buy, result.sell, result.payment):
+        for t in range(T):
+            names = [k for k in values if k.startswith('x_') and k.endswith('_{0}'.format(uid))
+                     and k.split('_')[2] == str(t)]
+            assert np.isclose(buy[t], sum(values[k] for k in names if 'selling' not in k))
+            assert np.isclose(sell[t], sum(values[k] for k in names if 'selling' in k))
+        assert np.isclose(payment, sum(v for k, v in values.items()
+                                       if k.startswith('payment') and k.split('_')[2] == uid))
+
+    assert np.allclose([costs[k] for k in result.uids],
+                       result.buy @ wdp.price_buy - result.sell @ wdp.price_sell)
+
+
+@pytest.mark.parametrize('backend', ['cplex', 'highs'])
+@pytest.mark.parametrize('seed', range(2))
+def test_solve_without(backend, seed):
+    T, bids = generate_bids(seed)
+    wdp = build(bids, T, 'matrix')
+    wdp.backend = backend
+    for bd in bids:
+        # Same welfare as building the problem without the bidder
+        others = build([bd_ for bd_ in bids if bd_.uid != bd.uid], T, 'matrix')
+        others.backend = backend
+        _, expected, _, _, _ = others.solve()
+        objective, result, costs = wdp.solve_without(bd.uid)
+        assert np.isclose(objective, expected)
+        k = list(result.uids).index(str(bd.uid))
+        assert np.allclose(result.buy[k], 0) and np.allclose(result.sell[k], 0)
+        assert costs[str(bd.uid)] == 0
+    assert wdp.solution is None
+    assert np.allclose(wdp.session.lp.ub, wdp.model.lp.ub)
+
+
+@pytest.mark.parametrize('backend', ['cplex', 'highs'])
+def test_solve_without_error(backend, monkeypatch):
+    T, bids = generate_bids(0)
+    wdp = build(bids, T, 'matrix')
+    wdp.backend = backend
+    objective = wdp.solve()[1]
+    expected = wdp.solve_without(bids[1].uid)[0]
+    lb, ub = wdp.session.lp.lb.copy(), wdp.session.lp.ub.copy()
+
+    def fail():
+        raise RuntimeError('solver failed')
+    with monkeypatch.context() as m:
+        m.setattr(wdp.session, 'solve', fail)
+        with pytest.raises(RuntimeError):
+            wdp.solve_without(bids[0].uid)
+    # The bidder is back in the session
+    assert np.array_equal(wdp.session.lp.lb, lb) and np.array_equal(wdp.session.lp.ub, ub)
+    assert np.isclose(wdp.solve_without(bids[1].uid)[0], expected)
+    assert np.isclose(wdp.solve()[1], objective)
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_vcg_mechanism(workers):
+    T, bids = generate_bids(0)
+    wdp, result, payments = vcg_mechanism(bids, T=T, backend='cplex', workers=workers)
+    costs = wdp.get_costs()
+    total_cost = sum(costs.values())
+    for bd, buy, sell in zip(bids, result.buy, result.sell):
+        if (buy + sell).sum() > 1e-4:
+            _, _, costs_bd = wdp.solve_without(bd.uid)
+            assert np.isclose(payments[bd.uid], total_cost - costs[str(bd.uid)] - sum(costs_bd.values()))
+        else:
+            # Bidders that do not trade are not re-solved
+            assert payments[bd.uid] == 0
+
+
+@pytest.mark.parametrize('backend', ['cplex', 'highs'])
+def test_split_partition(backend):
+    T, bids = generate_bids(1)
+    sides, result, costs = simple_split_mechanism(bids, np.random.RandomState(0), T=T, backend=backend)
+    prices = []
+    for w in sides:
+        first = build(w.bids, T, 'matrix')
+        first.backend = backend
+        first.solve()
+        prices.append(first.get_prices())
+    for w, p in zip(sides, prices[::-1]):
+        # The warm-started second solve matches solving the restricted problem from scratch
+        fresh = build(w.bids, T, 'matrix')
+        fresh.backend = backend
+        fresh.restrict_to_prices(p)
+        assert np.isclose(w.solve()[1], fresh.solve()[1])
+    assert np.allclose(result.net.sum(axis=0), 0)
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_split_partitions(workers):
+    T, bids = generate_bids(1)
+    _, result, costs = simple_split_mechanism(bids, np.random.RandomState(0), T=T, backend='cplex',
+                                              partitions=3, workers=workers)
+    seeds = np.random.RandomState(0).randint(0, 2 ** 31 - 1, 3)
+    outputs = [split_partition(bids, np.random.RandomState(s), T=T, backend='cplex') for s in seeds]
+    for uid, net in zip(result.uids, result.net):
+        expected = [res.net[list(res.uids).index(uid)] for _, res, _ in outputs]
+        assert np.allclose(net, np.mean(expected, axis=0))
+        assert np.isclose(costs[uid], np.mean([c[uid] for _, _, c in outputs]))
+    assert np.allclose(result.net.sum(axis=0), 0)
+
+
+def window_bids(seed, windows, n=4):
+    """
+    `n` buyers and `n` sellers with bundles inside each of the `windows`
+    """
+    r = np.random.RandomState(seed)
+    bids = []
+    for start, end in windows:
+        L = end - start + 1
+        for _ in range(n):
+            buyer, seller = Bid(len(bids)), Bid(len(bids) + 1)
+            q = r.uniform(0.2, 1.0, L)
+            buyer.add_bundle(start, end, q.sum() * r.uniform(0.3, 1), r.uniform(8, 16), True, upper_bound=q)
+            singles = r.choice(L, 2, replace=False)
+            for t in singles:
+                buyer.add_single(start + t, r.uniform(0.1, 0.5), r.uniform(8, 16), True)
+            q = r.uniform(0.2, 1.0, L)
+            seller.add_bundle_selling(start, end, q, q.sum() * r.uniform(0, 0.5), r.uniform(4, 12))
+            bids.extend([buyer, seller])
+    return bids
+
+
+@pytest.mark.parametrize('budgetbalanced', [False, True])
+@pytest.mark.parametrize('workers', [None, 2])
+def test_decompose(budgetbalanced, workers):
+    T = 24
+    bids = window_bids(0, [(0, 5), (4, 7), (10, 15), (18, 23)])
+    wdp = build(bids, T, 'matrix', budgetbalanced)
+    blocks = components(wdp.model.columns, T)
+    # The first two windows overlap
+    assert [sorted(set(wdp.model.columns['bid'][cols])) for cols in blocks] == \
+        [list(range(0, 16)), list(range(16, 24)), list(range(24, 32))]
+
+    status, objective, _, _, costs = wdp.solve()
+    wdp_blocks = build(bids, T, 'matrix', budgetbalanced)
+    wdp_blocks.decompose, wdp_blocks.workers = True, workers
+    status_b, objective_b, values, _, costs_b = wdp_blocks.solve()
+    assert status == status_b == 'Optimal'
+    assert np.isclose(objective, objective_b)
+    # The solution is feasible for the whole problem, including the budget balance
+    wdp_pulp = build(bids, T, 'pulp', budgetbalanced)
+    for v in wdp_pulp.model.variables():
+        v.varValue = values[v.name]
+    assert wdp_pulp.model.valid(1e-6)
+    assert np.allclose(wdp_blocks.result.net.sum(axis=0), 0)
+
+
+def test_decompose_single_component():
+    T, bids = generate_bids(0)
+    wdp = build(bids, T, 'matrix')
+    assert len(components(wdp.model.columns, T)) == 1
+    objective = wdp.solve()[1]
+    wdp.decompose = True
+    assert np.isclose(wdp.solve()[1], objective)
+
+
+@pytest.mark.parametrize('backend', ['cplex', 'highs', 'cbc'])
+@pytest.mark.parametrize('decompose', [False, True])
+def test_dual_prices(backend, decompose):
+    T, bids = generate_bids(1)
+    wdp = WinnerDeterminationProblem(T, seed=0, backend=backend, decompose=decompose, pricing='duals')
+    [wdp.add_bid(bd) for bd in bids]
+    wdp.build_problem()
+    _, _, _, _, costs = wdp.solve()
+    prices = np.array(wdp.get_prices())
+    assert np.allclose(prices[:, 0], prices[:, 1])
+
+    # Between the highest selling and the lowest buying unit cost that trade
+    wdp.pricing = 'alphabeta'
+    wdp.a, wdp.b = 0, 0
+    lowest = np.array(wdp.get_prices())[:, 0]
+    wdp.a, wdp.b = 1, 1
+    highest = np.array(wdp.get_prices())[:, 0]
+    closed = np.isclose(lowest, -1)
+    assert np.allclose(prices[closed], -1)
+    assert (prices[~closed, 0] >= lowest[~closed] - 1e-6).all()
+    assert (prices[~closed, 0] <= highest[~closed] + 1e-6).all()
+
+    result = wdp.result
+    assert np.allclose([costs[k] for k in result.uids], result.net @ prices[:, 0])
+
+
+@pytest.mark.parametrize('budgetbalanced', [False, True])
+@pytest.mark.parametrize('seed', range(3))
+def test_presolve(seed, budgetbalanced):
+    T, bids = generate_bids(seed, N=16)
+    # Buying below every seller and selling above every buyer
+    low, high = Bid(100), Bid(101)
+    low.add_bundle(0, T - 1, 4.0, 1.0, True, upper_bound=np.ones(T))
+    high.add_bundle_selling(0, 5, np.ones(6), 0, 100.0)
+    bids += [low, high]
+    wdp = build(bids, T, 'matrix', budgetbalanced)
+    objective = wdp.solve()[1]
+
+    presolved = presolve(wdp.model)
+    removed = np.setdiff1d(np.arange(len(wdp.model.columns)), presolved.cols)
+    kept = wdp.model.columns[presolved.cols]
+    # Only the columns of the quantity to keep of the selling bundle are left
+    assert set(kept['kind'][np.isin(kept['uid'], [100, 101])]) == {'keep'}
+    assert removed.shape[0] > T + 6
+    assert presolved.model.lp.A_ub.shape[0] < wdp.model.lp.A_ub.shape[0]
+    assert (presolved.model.lp.ub <= wdp.model.lp.ub[presolved.cols]).all()
+
+    wdp.presolve = True
+    status, objective_p, values, _, _ = wdp.solve()
+    assert status == 'Optimal'
+    assert np.isclose(objective, objective_p)
+    # Reported for every bid and feasible for the whole problem
+    assert list(wdp.result.uids) == [str(bd.uid) for bd in bids]
+    wdp_pulp = build(bids, T, 'pulp', budgetbalanced)
+    for v in wdp_pulp.model.variables():
+        v.varValue = values[v.name]
+    assert wdp_pulp.model.valid(1e-6)
+
+
+def test_presolve_solve_without():
+    T, bids = generate_bids(0)
+    wdp = build(bids, T, 'matrix')
+    wdp_p = build(bids, T, 'matrix')
+    wdp_p.presolve = True
+    wdp.solve()
+    wdp_p.solve()
+    for bd in bids:
+        assert np.isclose(wdp.solve_without(bd.uid)[0], wdp_p.solve_without(bd.uid)[0])
+
+
+@pytest.mark.parametrize('backend', ['cplex', 'highs'])
+@pytest.mark.parametrize('budgetbalanced', [False, True])
+def test_add_remove_bid(backend, budgetbalanced):
+    T, bids = generate_bids(2, N=10)
+    first, rest = bids[:5], bids[5:]
+    wdp = build(first, T, 'matrix', budgetbalanced)
+    wdp.backend = backend
+    wdp.solve()
+    for bd in rest:
+        assert wdp.add_bid(bd)
+    wdp.remove_bid(first[0].uid)
+    wdp.remove_bid(rest[0].uid)
+    status, objective, values, _, costs = wdp.solve()
+
+    # Same as building the problem with the remaining bids
+    remaining = first[1:] + rest[1:]
+    fresh = build(remaining, T, 'matrix', budgetbalanced)
+    fresh.backend = backend
+    status_f, objective_f, _, _, costs_f = fresh.solve()
+    assert status == status_f == 'Optimal'
+    assert np.isclose(objective, objective_f)
+    assert list(wdp.result.uids) == [str(bd.uid) for bd in remaining]
+    assert set(costs) == set(costs_f) == set(wdp.result.uids)
+    # The costs are those of the new allocation, at its own prices
+    assert np.allclose([costs[u] for u in wdp.result.uids], wdp.result.costs(*wdp.clearing_prices()))
+    # Both solutions are optimal, but the solver can start from the last
+    # one and return another allocation
+    if np.allclose(wdp.result.net, fresh.result.net):
+        assert np.allclose([costs[u] for u in costs_f], list(costs_f.values()))
+    else:
+        assert backend == 'cplex'
+    assert np.allclose(wdp.result.net.sum(axis=0), 0)
+
+    # The matrices are those of the whole bid set with the removed bids fixed at zero
+    wdp_pulp = build(first + rest, T, 'pulp', budgetbalanced)
+    for v in wdp_pulp.model.variables():
+        v.varValue = values[v.name]
+    assert wdp_pulp.model.valid(1e-6)
+
+
+@pytest.mark.parametrize('path', [False, True])
+def test_solution_cache(path, tmp_path):
+    T, bids = generate_bids(1)
+    cache = SolutionCache(str(tmp_path) if path else None)
+    results = []
+    for a, b in [(0, 1), (0.5, 0.5)]:
+        wdp = WinnerDeterminationProblem(T, a, b, cache=cache)
+        [wdp.add_bid(bd) for bd in bids]
+        wdp.build_problem()
+        results.append(wdp.solve())
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Same allocation, and the same prices as solving with these alpha and beta
+    fresh = build(bids, T, 'matrix')
+    fresh.a, fresh.b = 0.5, 0.5
+    expected = fresh.solve()
+    assert np.isclose(results[1][1], expected[1])
+    assert np.allclose(wdp.solution, fresh.solution)
+    assert wdp.get_prices() == fresh.get_prices()
+    assert results[1][4] == expected[4]
+
+    # Re-pricing the cached allocation gives the costs of the first solve
+    assert wdp.reprice(0, 1) == results[0][4]
+
+    if path:
+        # A new cache finds the solution on disk
+        cache = SolutionCache(str(tmp_path))
+        wdp = build(bids, T, 'matrix')
+        wdp.cache = cache
+        wdp.solve()
+        assert cache.hits == 1 and np.allclose(wdp.solution, fresh.solution)
+
+
+def test_solution_cache_key():
+    T, bids = generate_bids(1)
+    keys = set()
+    for bids_, seed in [(bids, 420), (bids, 420), (bids, 0), (bids[1:], 420)]:
+        wdp = WinnerDeterminationProblem(T, seed=seed)
+        [wdp.add_bid(bd) for bd in bids_]
+        wdp.build_problem()
+        keys.add(wdp.cache_key())
+    assert len(keys) == 3
+    wdp.restrict_to_prices([(14.0, 8.0)] * T)
+    assert wdp.cache_key() not in keys